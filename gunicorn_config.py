@@ -0,0 +1,8 @@
+# Server hooks for gunicorn, loaded through GUNICORN_CMD_ARGS in the Dockerfile
+from prometheus_client import multiprocess
+
+
+def child_exit(server, worker):
+    # Runs in the master however the worker went (including being killed), so its in flight gauge isn't still added
+    # in to /metrics after it has gone
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,50 @@
+import unittest
+from sqlalchemy import desc
+from verification_api.main import app
+from verification_api.extensions import db
+from verification_api.models import Case, Note, Close
+
+
+class TestIndexes(unittest.TestCase):
+    """Checks the status and foreign key lookups are served by indexes rather than sequential scans.
+
+    Sequential scans are disabled for the duration of each EXPLAIN, otherwise the planner would (rightly) prefer
+    them on the handful of rows a test database holds. With them disabled a sequential scan in the plan means
+    there is no index that can serve the query at all.
+    """
+
+    def test_get_pending(self):
+        with app.app_context():
+            self._assert_no_seq_scan(Case._pending_query())
+
+    def test_get_case_by_ldap_id(self):
+        with app.app_context():
+            self._assert_no_seq_scan(Case.query.filter_by(ldap_id='abc-123'))
+
+    def test_get_notepad_by_case_id(self):
+        with app.app_context():
+            self._assert_no_seq_scan(Note.query.filter_by(verification_id=1).order_by(desc(Note.date_added)))
+
+    def test_get_closure_by_case_id(self):
+        with app.app_context():
+            self._assert_no_seq_scan(Close.query.filter_by(verification_id=1))
+
+    def _assert_no_seq_scan(self, query):
+        try:
+            connection = db.session.connection()
+            connection.execute('SET LOCAL enable_seqscan = off')
+            statement = query.statement.compile(dialect=db.engine.dialect)
+            plan = connection.execute('EXPLAIN (FORMAT JSON) ' + str(statement), statement.params).scalar()
+        finally:
+            db.session.rollback()
+            db.session.close()
+
+        seq_scans = [node['Relation Name'] for node in _plan_nodes(plan[0]['Plan'])
+                     if node['Node Type'] == 'Seq Scan']
+        self.assertEqual(seq_scans, [], 'Sequential scan in plan: {}'.format(plan))
+
+
+def _plan_nodes(node):
+    yield node
+    for child in node.get('Plans', []):
+        yield from _plan_nodes(child)
@@ -292,10 +292,10 @@ class TestVerificationAPI(unittest.TestCase):
         response = self.client.post(url, data=json.dumps(search_params), headers=self.headers)
 
         self.assertEqual(200, response.status_code)
-        response_body = response.get_json()
-        self.assertTrue(len(response_body) > 0)
-        self.assertEqual(response_body[0]['status'], 'Pending')
-        self.assertEqual(response_body[0]['registration_data']['first_name'], 'Rob')
+        results = response.get_json()['results']
+        self.assertTrue(len(results) > 0)
+        self.assertEqual(results[0]['status'], 'Pending')
+        self.assertEqual(results[0]['registration_data']['first_name'], 'Rob')
 
     def test_search_no_result(self):
         search_params = {
@@ -308,7 +308,7 @@ class TestVerificationAPI(unittest.TestCase):
         response = self.client.post(url, data=json.dumps(search_params), headers=self.headers)
         self.assertEqual(200, response.status_code)
         response_body = response.get_json()
-        self.assertEqual(len(response_body), 0)
+        self.assertEqual(response_body['results'], [])
 
     # ----[ Helper Functions ]---- #
 
@@ -1,9 +1,12 @@
 import os
+import time
 from flask_script import Manager
 from verification_api.main import app
 from flask_migrate import Migrate, MigrateCommand
 from verification_api.models import *    # noqa
 from verification_api.extensions import db
+from verification_api.dependencies import metric_api
+from verification_api.services import verification_service
 
 migrate = Migrate(app, db)
 
@@ -23,5 +26,39 @@ def runserver(port=9998):
     app.run(debug=True, port=int(port))
 
 
+@manager.command
+def drain_metrics():
+    """Send events from the metric outbox to dps-metric-api until stopped"""
+
+    batch_size = app.config['METRIC_OUTBOX_BATCH_SIZE']
+    while True:
+        try:
+            sent = metric_api.drain_metric_outbox(batch_size)
+        except Exception as e:
+            app.logger.error('Failed to drain metric outbox: {}'.format(e))
+            sent = 0
+        # Keep going straight away while there's a backlog, otherwise wait for more events
+        if sent < batch_size:
+            time.sleep(app.config['METRIC_OUTBOX_INTERVAL'])
+
+
+@manager.command
+def purge_idempotency_keys(interval=0):
+    """Remove idempotency keys older than IDEMPOTENCY_KEY_TTL, then again every interval seconds if one is given"""
+
+    interval = int(interval)
+    while True:
+        try:
+            purged = verification_service.purge_idempotency_keys()
+            app.logger.info('Purged {} idempotency keys'.format(purged))
+        except Exception as e:
+            if not interval:
+                raise
+            app.logger.error('Failed to purge idempotency keys: {}'.format(e))
+        if not interval:
+            return
+        time.sleep(interval)
+
+
 if __name__ == "__main__":
     manager.run()
@@ -0,0 +1,33 @@
+"""indexes for status, ldap_id and foreign key lookups
+
+Revision ID: 22090ddf20cb
+Revises: a6dbe85920e3
+Create Date: 2026-10-17 10:03:27.118204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '22090ddf20cb'
+down_revision = 'a6dbe85920e3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Serves the worklist, including its keyset paging on (date_added, verification_id)
+    op.create_index('ix_verification_pending_date_added', 'verification',
+                    [sa.text('date_added DESC'), sa.text('verification_id DESC')],
+                    postgresql_where=sa.text("status = 'Pending'"))
+    op.create_index('ix_verification_ldap_id', 'verification', ['ldap_id'], unique=True)
+    op.create_index('ix_note_verification_id_date_added', 'note', ['verification_id', sa.text('date_added DESC')])
+    op.create_index('ix_close_verification_id', 'close', ['verification_id'])
+
+
+def downgrade():
+    op.drop_index('ix_close_verification_id', table_name='close')
+    op.drop_index('ix_note_verification_id_date_added', table_name='note')
+    op.drop_index('ix_verification_ldap_id', table_name='verification')
+    op.drop_index('ix_verification_pending_date_added', table_name='verification')
@@ -0,0 +1,26 @@
+"""response headers on idempotency_key for replaying
+
+Revision ID: 3a7c5e9b1d24
+Revises: e4b8d2f61c07
+Create Date: 2026-10-17 19:41:07.285316
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '3a7c5e9b1d24'
+down_revision = 'e4b8d2f61c07'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('idempotency_key',
+                  sa.Column('response_headers', postgresql.JSONB(astext_type=sa.Text()), nullable=True))
+
+
+def downgrade():
+    op.drop_column('idempotency_key', 'response_headers')
@@ -0,0 +1,34 @@
+"""metric outbox table
+
+Revision ID: 5ef7e5c8ee45
+Revises: 22090ddf20cb
+Create Date: 2026-10-17 11:26:54.730159
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+from flask import current_app
+
+
+# revision identifiers, used by Alembic.
+revision = '5ef7e5c8ee45'
+down_revision = '22090ddf20cb'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('metric_outbox',
+                    sa.Column('outbox_id', sa.Integer(), nullable=False),
+                    sa.Column('payload', postgresql.JSONB(astext_type=sa.Text()), nullable=False),
+                    sa.Column('trace_id', sa.String(), nullable=True),
+                    sa.Column('date_added', sa.DateTime(timezone=True), nullable=True),
+                    sa.PrimaryKeyConstraint('outbox_id')
+                    )
+    op.execute("GRANT SELECT, UPDATE, INSERT, DELETE ON TABLE metric_outbox TO " + current_app.config.get('APP_SQL_USERNAME'))
+    op.execute("GRANT USAGE, SELECT ON metric_outbox_outbox_id_seq TO " + current_app.config.get('APP_SQL_USERNAME'))
+
+
+def downgrade():
+    op.drop_table('metric_outbox')
@@ -0,0 +1,27 @@
+"""locked_until on verification for expiring case locks
+
+Revision ID: 7f2a9c41d8e0
+Revises: c9d4e2a1f7b3
+Create Date: 2026-10-17 15:17:33.208476
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7f2a9c41d8e0'
+down_revision = 'c9d4e2a1f7b3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('verification', sa.Column('locked_until', sa.DateTime(timezone=True), nullable=True))
+    # Give cases that are already locked a lease, so they aren't up for grabs the moment this is deployed
+    op.execute("UPDATE verification SET locked_until = now() + interval '15 minutes' "
+               "WHERE status = 'Pending' AND staff_id IS NOT NULL")
+
+
+def downgrade():
+    op.drop_column('verification', 'locked_until')
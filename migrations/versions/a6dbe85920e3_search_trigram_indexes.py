@@ -0,0 +1,31 @@
+"""trigram indexes for case search
+
+Revision ID: a6dbe85920e3
+Revises: 594dc4410fc6
+Create Date: 2026-10-17 09:12:41.503318
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'a6dbe85920e3'
+down_revision = '594dc4410fc6'
+branch_labels = None
+depends_on = None
+
+# The registration_data fields that can be searched on. The index expressions must match the ones
+# Case.search builds exactly (including the key being a literal) for the planner to use them.
+SEARCH_FIELDS = ['first_name', 'last_name', 'organisation_name', 'email']
+
+
+def upgrade():
+    op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    for field in SEARCH_FIELDS:
+        op.execute("CREATE INDEX ix_verification_{0}_trgm ON verification "
+                   "USING gin ((registration_data ->> '{0}') gin_trgm_ops)".format(field))
+
+
+def downgrade():
+    for field in SEARCH_FIELDS:
+        op.execute("DROP INDEX ix_verification_{}_trgm".format(field))
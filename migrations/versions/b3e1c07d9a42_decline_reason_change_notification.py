@@ -0,0 +1,34 @@
+"""notify decline_reason_changed when the decline reasons change
+
+Revision ID: b3e1c07d9a42
+Revises: 5ef7e5c8ee45
+Create Date: 2026-10-17 12:41:09.372815
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'b3e1c07d9a42'
+down_revision = '5ef7e5c8ee45'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Each worker keeps the decline reasons in memory until it hears about a change on this channel
+    op.execute("""
+        CREATE FUNCTION notify_decline_reason_changed() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('decline_reason_changed', '');
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+    op.execute("CREATE TRIGGER decline_reason_changed AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON decline_reason "
+               "FOR EACH STATEMENT EXECUTE PROCEDURE notify_decline_reason_changed()")
+
+
+def downgrade():
+    op.execute("DROP TRIGGER decline_reason_changed ON decline_reason")
+    op.execute("DROP FUNCTION notify_decline_reason_changed()")
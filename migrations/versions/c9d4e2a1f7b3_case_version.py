@@ -0,0 +1,24 @@
+"""version column on verification for optimistic concurrency
+
+Revision ID: c9d4e2a1f7b3
+Revises: b3e1c07d9a42
+Create Date: 2026-10-17 14:02:51.640183
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c9d4e2a1f7b3'
+down_revision = 'b3e1c07d9a42'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('verification', sa.Column('version', sa.Integer(), nullable=False, server_default='1'))
+
+
+def downgrade():
+    op.drop_column('verification', 'version')
@@ -0,0 +1,36 @@
+"""idempotency key table
+
+Revision ID: e4b8d2f61c07
+Revises: 7f2a9c41d8e0
+Create Date: 2026-10-17 17:02:41.118734
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+from flask import current_app
+
+
+# revision identifiers, used by Alembic.
+revision = 'e4b8d2f61c07'
+down_revision = '7f2a9c41d8e0'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('idempotency_key',
+                    sa.Column('idempotency_key', sa.String(), nullable=False),
+                    sa.Column('request_hash', sa.String(), nullable=False),
+                    sa.Column('response_code', sa.Integer(), nullable=True),
+                    sa.Column('response_body', postgresql.JSONB(astext_type=sa.Text()), nullable=True),
+                    sa.Column('date_added', sa.DateTime(timezone=True), nullable=False),
+                    sa.PrimaryKeyConstraint('idempotency_key')
+                    )
+    op.create_index('ix_idempotency_key_date_added', 'idempotency_key', ['date_added'])
+    op.execute("GRANT SELECT, UPDATE, INSERT, DELETE ON TABLE idempotency_key TO " + current_app.config.get('APP_SQL_USERNAME'))
+
+
+def downgrade():
+    op.drop_index('ix_idempotency_key_date_added', table_name='idempotency_key')
+    op.drop_table('idempotency_key')
@@ -1,12 +1,19 @@
+import queue
 import unittest
 import requests
-from flask import current_app
+from flask import current_app, g
 from verification_api.main import app
 from verification_api.exceptions import ApplicationError
-from unittest.mock import patch
+from unittest.mock import patch, MagicMock
 from verification_api.dependencies.metric_api import (MetricAPI,
+                                                      MetricDispatcher,
                                                       _create_metric_payload,
+                                                      _send_with_backoff,
+                                                      add_metric_event_to_outbox,
+                                                      add_metric_events_to_outbox,
+                                                      drain_metric_outbox,
                                                       insert_metric_event,
+                                                      send_metric_events,
                                                       handle_dataset_access_metrics)
 from requests.exceptions import HTTPError, ConnectionError, Timeout
 from common_utilities import errors
@@ -98,26 +105,156 @@ class TestDependencyMetricAPI(unittest.TestCase):
                 self.assertEqual(context.exception.code, 'E515')
                 self.assertEqual(context.exception.http_code, 500)
 
-    @patch("verification_api.dependencies.metric_api.MetricAPI")
+    @patch("verification_api.dependencies.metric_api.dispatcher")
     @patch("verification_api.dependencies.metric_api._create_metric_payload")
-    def test_insert_metric_event_success(self, mock_create_payload, mock_metric_api, *_):
-        mock_metric_api.add_event.return_value = {'foo': 'bar'}
+    def test_insert_metric_event_success(self, mock_create_payload, mock_dispatcher, *_):
+        mock_create_payload.return_value = {'foo': 'bar'}
         with app.app_context() as ac:
             ac.g.trace_id = None
             insert_metric_event('dst_action_approved', self.payload)
         mock_create_payload.assert_called_once()
+        mock_dispatcher.enqueue.assert_called_once_with({'foo': 'bar'})
+
+    @patch("verification_api.dependencies.metric_api.db")
+    @patch("verification_api.dependencies.metric_api.MetricOutbox")
+    def test_add_metric_event_to_outbox(self, mock_outbox, mock_db):
+        with app.app_context() as ac:
+            ac.g.trace_id = 'abc123'
+            add_metric_event_to_outbox('account closed', self.payload)
+
+        expected_payload = {
+            'user': {'ckan_user_id': '123-456-abc', 'status': 'Pending', 'user_type': 'organisation-uk'},
+            'activity': {'activity_type': 'account closed', 'dataset': None, 'filename': None}
+        }
+        mock_outbox.assert_called_once_with(expected_payload, 'abc123')
+        mock_db.session.add.assert_called_once_with(mock_outbox.return_value)
+        mock_db.session.commit.assert_not_called()
 
+    @patch("verification_api.dependencies.metric_api.MetricOutbox")
+    def test_add_metric_events_to_outbox(self, mock_outbox):
+        with app.app_context() as ac:
+            ac.g.trace_id = 'abc123'
+            add_metric_events_to_outbox('application received', [dict(self.payload), dict(self.payload)])
+
+        expected_payload = {
+            'user': {'ckan_user_id': '123-456-abc', 'status': 'Pending', 'user_type': 'organisation-uk'},
+            'activity': {'activity_type': 'application received', 'dataset': None, 'filename': None}
+        }
+        mock_outbox.add_many.assert_called_once_with([expected_payload, expected_payload], 'abc123')
+
+    @patch("verification_api.dependencies.metric_api.MetricOutbox")
+    def test_add_metric_events_to_outbox_none(self, mock_outbox):
+        with app.app_context():
+            add_metric_events_to_outbox('application received', [])
+
+        mock_outbox.add_many.assert_not_called()
+
+    @patch("verification_api.dependencies.metric_api.db")
     @patch("verification_api.dependencies.metric_api.MetricAPI")
-    @patch("verification_api.dependencies.metric_api._create_metric_payload")
-    def test_insert_metric_event_error(self, mock_create_payload, mock_metric_api, *_):
-        mock_create_payload.return_value = {'foo': 'bar'}
-        error = ApplicationError(*errors.get("verification_api", "METRIC_API_HTTP_ERROR"))
-        mock_metric_api.return_value.add_event.side_effect = error
+    @patch("verification_api.dependencies.metric_api.MetricOutbox")
+    def test_drain_metric_outbox(self, mock_outbox, mock_metric_api, mock_db):
+        mock_outbox.lock_batch.return_value = [MagicMock(outbox_id=1, payload={'foo': 'bar'}, trace_id='a'),
+                                               MagicMock(outbox_id=2, payload={'foo': 'baz'}, trace_id='b')]
+        with app.app_context():
+            sent = drain_metric_outbox(10)
+
+        self.assertEqual(sent, 2)
+        mock_outbox.lock_batch.assert_called_once_with(10)
+        self.assertEqual(mock_metric_api.return_value.add_event.call_count, 2)
+        mock_outbox.remove.assert_called_once_with([1, 2])
+        mock_db.session.commit.assert_called_once()
+
+    @patch("verification_api.dependencies.metric_api.db")
+    @patch("verification_api.dependencies.metric_api.MetricAPI")
+    @patch("verification_api.dependencies.metric_api.MetricOutbox")
+    def test_drain_metric_outbox_api_down(self, mock_outbox, mock_metric_api, mock_db):
+        mock_outbox.lock_batch.return_value = [MagicMock(outbox_id=1, payload={'foo': 'bar'}, trace_id='a'),
+                                               MagicMock(outbox_id=2, payload={'foo': 'baz'}, trace_id='b'),
+                                               MagicMock(outbox_id=3, payload={'foo': 'qux'}, trace_id='c')]
+        error = ApplicationError(*errors.get("verification_api", "METRIC_API_CONN_ERROR"))
+        mock_metric_api.return_value.add_event.side_effect = [{'message': 'event added'}, error]
+        with app.app_context():
+            sent = drain_metric_outbox(10)
+
+        self.assertEqual(sent, 1)
+        self.assertEqual(mock_metric_api.return_value.add_event.call_count, 2)
+        mock_outbox.remove.assert_called_once_with([1])
+        mock_db.session.commit.assert_called_once()
+
+    @patch("verification_api.dependencies.metric_api.time")
+    def test_send_with_backoff_error(self, mock_time):
+        mock_event = MagicMock()
+        mock_event.add_event.side_effect = ApplicationError(*errors.get("verification_api", "METRIC_API_HTTP_ERROR"))
         with app.app_context() as ac:
-            metric_retry = current_app.config["METRIC_RETRY"]
+            metric_retry = int(current_app.config["METRIC_RETRY"])
+            backoff = current_app.config["METRIC_BACKOFF"]
             ac.g.trace_id = None
-            insert_metric_event('dst_action_approved', self.payload)
-        self.assertEqual(mock_metric_api.return_value.add_event.call_count, int(metric_retry))
+            result = _send_with_backoff(mock_event, {'foo': 'bar'})
+
+        self.assertFalse(result)
+        self.assertEqual(mock_event.add_event.call_count, metric_retry)
+        self.assertEqual([call[0][0] for call in mock_time.sleep.call_args_list],
+                         [backoff * 2 ** attempt for attempt in range(metric_retry - 1)])
+
+    @patch("verification_api.dependencies.metric_api.time")
+    def test_send_with_backoff_retry_success(self, mock_time):
+        mock_event = MagicMock()
+        mock_event.add_event.side_effect = [ApplicationError(*errors.get("verification_api", "METRIC_API_TIMEOUT")),
+                                            {'message': 'event added'}]
+        with app.app_context() as ac:
+            ac.g.trace_id = None
+            result = _send_with_backoff(mock_event, {'foo': 'bar'})
+
+        self.assertTrue(result)
+        self.assertEqual(mock_event.add_event.call_count, 2)
+        mock_time.sleep.assert_called_once()
+
+    @patch("verification_api.dependencies.metric_api._send_with_backoff")
+    @patch("verification_api.dependencies.metric_api.MetricAPI")
+    def test_send_metric_events(self, mock_metric_api, mock_send):
+        trace_ids = []
+        mock_send.side_effect = lambda event, payload: trace_ids.append(g.trace_id) or payload['ok']
+
+        with app.app_context():
+            sent = send_metric_events([('trace-1', {'ok': True}), ('trace-2', {'ok': False})])
+
+        self.assertEqual(sent, 1)
+        self.assertEqual(trace_ids, ['trace-1', 'trace-2'])
+        mock_metric_api.assert_called_once()
+
+    @patch("verification_api.dependencies.metric_api.threading")
+    def test_dispatcher_enqueue(self, mock_threading):
+        dispatcher = MetricDispatcher()
+        with app.test_request_context():
+            g.trace_id = 'abc123'
+            dispatcher.enqueue({'foo': 'bar'})
+            dispatcher.enqueue({'foo': 'baz'})
+
+        mock_threading.Thread.return_value.start.assert_called_once()
+        self.assertEqual(dispatcher._next_batch(10), [('abc123', {'foo': 'bar'}), ('abc123', {'foo': 'baz'})])
+
+    @patch("verification_api.dependencies.metric_api.app")
+    @patch("verification_api.dependencies.metric_api.threading")
+    def test_dispatcher_enqueue_full(self, mock_threading, mock_app):
+        dispatcher = MetricDispatcher()
+        with app.test_request_context():
+            g.trace_id = 'abc123'
+            dispatcher._start()
+            dispatcher.queue = queue.Queue(maxsize=1)
+            dispatcher.enqueue({'foo': 'bar'})
+            dispatcher.enqueue({'foo': 'baz'})
+
+        mock_app.logger.error.assert_called_once_with("Metric queue full, dropping event: {'foo': 'baz'}")
+        self.assertEqual(dispatcher._next_batch(10), [('abc123', {'foo': 'bar'})])
+
+    def test_dispatcher_next_batch_limit(self):
+        dispatcher = MetricDispatcher()
+        dispatcher.queue = queue.Queue()
+        for number in range(5):
+            dispatcher.queue.put((None, number))
+
+        self.assertEqual(dispatcher._next_batch(3), [(None, 0), (None, 1), (None, 2)])
+        self.assertEqual(dispatcher._next_batch(3), [(None, 3), (None, 4)])
 
     @patch("verification_api.dependencies.metric_api.app")
     @patch("verification_api.dependencies.metric_api._create_metric_payload")
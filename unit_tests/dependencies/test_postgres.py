@@ -0,0 +1,74 @@
+import datetime
+import unittest
+from unittest.mock import patch
+from sqlalchemy.exc import OperationalError
+
+from verification_api.main import app
+from verification_api.exceptions import ApplicationError
+from verification_api.dependencies import postgres
+
+
+@patch('verification_api.dependencies.postgres._get_engine')
+class TestPostgres(unittest.TestCase):
+
+    def setUp(self):
+        postgres._timestamp_cache.clear()
+        self.timestamp = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+
+    def test_get_current_timestamp(self, mock_get_engine):
+        connection = mock_get_engine.return_value.begin.return_value.__enter__.return_value
+        connection.execute.return_value.scalar.return_value = self.timestamp
+
+        with app.app_context():
+            result = postgres.get_current_timestamp()
+
+        self.assertEqual(result, self.timestamp)
+        timeout_call, timestamp_call = connection.execute.call_args_list
+        self.assertIn('statement_timeout', str(timeout_call[0][0]))
+        self.assertEqual(timeout_call[1], {'timeout': str(app.config['HEALTH_DB_TIMEOUT'])})
+        self.assertEqual(str(timestamp_call[0][0]), 'SELECT CURRENT_TIMESTAMP')
+
+    def test_get_current_timestamp_cached(self, mock_get_engine):
+        connection = mock_get_engine.return_value.begin.return_value.__enter__.return_value
+        connection.execute.return_value.scalar.return_value = self.timestamp
+
+        with app.app_context():
+            first = postgres.get_current_timestamp()
+            second = postgres.get_current_timestamp()
+
+        self.assertEqual(first, second)
+        mock_get_engine.return_value.begin.assert_called_once()
+
+    def test_get_current_timestamp_error(self, mock_get_engine):
+        mock_get_engine.return_value.begin.side_effect = OperationalError('SELECT 1', {}, 'connection refused')
+
+        with app.app_context():
+            with self.assertRaises(ApplicationError) as context:
+                postgres.get_current_timestamp()
+            # Failures aren't cached, the next check tries again
+            with self.assertRaises(ApplicationError):
+                postgres.get_current_timestamp()
+
+        self.assertIn('connection refused', context.exception.message)
+        self.assertEqual(mock_get_engine.return_value.begin.call_count, 2)
+
+
+@patch('verification_api.dependencies.postgres.create_engine')
+class TestPostgresEngine(unittest.TestCase):
+
+    def setUp(self):
+        postgres._engine = None
+
+    def tearDown(self):
+        postgres._engine = None
+
+    def test_engine_bounded_by_health_timeout(self, mock_create_engine):
+        with app.app_context(), patch.dict(app.config, {'HEALTH_DB_TIMEOUT': 2500}):
+            postgres._get_engine()
+            postgres._get_engine()
+
+        mock_create_engine.assert_called_once()
+        options = mock_create_engine.call_args[1]
+        self.assertEqual((options['pool_size'], options['max_overflow'], options['pool_timeout']), (1, 0, 2.5))
+        self.assertEqual(options['connect_args']['connect_timeout'], 3)
+        self.assertEqual(options['connect_args']['application_name'], app.config['APP_NAME'])
@@ -1,8 +1,10 @@
 import os
 import json
 import unittest
+from datetime import datetime, timedelta, timezone
 from unittest.mock import patch, MagicMock
 from sqlalchemy.exc import ProgrammingError
+from sqlalchemy.orm.exc import StaleDataError
 from common_utilities import errors
 
 from verification_api.main import app
@@ -45,7 +47,7 @@ class TestService(unittest.TestCase):
         self.assertEqual(context.exception.message, errors.get_message(*error, filler='TEST ERR'))
         self.assertEqual(context.exception.code, errors.get_code(*error))
 
-    def test_get_pending_sql_error(self, mock_case, *_):
+    def test_get_pending_sql_error(self, mock_case, mock_db):
         with self.assertRaises(ApplicationError) as context:
             mock_case.get_pending.side_effect = self.error
             service.get_pending()
@@ -53,6 +55,91 @@ class TestService(unittest.TestCase):
         self.assertEqual(context.exception.message, errors.get_message("verification_api", "SQLALCHEMY_ERROR",
                                                                        filler=self.error))
         self.assertEqual(errors.get_code("verification_api", "SQLALCHEMY_ERROR"), context.exception.code)
+        mock_db.session.rollback.assert_called_once()
+
+    def test_get_pending_keeps_session(self, mock_case, mock_db):
+        service.get_pending()
+
+        # The session is left for the rest of the request rather than closed
+        mock_db.session.close.assert_not_called()
+        mock_db.session.rollback.assert_not_called()
+
+    @patch("verification_api.services.verification_service._extract_rows")
+    def test_get_pending_page(self, mock_extract, mock_case, *_):
+        date_added = datetime(2020, 2, 1, 9, 30, 15, 123456, tzinfo=timezone.utc)
+        cases = [_generate_test_profile(verification_id=3, date_added=date_added),
+                 _generate_test_profile(verification_id=2, date_added=date_added),
+                 _generate_test_profile(verification_id=1, date_added=date_added)]
+        mock_case.get_pending_page.return_value = cases
+        mock_extract.return_value = [{'foo': 'bar'}, {'foo': 'bar'}]
+
+        with app.app_context():
+            result = service.get_pending_page(2)
+
+        mock_case.get_pending_page.assert_called_once_with(3, None)
+        mock_extract.assert_called_once_with(cases[:2])
+        self.assertEqual(result['cases'], [{'foo': 'bar'}, {'foo': 'bar'}])
+        self.assertEqual(service._decode_worklist_cursor(result['next_cursor']), (date_added, 2))
+
+    @patch("verification_api.services.verification_service._extract_rows")
+    def test_get_pending_page_last_page(self, mock_extract, mock_case, *_):
+        mock_case.get_pending_page.return_value = [_generate_test_profile()]
+        mock_extract.return_value = [{'foo': 'bar'}]
+
+        with app.app_context():
+            result = service.get_pending_page(2, service._encode_worklist_cursor(_generate_test_profile(
+                verification_id=5, date_added=datetime(2020, 2, 1, tzinfo=timezone.utc))))
+
+        mock_case.get_pending_page.assert_called_once_with(3, (datetime(2020, 2, 1, tzinfo=timezone.utc), 5))
+        self.assertEqual(result, {'cases': [{'foo': 'bar'}], 'next_cursor': None})
+
+    def test_get_pending_page_capped(self, mock_case, *_):
+        mock_case.get_pending_page.return_value = []
+
+        with app.app_context():
+            service.get_pending_page(app.config['MAX_PAGE_SIZE'] + 100)
+
+        mock_case.get_pending_page.assert_called_once_with(app.config['MAX_PAGE_SIZE'] + 1, None)
+
+    def test_get_pending_page_invalid_cursor(self, mock_case, *_):
+        with app.app_context():
+            with self.assertRaises(ApplicationError) as context:
+                service.get_pending_page(10, 'not-a-cursor')
+
+        self.assertEqual(context.exception.http_code, 400)
+        mock_case.get_pending_page.assert_not_called()
+
+    def test_get_pending_page_invalid_limit(self, mock_case, *_):
+        with app.app_context():
+            with self.assertRaises(ApplicationError) as context:
+                service.get_pending_page(0)
+
+        self.assertEqual(context.exception.http_code, 400)
+        mock_case.get_pending_page.assert_not_called()
+
+    def test_get_pending_page_limit_from_query_string(self, mock_case, *_):
+        mock_case.get_pending_page.return_value = []
+
+        with app.app_context():
+            service.get_pending_page('5')
+            for limit in ('abc', '0', '-1', ''):
+                with self.assertRaises(ApplicationError) as context:
+                    service.get_pending_page(limit)
+                self.assertEqual(context.exception.http_code, 400)
+
+        mock_case.get_pending_page.assert_called_once_with(6, None)
+
+    def test_stream_pending(self, mock_case, mock_db):
+        first, second = MagicMock(), MagicMock()
+        first.as_dict.return_value = {'case_id': 1}
+        second.as_dict.return_value = {'case_id': 2}
+        mock_case.stream_pending.return_value = [first, second]
+
+        with app.app_context():
+            result = ''.join(service.stream_pending())
+
+        self.assertEqual(json.loads(result), [{'case_id': 1}, {'case_id': 2}])
+        mock_db.session.close.assert_called_once()
 
     @patch("verification_api.services.verification_service.Note.get_notepad_by_case_id")
     @patch("verification_api.services.verification_service._extract_rows")
@@ -87,16 +174,56 @@ class TestService(unittest.TestCase):
                                                                        filler=self.error))
         self.assertEqual(errors.get_code("verification_api", "SQLALCHEMY_ERROR"), context.exception.code)
 
+    @patch("verification_api.services.verification_service.UlapdAPI")
     @patch("verification_api.services.verification_service.AccountAPI")
-    @patch("verification_api.services.verification_service.Case.get_case_by_id")
-    @patch("verification_api.services.verification_service._can_perform_action")
-    def test_dps_action_approve(self, mock_lock, mock_case, *_):
-        mock_lock.return_value = True
-        mock_case.return_value = _generate_test_profile()
+    @patch("verification_api.services.verification_service.Note.get_notepad_by_case_id")
+    @patch("verification_api.services.verification_service._extract_rows")
+    def test_get_case_details(self, mock_extract, mock_note, mock_account_api, mock_ulapd, mock_case, *_):
+        mocked_case = MagicMock(ldap_id='ldap-1', user_id='user-1')
+        mocked_case.as_dict.return_value = {'foo': 'bar'}
+        mock_case.get_case_by_id.return_value = mocked_case
+        mock_extract.return_value = [{'my_note': 'A note'}]
+        mock_account_api.return_value.get.return_value = {'groups': 'cn=nps,ou=groups,dc=HMLR,dc=zone'}
+        mock_ulapd.return_value.get_dataset_activity.return_value = self.dataset_activity
+        mock_ulapd.return_value.get_user_dataset_access.return_value = [{'name': 'nps'}]
+
+        with app.test_request_context():
+            result = service.get_case_details('1')
+
+        mock_case.get_case_by_id.assert_called_once_with('1')
+        mock_account_api.return_value.get.assert_called_once_with('ldap-1')
+        mock_ulapd.return_value.get_dataset_activity.assert_called_once_with('user-1')
+        mock_ulapd.return_value.get_user_dataset_access.assert_called_once_with('user-1')
+        self.assertEqual(result, {
+            'foo': 'bar',
+            'notes': [{'my_note': 'A note'}],
+            'groups': ['nps'],
+            'dataset_activity': self.dataset_activity,
+            'dataset_access': [{'name': 'nps'}]
+        })
+
+    def test_get_case_details_no_row(self, mock_case, *_):
+        mock_case.get_case_by_id.return_value = None
+        with self.assertRaises(ApplicationError) as context:
+            service.get_case_details('1')
+
+        self.assertEqual(context.exception.code, errors.get_code('verification_api', 'CASE_NOT_FOUND'))
+        self.assertEqual(context.exception.http_code, 404)
+
+    @patch("verification_api.services.verification_service.AccountAPI")
+    @patch("verification_api.services.verification_service.add_metric_event_to_outbox")
+    def test_dps_action_approve(self, mock_outbox, mock_account, mock_case, mock_db):
+        mock_case.transition.return_value = _generate_test_profile(status='Approved')
         data = {'staff_id': 'LRTM101'}
 
         result = service.dps_action('Approve', '1', data)
 
+        mock_case.transition.assert_called_once_with('1', 'LRTM101', 'Approved')
+        mock_account.return_value.approve.assert_called_once_with(mock_case.transition.return_value.ldap_id)
+        mock_outbox.assert_called_once_with('dst action approved', mock_case.transition.return_value.as_dict())
+        mock_case.get_case_by_id.assert_not_called()
+        mock_db.session.commit.assert_called_once()
+
         expected_result = {
             'case_id': '1',
             'staff_id': 'LRTM101',
@@ -105,11 +232,9 @@ class TestService(unittest.TestCase):
         self.assertEqual(result, expected_result)
 
     @patch("verification_api.services.verification_service.AccountAPI")
-    @patch("verification_api.services.verification_service.Case.get_case_by_id")
-    @patch("verification_api.services.verification_service._can_perform_action")
-    def test_dps_action_approve_locked(self, mock_lock, mock_case, *_):
-        mock_lock.return_value = False
-        mock_case.return_value = _generate_test_profile()
+    def test_dps_action_approve_locked(self, mock_account, mock_case, *_):
+        mock_case.transition.return_value = None
+        mock_case.get_case_by_id.return_value = _generate_test_profile(staff_id='LRTM102')
         data = {'staff_id': 'LRTM101'}
         with self.assertRaises(ApplicationError) as context:
             service.dps_action('Approve', '1', data)
@@ -121,17 +246,38 @@ class TestService(unittest.TestCase):
 
         self.assertEqual(context.exception.message, expected_err_message)
         self.assertEqual(context.exception.code, expected_err_code)
+        self.assertEqual(context.exception.http_code, 403)
+        mock_account.assert_not_called()
 
     @patch("verification_api.services.verification_service.AccountAPI")
-    @patch("verification_api.services.verification_service.Case.get_case_by_id")
-    @patch("verification_api.services.verification_service._can_perform_action")
-    def test_dps_action_decline(self, mock_lock, mock_case, *_):
-        mock_lock.return_value = True
-        mock_case.return_value = _generate_test_profile()
+    def test_dps_action_approve_already_resolved(self, mock_account, mock_case, *_):
+        mock_case.transition.return_value = None
+        mock_case.get_case_by_id.return_value = _generate_test_profile(status='Approved')
+        with self.assertRaises(ApplicationError) as context:
+            service.dps_action('Approve', '1', {'staff_id': 'LRTM101'})
+
+        expected_err = ('verification_api', 'VERIFICATION_ERROR')
+        expected_err_message = errors.get_message(*expected_err, filler='Case has already been approved')
+
+        self.assertEqual(context.exception.message, expected_err_message)
+        self.assertEqual(context.exception.http_code, 409)
+        mock_account.assert_not_called()
+
+    @patch("verification_api.services.verification_service.AccountAPI")
+    @patch("verification_api.services.verification_service._add_note")
+    def test_dps_action_decline(self, mock_add_note, mock_account, mock_case, mock_db):
+        mock_case.transition.return_value = _generate_test_profile(status='Declined')
         data = {'staff_id': 'LRTM101', 'reason': 'Company Failed', 'advice': 'Reapply'}
 
         result = service.dps_action('Decline', '1', data)
 
+        mock_case.transition.assert_called_once_with('1', 'LRTM101', 'Declined')
+        mock_account.return_value.decline.assert_called_once_with(mock_case.transition.return_value.ldap_id,
+                                                                  'company Failed', 'Reapply', 123)
+        expected_note = 'Declined: Reason - Company Failed; Next Steps - Reapply'
+        mock_add_note.assert_called_once_with('1', 'LRTM101', expected_note)
+        mock_db.session.commit.assert_called_once()
+
         expected_result = {
             'case_id': '1',
             'staff_id': 'LRTM101',
@@ -142,11 +288,7 @@ class TestService(unittest.TestCase):
         self.assertDictEqual(result, expected_result)
 
     @patch("verification_api.services.verification_service.AccountAPI")
-    @patch("verification_api.services.verification_service.Case.get_case_by_id")
-    @patch("verification_api.services.verification_service._can_perform_action")
-    def test_dps_action_invalid_action(self, mock_lock, mock_case, *_):
-        mock_lock.return_value = True
-        mock_case.return_value = _generate_test_profile()
+    def test_dps_action_invalid_action(self, mock_account, mock_case, *_):
         data = {'staff_id': 'LRTM101', 'reason': 'Company Failed'}
 
         with self.assertRaises(ApplicationError) as context:
@@ -158,16 +300,13 @@ class TestService(unittest.TestCase):
 
         self.assertEqual(context.exception.message, expected_err_message)
         self.assertEqual(context.exception.code, expected_err_code)
+        mock_case.transition.assert_not_called()
 
     @patch("verification_api.services.verification_service._add_note")
     @patch("verification_api.services.verification_service.AccountAPI")
-    @patch("verification_api.services.verification_service.Case.get_case_by_id")
-    @patch("verification_api.services.verification_service._status_update")
-    @patch("verification_api.services.verification_service._can_perform_action")
-    def test_dps_action_decline_locked(self, mock_lock, mock_status, mock_case, *_):
-        mock_status.return_value = True
-        mock_lock.return_value = False
-        mock_case.return_value = _generate_test_profile()
+    def test_dps_action_decline_locked(self, mock_account, mock_add_note, mock_case, *_):
+        mock_case.transition.return_value = None
+        mock_case.get_case_by_id.return_value = _generate_test_profile(staff_id='LRTM102')
         data = {'staff_id': 'LRTM101', 'reason': 'Company Failed', 'advice': 'Reapply'}
 
         with self.assertRaises(ApplicationError) as context:
@@ -180,9 +319,12 @@ class TestService(unittest.TestCase):
 
         self.assertEqual(context.exception.message, expected_err_message)
         self.assertEqual(context.exception.code, expected_err_code)
+        mock_account.assert_not_called()
+        mock_add_note.assert_not_called()
 
     @patch("verification_api.services.verification_service.AccountAPI")
-    def test_close(self, __, mock_case, *_):
+    @patch("verification_api.services.verification_service.add_metric_event_to_outbox")
+    def test_close(self, mock_outbox, __, mock_case, *_):
         mock_case.get_case_by_id.return_value = _generate_test_profile(status='Approved')
         data = {
             'staff_id': 'AA111ZZ',
@@ -192,6 +334,8 @@ class TestService(unittest.TestCase):
 
         result = service.close_account('1', data)
 
+        mock_outbox.assert_called_once_with('account closed', mock_case.get_case_by_id.return_value.as_dict())
+
         expected_result = {
             'staff_id': 'AA111ZZ',
             'close_detail': 'Test closure reason',
@@ -201,6 +345,22 @@ class TestService(unittest.TestCase):
         }
         self.assertDictEqual(result, expected_result)
 
+    @patch("verification_api.services.verification_service.AccountAPI")
+    @patch("verification_api.services.verification_service.add_metric_event_to_outbox")
+    def test_close_stale(self, mock_outbox, mock_account, mock_case, mock_db):
+        mock_case.get_case_by_id.return_value = _generate_test_profile(status='Approved')
+        mock_db.session.commit.side_effect = StaleDataError('version mismatch')
+        data = {'staff_id': 'AA111ZZ', 'close_detail': 'Test closure reason', 'requester': 'hmlr'}
+
+        with self.assertRaises(ApplicationError) as context:
+            service.close_account('1', data)
+
+        expected_err = ('verification_api', 'VERIFICATION_ERROR')
+        expected_err_message = errors.get_message(*expected_err,
+                                                  filler='Case was changed by another request, please try again')
+        self.assertEqual(context.exception.message, expected_err_message)
+        self.assertEqual(context.exception.http_code, 409)
+
     def test_close_account_case_not_found(self, mock_case, *_):
         mock_case.get_case_by_id.return_value = None
         with self.assertRaises(ApplicationError) as context:
@@ -258,6 +418,7 @@ class TestService(unittest.TestCase):
         mock_insert_note.assert_called_once_with(233, close_data)
 
     def test_dps_action_no_row(self, mock_case, *_):
+        mock_case.transition.return_value = None
         mock_case.get_case_by_id.return_value = None
 
         with self.assertRaises(ApplicationError) as context:
@@ -274,7 +435,7 @@ class TestService(unittest.TestCase):
     def test_dps_action_error(self, mock_account, mock_case, *_):
         error = ('verification_api', 'VERIFICATION_ERROR')
         mock_account.side_effect = ApplicationError(*errors.get(*error, filler='TEST ERROR'))
-        mock_case.get_case_by_id.return_value = _generate_test_profile()
+        mock_case.transition.return_value = _generate_test_profile()
 
         with self.assertRaises(ApplicationError) as context:
             service.dps_action('Approve', '1', {'staff_id': 'LRTM101'})
@@ -285,7 +446,7 @@ class TestService(unittest.TestCase):
 
     def test_dps_action_sql_error(self, mock_case, *_):
         with self.assertRaises(ApplicationError) as context:
-            mock_case.get_case_by_id.side_effect = self.error
+            mock_case.transition.side_effect = self.error
             service.dps_action('Approve', '1', {'staff_id': 'LRTM101'})
 
         self.assertEqual(context.exception.message, errors.get_message("verification_api", "SQLALCHEMY_ERROR",
@@ -315,6 +476,197 @@ class TestService(unittest.TestCase):
                                                                        filler=self.error))
         self.assertEqual(errors.get_code("verification_api", "SQLALCHEMY_ERROR"), context.exception.code)
 
+    @patch("verification_api.services.verification_service.add_metric_events_to_outbox")
+    def test_insert_cases(self, mock_outbox, mock_case, mock_db):
+        cases = [{'user_id': str(i), 'ldap_id': str(i), 'registration_data': {'first_name': 'Ted'},
+                  'status': 'Pending'} for i in range(3)]
+        mock_case.insert_many.side_effect = [[7, 8], [9]]
+
+        with app.app_context(), patch.dict(app.config, {'BULK_INSERT_BATCH_SIZE': 2}):
+            result = service.insert_cases(iter(cases))
+
+        self.assertEqual(result, [7, 8, 9])
+        self.assertEqual(mock_case.insert_many.call_args_list, [((cases[:2],),), ((cases[2:],),)])
+        self.assertEqual(mock_outbox.call_count, 2)
+        activity, data = mock_outbox.call_args[0]
+        self.assertEqual(activity, 'application received')
+        self.assertEqual(data[0]['registration_data']['first_name'], 'Ted')
+        self.assertIn('date_added', data[0]['registration_data'])
+        self.assertNotIn('date_added', cases[2]['registration_data'])
+        mock_db.session.commit.assert_called_once()
+
+    @patch("verification_api.services.verification_service.add_metric_events_to_outbox")
+    def test_insert_cases_missing_fields(self, mock_outbox, mock_case, mock_db):
+        cases = [{'user_id': '1', 'ldap_id': '1', 'registration_data': {}, 'status': 'Pending'}, {'user_id': '2'}]
+
+        with app.app_context():
+            with self.assertRaises(ApplicationError) as context:
+                service.insert_cases(cases)
+
+        expected_err = ('verification_api', 'VERIFICATION_ERROR')
+        expected_err_message = errors.get_message(*expected_err,
+                                                  filler='Case 1 is missing ldap_id, registration_data, status')
+        self.assertEqual(context.exception.message, expected_err_message)
+        self.assertEqual(context.exception.http_code, 400)
+        mock_case.insert_many.assert_not_called()
+        mock_db.session.commit.assert_not_called()
+        mock_db.session.rollback.assert_called_once()
+
+    @patch("verification_api.services.verification_service.add_metric_events_to_outbox")
+    def test_insert_cases_invalid_fields(self, mock_outbox, mock_case, mock_db):
+        valid = {'user_id': '1', 'ldap_id': '1', 'registration_data': {}, 'status': 'Pending'}
+        for invalid, fields in (({'registration_data': ['first_name']}, 'registration_data'),
+                                ({'registration_data': None}, 'registration_data'),
+                                ({'user_id': 2, 'ldap_id': None, 'status': True}, 'user_id, ldap_id, status')):
+            with app.app_context():
+                with self.assertRaises(ApplicationError) as context:
+                    service.insert_cases([valid, dict(valid, **invalid)])
+
+            expected_err_message = errors.get_message('verification_api', 'VERIFICATION_ERROR',
+                                                      filler='Case 1 has invalid {}'.format(fields))
+            self.assertEqual(context.exception.message, expected_err_message)
+            self.assertEqual(context.exception.http_code, 400)
+
+        mock_case.insert_many.assert_not_called()
+        mock_outbox.assert_not_called()
+        mock_db.session.commit.assert_not_called()
+
+    @patch("verification_api.services.verification_service.AccountAPI")
+    @patch("verification_api.services.verification_service.add_metric_events_to_outbox")
+    def test_bulk_dps_action_approve(self, mock_outbox, mock_account, mock_case, mock_db):
+        mock_case.lock_many.side_effect = [[_generate_bulk_case(1), _generate_bulk_case(2)], [_generate_bulk_case(3)]]
+        mock_case.update_many.side_effect = lambda ids, _: [_generate_bulk_case(case_id) for case_id in ids]
+        mock_case.query.filter.return_value = [_generate_bulk_case(4, status='Approved')]
+        account_error = ApplicationError('Account API failed', 'E711', http_code=500)
+        mock_account.return_value.approve.side_effect = \
+            lambda ldap_id: _raise(account_error) if ldap_id == 'ldap-2' else None
+
+        with app.app_context(), patch.dict(app.config, {'BULK_ACTION_BATCH_SIZE': 2}):
+            result = service.bulk_dps_action('Approve', [1, 2, 3, 4, 1], {'staff_id': 'LRTM101'})
+
+        self.assertEqual(result, [
+            {'case_id': 1, 'status_updated': True},
+            {'case_id': 2, 'status_updated': False, 'error': 'Account API failed'},
+            {'case_id': 3, 'status_updated': True},
+            {'case_id': 4, 'status_updated': False, 'error': 'Case has already been approved'}
+        ])
+        self.assertEqual(mock_case.lock_many.call_args_list,
+                         [(([1, 2], 'Pending', 'LRTM101'),), (([3, 4], 'Pending', 'LRTM101'),)])
+        self.assertEqual([call[0][0] for call in mock_case.update_many.call_args_list], [[1], [3]])
+        self.assertEqual(mock_case.update_many.call_args[0][1]['status'], 'Approved')
+        approved = {'case_id': 3, 'ldap_id': 'ldap-3', 'user_id': 'user-3'}
+        self.assertEqual(mock_outbox.call_args[0], ('dst action approved', [approved]))
+        self.assertEqual(mock_db.session.commit.call_count, 2)
+
+    @patch("verification_api.services.verification_service.Note")
+    @patch("verification_api.services.verification_service.AccountAPI")
+    def test_bulk_dps_action_decline(self, mock_account, mock_note, mock_case, mock_db):
+        mock_case.lock_many.return_value = [_generate_bulk_case(1)]
+        mock_case.query.filter.return_value = [_generate_bulk_case(2, staff_id='LRTM102')]
+        data = {'staff_id': 'LRTM101', 'reason': 'Company Failed', 'advice': 'Reapply'}
+
+        with app.app_context():
+            result = service.bulk_dps_action('Decline', [1, 2, 3], data)
+
+        self.assertEqual(result, [
+            {'case_id': 1, 'status_updated': True},
+            {'case_id': 2, 'status_updated': False,
+             'error': 'Could not perform action on case as it is locked to another user'},
+            {'case_id': 3, 'status_updated': False, 'error': 'Case 3 not found'}
+        ])
+        mock_account.return_value.decline.assert_called_once_with('ldap-1', 'company Failed', 'Reapply', 'user-1')
+        self.assertEqual(mock_case.update_many.call_args[0][0], [1])
+        self.assertEqual(mock_case.update_many.call_args[0][1]['status'], 'Declined')
+        mock_note.add_many.assert_called_once_with([1], 'LRTM101',
+                                                   'Declined: Reason - Company Failed; Next Steps - Reapply')
+        mock_db.session.commit.assert_called_once()
+
+    @patch("verification_api.services.verification_service.AccountAPI")
+    def test_bulk_dps_action_invalid_action(self, mock_account, mock_case, *_):
+        with self.assertRaises(ApplicationError) as context:
+            service.bulk_dps_action('Obliviate', [1], {'staff_id': 'LRTM101'})
+
+        self.assertEqual(context.exception.http_code, 500)
+        mock_case.lock_many.assert_not_called()
+
+    @patch("verification_api.services.verification_service.Close")
+    @patch("verification_api.services.verification_service.Note")
+    @patch("verification_api.services.verification_service.AccountAPI")
+    @patch("verification_api.services.verification_service.add_metric_events_to_outbox")
+    def test_bulk_close_accounts(self, mock_outbox, mock_account, mock_note, mock_close, mock_case, mock_db):
+        mock_case.lock_many.return_value = [_generate_bulk_case(1, status='Approved')]
+        mock_case.query.filter.return_value = [_generate_bulk_case(2)]
+        data = {'staff_id': 'AA111ZZ', 'close_detail': 'Test closure reason', 'requester': 'hmlr'}
+
+        with app.app_context():
+            result = service.bulk_close_accounts([1, 2], data)
+
+        self.assertEqual(result, [
+            {'case_id': 1, 'status_updated': True},
+            {'case_id': 2, 'status_updated': False, 'error': 'Account closure only permitted on active user accounts'}
+        ])
+        mock_case.lock_many.assert_called_once_with([1, 2], 'Approved')
+        mock_account.return_value.close.assert_called_once_with('ldap-1', 'user-1', 'hmlr')
+        mock_case.update_many.assert_called_once_with([1], {'status': 'Closed'})
+        mock_close.add_many.assert_called_once_with([1], data)
+        mock_note.add_many.assert_called_once_with(
+            [1], 'AA111ZZ', 'Account closure requested by: hmlr, for reason: Test closure reason')
+        mock_outbox.assert_called_once()
+        mock_db.session.commit.assert_called_once()
+
+    @patch("verification_api.services.verification_service.IdempotencyKey")
+    def test_claim_idempotency_key(self, mock_key, mock_case, mock_db):
+        mock_key.claim.return_value = True
+
+        with app.app_context():
+            result = service.claim_idempotency_key('abc123', 'hash')
+
+        # On a connection of its own, not the request's session
+        connection = mock_db.engine.begin.return_value.__enter__.return_value
+        self.assertIsNone(result)
+        mock_key.claim.assert_called_once_with(connection, 'abc123', 'hash',
+                                               timedelta(seconds=app.config['IDEMPOTENCY_KEY_TTL']),
+                                               timedelta(seconds=app.config['IDEMPOTENCY_KEY_IN_PROGRESS_TIMEOUT']))
+        mock_db.session.commit.assert_not_called()
+
+    @patch("verification_api.services.verification_service.IdempotencyKey")
+    def test_claim_idempotency_key_replay(self, mock_key, *_):
+        mock_key.claim.return_value = False
+        mock_key.get_key.return_value = MagicMock(request_hash='hash', response_code=200,
+                                                  response_body={'status_updated': True},
+                                                  response_headers={'ETag': '"2"'})
+
+        with app.app_context():
+            result = service.claim_idempotency_key('abc123', 'hash')
+
+        self.assertEqual(result, (200, {'status_updated': True}, {'ETag': '"2"'}))
+
+    @patch("verification_api.services.verification_service.IdempotencyKey")
+    def test_claim_idempotency_key_in_progress(self, mock_key, *_):
+        mock_key.claim.return_value = False
+        mock_key.get_key.return_value = MagicMock(request_hash='hash', response_code=None)
+
+        with app.app_context():
+            with self.assertRaises(ApplicationError) as context:
+                service.claim_idempotency_key('abc123', 'hash')
+
+        self.assertEqual(context.exception.http_code, 409)
+
+    @patch("verification_api.services.verification_service.IdempotencyKey")
+    def test_claim_idempotency_key_different_request(self, mock_key, *_):
+        mock_key.claim.return_value = False
+        mock_key.get_key.return_value = MagicMock(request_hash='other', response_code=200)
+
+        with app.app_context():
+            with self.assertRaises(ApplicationError) as context:
+                service.claim_idempotency_key('abc123', 'hash')
+
+        expected_err_message = errors.get_message(
+            'verification_api', 'VERIFICATION_ERROR',
+            filler='Idempotency-Key abc123 has already been used for a different request')
+        self.assertEqual(context.exception.message, expected_err_message)
+        self.assertEqual(context.exception.http_code, 422)
+
     def test_add_note_case_not_found(self, mock_case, *_):
         mock_case.get_case_by_id.return_value = None
 
@@ -378,16 +730,20 @@ class TestService(unittest.TestCase):
         self.assertEqual(context.exception.message, errors.get_message(*expected_err, filler=self.error))
         self.assertEqual(context.exception.code, errors.get_code(*expected_err))
 
+    @patch("verification_api.services.verification_service.decline_reason_catalogue._start")
     @patch("verification_api.services.verification_service.DeclineReason.get_all_decline_reasons")
     @patch("verification_api.services.verification_service._extract_rows")
     def test_decline_reasons(self, mock_extract, *_):
         mock_extract.return_value = self.decline_data
-        result = service.get_decline_reasons()
+        body, etag = service.get_decline_reasons()
+        result = json.loads(body)
+        assert etag
         assert 'decline_reason' in result[0]
         assert 'decline_text' in result[0]
         assert 'decline_advice' in result[0]
         assert 'decline_id' not in result[0]
 
+    @patch("verification_api.services.verification_service.decline_reason_catalogue._start")
     @patch("verification_api.services.verification_service.DeclineReason.get_all_decline_reasons")
     @patch("verification_api.services.verification_service._extract_rows")
     def test_decline_reasons_error(self, mock_extract, *_):
@@ -400,6 +756,7 @@ class TestService(unittest.TestCase):
         self.assertEqual(context.exception.message, errors.get_message(*error, filler='TEST ERR'))
         self.assertEqual(context.exception.code, errors.get_code(*error))
 
+    @patch("verification_api.services.verification_service.decline_reason_catalogue._start")
     @patch("verification_api.services.verification_service._extract_rows")
     @patch("verification_api.services.verification_service.DeclineReason.get_all_decline_reasons")
     def test_decline_reasons_sql_error(self, mock_decline, mock_extract, *_):
@@ -413,17 +770,67 @@ class TestService(unittest.TestCase):
         self.assertEqual(errors.get_code("verification_api", "SQLALCHEMY_ERROR"), context.exception.code)
 
     def test_manage_case_lock(self, mock_case, mock_db):
-        test_staff_id = 'LRTM101'
-        mocked_case = MagicMock()
-        mocked_case.status = 'In Progress'
-        mock_case.get_case_by_id.return_value = mocked_case
+        mock_case.lock.return_value = datetime(2026, 1, 1, 12, 15, tzinfo=timezone.utc)
 
-        service.manage_case_lock('1', test_staff_id)
+        with app.app_context():
+            result = service.manage_case_lock('1', 'LRTM101')
 
+        mock_case.lock.assert_called_once_with('1', 'LRTM101', timedelta(seconds=app.config['CASE_LOCK_LEASE']))
         mock_db.session.commit.assert_called_once()
-        self.assertEqual(test_staff_id, mocked_case.staff_id)
+        self.assertEqual(result, {'case_id': '1', 'staff_id': 'LRTM101', 'locked_until': '2026-01-01 12:15:00+00:00'})
+
+    def test_manage_case_lock_held_by_another_user(self, mock_case, mock_db):
+        mock_case.lock.return_value = None
+        mock_case.get_case_by_id.return_value = _generate_test_profile(staff_id='LRTM102')
+        mock_case.get_case_by_id.return_value.locked_until = '2026-01-01 12:15:00+00:00'
+
+        with app.app_context():
+            with self.assertRaises(ApplicationError) as context:
+                service.manage_case_lock('1', 'LRTM101')
+
+        expected_err = ('verification_api', 'LOCKING_ERROR')
+        expected_err_msg = 'Case is locked to another user until 2026-01-01 12:15:00+00:00'
+        expected_err_message = errors.get_message(*expected_err, filler=expected_err_msg)
+        self.assertEqual(context.exception.message, expected_err_message)
+        self.assertEqual(context.exception.http_code, 403)
+        mock_db.session.commit.assert_not_called()
+
+    def test_manage_case_unlock(self, mock_case, mock_db):
+        mock_case.unlock.return_value = 1
+
+        result = service.manage_case_lock('1')
+
+        mock_case.unlock.assert_called_once_with('1')
+        mock_case.lock.assert_not_called()
+        mock_db.session.commit.assert_called_once()
+        self.assertEqual(result, {'case_id': '1', 'staff_id': None, 'locked_until': None})
+
+    @patch("verification_api.services.verification_service.Note.get_notepad_by_case_id")
+    @patch("verification_api.services.verification_service._extract_rows")
+    def test_claim_next_case(self, mock_extract, mock_note, mock_case, mock_db):
+        mock_case.claim_next.return_value.as_dict.return_value = {'case_id': 233, 'staff_id': 'LRTM101'}
+        mock_case.claim_next.return_value.verification_id = 233
+        mock_extract.return_value = [{'my_note': 'A note'}]
+
+        with app.app_context():
+            result = service.claim_next_case('LRTM101')
+
+        mock_case.claim_next.assert_called_once_with('LRTM101', timedelta(seconds=app.config['CASE_LOCK_LEASE']))
+        mock_note.assert_called_once_with(233)
+        mock_db.session.commit.assert_called_once()
+        self.assertEqual(result, {'case_id': 233, 'staff_id': 'LRTM101', 'notes': [{'my_note': 'A note'}]})
+
+    def test_claim_next_case_none_left(self, mock_case, mock_db):
+        mock_case.claim_next.return_value = None
+
+        with app.app_context():
+            result = service.claim_next_case('LRTM101')
+
+        self.assertIsNone(result)
+        mock_db.session.commit.assert_not_called()
 
     def test_manage_case_lock_case_not_found(self, mock_case, *_):
+        mock_case.unlock.return_value = None
         mock_case.get_case_by_id.return_value = None
         test_case_id = '1'
         with self.assertRaises(ApplicationError) as context:
@@ -437,6 +844,7 @@ class TestService(unittest.TestCase):
         self.assertEqual(context.exception.code, expected_err_code)
 
     def test_manage_case_lock_invalid_status(self, mock_case, *_):
+        mock_case.unlock.return_value = None
         mocked_case = MagicMock()
         mocked_case.status = 'Approved'
         mock_case.get_case_by_id.return_value = mocked_case
@@ -453,7 +861,7 @@ class TestService(unittest.TestCase):
         self.assertEqual(context.exception.code, expected_err_code)
 
     def test_manage_case_lock_sql_error(self, mock_case, *_):
-        mock_case.get_case_by_id.side_effect = self.error
+        mock_case.unlock.side_effect = self.error
 
         with self.assertRaises(ApplicationError) as context:
             service.manage_case_lock('1')
@@ -465,20 +873,28 @@ class TestService(unittest.TestCase):
         self.assertEqual(context.exception.message, expected_err_message)
         self.assertEqual(context.exception.code, expected_err_code)
 
+    @patch("verification_api.services.verification_service.estimate_rows")
     @patch("verification_api.services.verification_service._extract_rows")
-    def test_perform_search(self, mock_extract_rows, mock_case, *_):
+    def test_perform_search(self, mock_extract_rows, mock_estimate, mock_case, *_):
         search_result = [{'foo': 'bar'}, {'foo': 'bar'}]
-        mock_case.search.return_value = _generate_test_profile()
+        query = mock_case.search.return_value
+        query.offset.return_value.limit.return_value.all.return_value = [MagicMock(), MagicMock()]
         mock_extract_rows.return_value = search_result
+        mock_estimate.return_value = 2
         search_params = {
             "first_name": "Andreea",
             "last_name": "",
             "organisation_name": "",
             "email": "",
         }
-        result = service.perform_search(search_params)
-        self.assertEqual(result, search_result)
+        with app.app_context(), patch.dict(app.config, {'MAX_PAGE_SIZE': 50}):
+            result = service.perform_search(search_params)
+
+        # Without a limit it's still only one page, of the largest size
+        self.assertEqual(result, {'results': search_result, 'next_cursor': None, 'total_estimate': 2})
         mock_case.search.assert_called_once()
+        query.offset.assert_called_once_with(0)
+        query.offset.return_value.limit.assert_called_once_with(51)
         mock_extract_rows.assert_called_once()
 
     @patch("verification_api.services.verification_service._extract_rows")
@@ -492,7 +908,7 @@ class TestService(unittest.TestCase):
         test_error = ('verification_api', 'VERIFICATION_ERROR')
         mock_extract_rows.side_effect = ApplicationError(*errors.get(*test_error, filler='TEST ERROR'))
 
-        with self.assertRaises(ApplicationError) as context:
+        with app.app_context(), self.assertRaises(ApplicationError) as context:
             service.perform_search(search_params)
 
         expected_error_msg = errors.get_message(*test_error, filler='TEST ERROR')
@@ -514,7 +930,7 @@ class TestService(unittest.TestCase):
         mock_extract_rows.return_value = search_result
         mock_case.search.side_effect = self.error
 
-        with self.assertRaises(ApplicationError) as context:
+        with app.app_context(), self.assertRaises(ApplicationError) as context:
             service.perform_search(search_params)
 
         expected_err = ('verification_api', 'SQLALCHEMY_ERROR')
@@ -526,6 +942,52 @@ class TestService(unittest.TestCase):
         mock_case.search.assert_called_once()
         mock_extract_rows.assert_not_called()
 
+    @patch("verification_api.services.verification_service.estimate_rows")
+    @patch("verification_api.services.verification_service._extract_rows")
+    def test_perform_search_paged(self, mock_extract_rows, mock_estimate, mock_case, *_):
+        query = mock_case.search.return_value
+        query.offset.return_value.limit.return_value.all.return_value = [MagicMock(), MagicMock(), MagicMock()]
+        mock_extract_rows.return_value = [{'foo': 'bar'}, {'foo': 'bar'}]
+        mock_estimate.return_value = 40
+
+        with app.app_context():
+            result = service.perform_search({'last_name': 'Smith', 'limit': 2, 'cursor': service._encode_cursor(4)})
+
+        query.offset.assert_called_once_with(4)
+        query.offset.return_value.limit.assert_called_once_with(3)
+        mock_estimate.assert_called_once_with(query)
+        self.assertEqual(result['results'], [{'foo': 'bar'}, {'foo': 'bar'}])
+        self.assertEqual(result['total_estimate'], 40)
+        self.assertEqual(service._decode_cursor(result['next_cursor'], 1), [6])
+
+    @patch("verification_api.services.verification_service.estimate_rows")
+    def test_perform_search_paged_last_page(self, mock_estimate, mock_case, *_):
+        query = mock_case.search.return_value
+        query.offset.return_value.limit.return_value.all.return_value = []
+        mock_estimate.return_value = 0
+
+        with app.app_context():
+            result = service.perform_search({'last_name': 'Smith', 'limit': 2})
+
+        query.offset.assert_called_once_with(0)
+        self.assertEqual(result, {'results': [], 'next_cursor': None, 'total_estimate': 0})
+
+    def test_perform_search_invalid_limit(self, mock_case, *_):
+        with app.app_context():
+            with self.assertRaises(ApplicationError) as context:
+                service.perform_search({'last_name': 'Smith', 'limit': 'ten'})
+
+        self.assertEqual(context.exception.http_code, 400)
+
+    def test_perform_search_invalid_offset(self, mock_case, *_):
+        with app.app_context():
+            for offset in (-5, 0):
+                with self.assertRaises(ApplicationError) as context:
+                    service.perform_search({'last_name': 'Smith', 'cursor': service._encode_cursor(offset)})
+                self.assertEqual(context.exception.http_code, 400)
+
+        mock_case.search.return_value.offset.assert_not_called()
+
     @patch("verification_api.services.verification_service.Close.get_closure_by_case_id")
     def test_get_closure_by_id(self, mock_closure, *_):
         mock_closure.return_value = _generate_closure()
@@ -556,19 +1018,66 @@ class TestService(unittest.TestCase):
                                                                        filler=self.error))
         self.assertEqual(errors.get_code("verification_api", "SQLALCHEMY_ERROR"), context.exception.code)
 
-    @patch("verification_api.services.verification_service.Case.get_case_by_id")
-    @patch("verification_api.services.verification_service._update_registration_data")
     @patch("verification_api.services.verification_service._add_update_note")
     @patch("verification_api.services.verification_service.UlapdAPI")
-    def test_update_user_details(self, mock_ulapd, mock_note, mock_update_reg, mock_case, *_):
-        mock_case.return_value = _generate_test_profile()
-        mock_update_reg.return_value = {'foo': 'bar'}
-        mock_ulapd.update.return_value = {'message': 'user updated'}
+    def test_update_user_details(self, mock_ulapd, mock_note, mock_case, mock_db):
+        mock_case.get_case_by_id.return_value = _generate_test_profile()
+        mock_case.merge_registration_data.return_value = 2
+        data = {'updated_data': {'contactable': True}, 'staff_id': 'test_user'}
 
-        result = service.update_user_details(233, {'updated_data': {'contactable': True}, 'staff_id': 'test_user'})
+        result = service.update_user_details(233, data)
 
-        self.assertEqual(result, {'updated': True})
+        self.assertEqual(result, {'updated': True, 'version': 2})
+        mock_ulapd.return_value.update.assert_called_once_with({'user_id': 123, 'contactable': True})
+        mock_case.merge_registration_data.assert_called_once_with(233, {'contactable': True}, None)
         mock_note.assert_called_once()
+        mock_db.session.commit.assert_called_once()
+
+    @patch("verification_api.services.verification_service.UlapdAPI")
+    def test_update_user_details_version_mismatch(self, mock_ulapd, mock_case, *_):
+        mock_case.get_case_by_id.return_value = _generate_test_profile()
+        mock_case.get_case_by_id.return_value.version = 3
+
+        with self.assertRaises(ApplicationError) as context:
+            service.update_user_details(233, {'updated_data': {'contactable': True}}, 2)
+
+        expected_err = ('verification_api', 'VERIFICATION_ERROR')
+        expected_err_message = errors.get_message(*expected_err, filler='Case 233 has been changed since it was read')
+        self.assertEqual(context.exception.message, expected_err_message)
+        self.assertEqual(context.exception.http_code, 412)
+        mock_ulapd.assert_not_called()
+        mock_case.merge_registration_data.assert_not_called()
+
+    @patch("verification_api.services.verification_service.UlapdAPI")
+    def test_update_user_details_changed_during_update(self, mock_ulapd, mock_case, mock_db):
+        mock_case.get_case_by_id.return_value = _generate_test_profile()
+        mock_case.get_case_by_id.return_value.version = 2
+        mock_case.merge_registration_data.return_value = None
+
+        with self.assertRaises(ApplicationError) as context:
+            service.update_user_details(233, {'updated_data': {'contactable': True}}, 2)
+
+        self.assertEqual(context.exception.http_code, 412)
+        mock_case.merge_registration_data.assert_called_once_with(233, {'contactable': True}, 2)
+        mock_ulapd.assert_not_called()
+        mock_db.session.commit.assert_not_called()
+        mock_db.session.rollback.assert_called_once()
+
+    @patch("verification_api.services.verification_service._add_update_note")
+    @patch("verification_api.services.verification_service.UlapdAPI")
+    def test_update_user_details_ulapd_error(self, mock_ulapd, mock_note, mock_case, mock_db):
+        mock_case.get_case_by_id.return_value = _generate_test_profile()
+        mock_case.get_case_by_id.return_value.version = 2
+        mock_case.merge_registration_data.return_value = 3
+        mock_ulapd.return_value.update.side_effect = ApplicationError('Test error', 'E100')
+
+        with self.assertRaises(ApplicationError):
+            service.update_user_details(233, {'updated_data': {'contactable': True}, 'staff_id': 'test_user'}, 2)
+
+        # The case was updated first, and the update is undone
+        mock_case.merge_registration_data.assert_called_once_with(233, {'contactable': True}, 2)
+        mock_db.session.commit.assert_not_called()
+        mock_db.session.rollback.assert_called_once()
 
     def test_update_user_details_no_row(self, mock_case, *_):
         mock_case.get_case_by_id.return_value = None
@@ -601,10 +1110,15 @@ class TestService(unittest.TestCase):
             }
         ]
 
-        dataset_list = service.get_dataset_list_details()
+        service.dataset_list_cache.clear()
+        with app.app_context():
+            dataset_list, etag = service.get_dataset_list_details()
+            cached_list, cached_etag = service.get_dataset_list_details()
 
         mock_ulapd_api.assert_called_once()
         self.assertEqual(dataset_list, [{"id": "12345", "name": "test", "title": "Test Dataset", "private": True}])
+        self.assertEqual(cached_list, dataset_list)
+        self.assertEqual(cached_etag, etag)
 
     @patch("verification_api.services.verification_service._add_note")
     @patch("verification_api.services.verification_service.UlapdAPI")
@@ -776,13 +1290,6 @@ class TestServicePrivateFunctions(unittest.TestCase):
         result = service._extract_rows([mock_row, mock_row])
         self.assertEqual(result, [{'foo': 'bar'}, {'foo': 'bar'}])
 
-    def test_status_update_true(self):
-        mock_user = MagicMock()
-        test_data = {'verification_id': 123, 'staff_id': 'mr test'}
-        service._status_update(mock_user, 'Approved', test_data)
-        self.assertEqual(mock_user.status, 'Approved')
-        self.assertEqual(mock_user.staff_id, test_data['staff_id'])
-
     @patch("verification_api.services.verification_service.db.session")
     @patch("verification_api.services.verification_service.Note")
     def test_add_note(self, mock_note, mock_db):
@@ -801,7 +1308,7 @@ class TestServicePrivateFunctions(unittest.TestCase):
         }
         mock_note.assert_called_once_with(expected_dict_param)
         mock_db.add.assert_called_once_with(mock_note_entry)
-        mock_db.commit.assert_called_once()
+        mock_db.commit.assert_not_called()
 
     def test_can_perform_action_status_not_applicable(self):
         mock_case = MagicMock()
@@ -810,24 +1317,6 @@ class TestServicePrivateFunctions(unittest.TestCase):
         result = service._can_perform_action(mock_case, MagicMock())
         self.assertTrue(result)
 
-    def test_update_registration_data(self):
-        reg_data = {
-            'contactable': False,
-            'postcode': 'PL1 1AA',
-            'first_name': 'Ted'
-        }
-        updated_data = {
-            'contactable': True,
-            'postcode': 'PL2 2BB'
-        }
-        expected_data = {
-            'contactable': True,
-            'postcode': 'PL2 2BB',
-            'first_name': 'Ted'
-        }
-        result = service._update_registration_data(reg_data, updated_data)
-        self.assertEqual(result, expected_data)
-
     @patch("verification_api.services.verification_service._add_note")
     def test_add_update_note_true_single(self, mock_note):
         data = {
@@ -880,6 +1369,18 @@ def _generate_test_profile(verification_id=233, user_id=123, staff_id='LRTM101',
     return test_profile
 
 
+def _generate_bulk_case(case_id, staff_id='LRTM101', status='Pending'):
+    case = _generate_test_profile(verification_id=case_id, user_id='user-{}'.format(case_id), staff_id=staff_id,
+                                  status=status)
+    case.as_dict.return_value = {'case_id': case_id, 'ldap_id': 'ldap-{}'.format(case_id),
+                                 'user_id': 'user-{}'.format(case_id)}
+    return case
+
+
+def _raise(error):
+    raise error
+
+
 def _generate_closure(close_detail='test closure', date_added='2019-01-01'):
     test_closure = MagicMock()
     test_closure.close_detail = close_detail
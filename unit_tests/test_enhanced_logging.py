@@ -0,0 +1,118 @@
+import json
+import logging
+import unittest
+import urllib.request
+from email.message import Message
+from unittest.mock import patch, MagicMock
+from flask import g, jsonify
+from sqlalchemy import create_engine
+
+from verification_api.main import app
+from verification_api.custom_extensions.enhanced_logging import main as enhanced_logging
+from verification_api.custom_extensions.enhanced_logging import query_stats
+from verification_api.custom_extensions.enhanced_logging.filters import ContextualFilter
+from verification_api.custom_extensions.enhanced_logging.formatters import JsonFormatter
+
+
+class TestEnhancedLogging(unittest.TestCase):
+
+    def setUp(self):
+        enhanced_logging._session = None
+
+    def test_before_request_trace_id(self):
+        with app.test_request_context(headers={'X-Trace-ID': 'abc123'}):
+            enhanced_logging.before_request()
+            self.assertEqual(g.trace_id, 'abc123')
+
+    def test_before_request_shares_session(self):
+        with app.test_request_context():
+            enhanced_logging.before_request()
+            first = g.requests
+
+        with app.test_request_context():
+            enhanced_logging.before_request()
+            second = g.requests
+
+        self.assertIs(first, second)
+        self.assertNotIn('X-Trace-ID', second.headers)
+
+    def test_session_pool_size(self):
+        with app.test_request_context():
+            session = enhanced_logging.get_session()
+
+        adapter = session.get_adapter('http://account-api:8080')
+        self.assertEqual(adapter._pool_connections, app.config['HTTP_POOL_CONNECTIONS'])
+        self.assertEqual(adapter._pool_maxsize, app.config['HTTP_POOL_MAXSIZE'])
+
+    def test_session_keeps_no_cookies(self):
+        headers = Message()
+        headers['Set-Cookie'] = 'session=abc123; Path=/'
+        response = MagicMock()
+        response.info.return_value = headers
+        with app.test_request_context():
+            session = enhanced_logging.get_session()
+
+        session.cookies.extract_cookies(response, urllib.request.Request('http://account-api:8080/v1/users'))
+
+        self.assertEqual(len(session.cookies), 0)
+
+    @patch('requests.Session.request')
+    def test_request_adds_trace_id(self, mock_request):
+        mock_request.return_value.status_code = 200
+        with app.test_request_context(headers={'X-Trace-ID': 'abc123'}):
+            enhanced_logging.before_request()
+            g.requests.get('http://account-api:8080', headers={'Accept': 'application/json'})
+
+        _, kwargs = mock_request.call_args
+        self.assertEqual(kwargs['headers'], {'Accept': 'application/json', 'X-Trace-ID': 'abc123'})
+        self.assertEqual(kwargs['timeout'], app.config['DEFAULT_TIMEOUT'])
+
+    def test_queries_counted(self):
+        query_stats.listen()
+        engine = create_engine('sqlite://')
+        with app.test_request_context():
+            engine.execute('SELECT 1')
+            engine.execute('SELECT 2')
+            queries, sql_time = query_stats.get_query_stats()
+
+        self.assertEqual(queries, 2)
+        self.assertGreater(sql_time, 0)
+
+    def test_queries_outside_request_not_counted(self):
+        query_stats.listen()
+        engine = create_engine('sqlite://')
+        with app.app_context():
+            engine.execute('SELECT 1')
+            self.assertNotIn('sql_queries', g)
+
+    def test_after_request_server_timing(self):
+        with app.test_request_context():
+            enhanced_logging.before_request()
+            g.sql_queries = 3
+            g.sql_time = 0.0125
+            response = enhanced_logging.after_request(jsonify({}))
+
+        server_timing = response.headers.getlist('Server-Timing')
+        self.assertEqual(server_timing[0], 'db;desc="3 queries";dur=12.500')
+        self.assertTrue(server_timing[1].startswith('total;dur='))
+
+    def test_log_includes_query_stats(self):
+        with app.test_request_context():
+            enhanced_logging.before_request()
+            g.sql_queries = 2
+            g.sql_time = 0.004
+            record = logging.LogRecord('test', logging.INFO, __file__, 1, 'Hello %s', ('world',), None)
+            ContextualFilter().filter(record)
+
+        entry = json.loads(JsonFormatter().format(record))
+        self.assertEqual(entry['message'], 'Hello world')
+        self.assertEqual(entry['sql_queries'], 2)
+        self.assertEqual(entry['sql_time_ms'], 4.0)
+
+    def test_log_outside_request(self):
+        record = logging.LogRecord('test', logging.INFO, __file__, 1, 'Hello', (), None)
+        ContextualFilter().filter(record)
+
+        entry = json.loads(JsonFormatter().format(record))
+        self.assertEqual(entry['traceid'], 'N/A')
+        self.assertNotIn('sql_queries', entry)
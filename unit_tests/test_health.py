@@ -1,7 +1,11 @@
+import threading
+import time
 import unittest
 from unittest.mock import patch, MagicMock
 
 from verification_api.main import app
+from verification_api.utilities import concurrency
+from verification_api.views import general
 
 
 class TestHealth(unittest.TestCase):
@@ -117,10 +121,124 @@ class TestHealth(unittest.TestCase):
         self.assertEqual(response_json['status'], 'ERROR')
         self.assertEqual(response_json['cascade_depth'], 10)
 
+    @patch('verification_api.views.general._probe_service')
+    def test_health_cascade_probes_concurrently(self, mock_probe):
+        # Each probe only gets past the barrier once the other has started too
+        barrier = threading.Barrier(2, timeout=2)
+
+        def probe(dependency, *_):
+            barrier.wait()
+            return {'name': dependency, 'status': 'OK'}, True
+
+        mock_probe.side_effect = probe
+        dependencies = {'first-api': 'TEST_URL_1', 'second-api': 'TEST_URL_2'}
+        with patch.dict(app.config, {'DEPENDENCIES': dependencies, 'HEALTH_CASCADE_TIMEOUT': 5}):
+            response = self.app.get('/health/cascade/1')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([service['name'] for service in response.get_json()['services']], ['first-api', 'second-api'])
+
+    @patch('verification_api.views.general.submit', wraps=concurrency.submit)
+    @patch('verification_api.views.general._probe_service')
+    def test_health_cascade_probes_own_threads(self, mock_probe, mock_submit):
+        mock_probe.side_effect = lambda dependency, *_: ({'name': dependency, 'status': 'OK'}, True)
+        dependencies = {'first-api': 'TEST_URL_1', 'second-api': 'TEST_URL_2'}
+        with patch.dict(app.config, {'DEPENDENCIES': dependencies, 'HEALTH_CASCADE_TIMEOUT': 5}):
+            response = self.app.get('/health/cascade/1')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(mock_submit.call_count, 2)
+        for call in mock_submit.call_args_list:
+            self.assertEqual(call[1], {'workers': 'HEALTH_CASCADE_WORKERS'})
+
+    @patch('verification_api.views.general._probe_service')
+    def test_health_cascade_probe_timeout(self, mock_probe):
+        finished = threading.Event()
+        mock_probe.side_effect = lambda dependency, *_: (finished.wait(2), True)
+        try:
+            with patch.dict(app.config, {'DEPENDENCIES': {'dependency-api': 'TEST_URL'}, 'HEALTH_CASCADE_TIMEOUT': 5}):
+                start = time.monotonic()
+                response = self.app.get('/health/cascade/1', headers={'X-Cascade-Timeout': '0.1'})
+                elapsed = time.monotonic() - start
+        finally:
+            finished.set()
+
+        # The caller's shorter budget is the one used
+        self.assertLess(elapsed, 1)
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(response.get_json()['status'], 'BAD')
+        self.assertEqual(response.get_json()['services'][0], {'name': 'dependency-api', 'type': 'http',
+                                                              'status': 'UNKNOWN', 'status_code': None,
+                                                              'content_type': None, 'content': None})
+
+    @patch('verification_api.views.general._probe_dependencies')
+    def test_health_cascade_coalesced(self, mock_probe_dependencies):
+        started = threading.Event()
+        finished = threading.Event()
+
+        def probe_dependencies(*_):
+            started.set()
+            finished.wait(2)
+            return [], [], 200
+
+        mock_probe_dependencies.side_effect = probe_dependencies
+        results = []
+
+        def run_cascade():
+            results.append(general._run_cascade(1, 5))
+
+        leader = threading.Thread(target=run_cascade)
+        leader.start()
+        started.wait(2)
+        follower = threading.Thread(target=run_cascade)
+        follower.start()
+        time.sleep(0.1)
+        finished.set()
+        leader.join(2)
+        follower.join(2)
+
+        mock_probe_dependencies.assert_called_once_with(1, 5)
+        self.assertEqual(results, [([], [], 200), ([], [], 200)])
+        self.assertEqual(general._cascades_in_flight, {})
+
+    @patch('verification_api.views.general._probe_dependencies')
+    def test_health_cascade_coalesced_follower_timeout(self, mock_probe_dependencies):
+        started = threading.Event()
+        finished = threading.Event()
+
+        def probe_dependencies(*_):
+            started.set()
+            finished.wait(2)
+            return [], [], 200
+
+        mock_probe_dependencies.side_effect = probe_dependencies
+        dependencies = {'dependency-api': 'TEST_URL', 'database': 'postgres://TEST_URL'}
+        leader = threading.Thread(target=general._run_cascade, args=(1, 5))
+        leader.start()
+        try:
+            started.wait(2)
+            with patch.dict(app.config, {'DEPENDENCIES': dependencies}), app.test_request_context():
+                app.preprocess_request()
+                start = time.monotonic()
+                result = general._run_cascade(1, 0.1)
+                elapsed = time.monotonic() - start
+        finally:
+            finished.set()
+            leader.join(2)
+
+        # The follower only waits out its own budget, not the leader's
+        self.assertLess(elapsed, 1)
+        mock_probe_dependencies.assert_called_once_with(1, 5)
+        self.assertEqual(result, ([{'name': 'database', 'status': 'BAD'}],
+                                  [{'name': 'dependency-api', 'type': 'http', 'status': 'UNKNOWN', 'status_code': None,
+                                    'content_type': None, 'content': None}], 500))
+
 
 def _get_from_config(*args, **_):
     if args[0] == 'MAX_HEALTH_CASCADE':
         return 1
+    elif args[0] == 'HEALTH_CASCADE_TIMEOUT':
+        return 5
     elif args[0] == 'APP_NAME':
         return 'Verification API'
     elif args[0] == 'DEPENDENCIES':
@@ -0,0 +1,193 @@
+import unittest
+from datetime import timedelta
+from unittest.mock import patch, MagicMock
+from sqlalchemy.dialects import postgresql
+
+from verification_api.main import app
+from verification_api.extensions import db
+from verification_api.models import Case, Note, IdempotencyKey
+
+
+class TestModels(unittest.TestCase):
+
+    def setUp(self):
+        self.case = Case({
+            'user_id': '123',
+            'ldap_id': '456',
+            'registration_data': {'first_name': 'Ted'},
+            'status': 'Pending'
+        })
+
+    def test_as_dict_pending(self):
+        self.case.has_notes = False
+        self.assertEqual(self.case.as_dict()['status'], 'Pending')
+
+    def test_as_dict_in_progress(self):
+        self.case.has_notes = True
+        self.assertEqual(self.case.as_dict()['status'], 'In Progress')
+
+    def test_as_dict_resolved_with_notes(self):
+        self.case.status = 'Declined'
+        self.case.has_notes = True
+        self.assertEqual(self.case.as_dict()['status'], 'Declined')
+
+    def test_pending_query_loads_has_notes(self):
+        with app.app_context():
+            sql = str(Case._pending_query().statement.compile(dialect=postgresql.dialect()))
+
+        self.assertIn('EXISTS (SELECT *', sql)
+        self.assertIn('note.verification_id = verification.verification_id', sql)
+
+    def test_search_uses_indexed_expressions(self):
+        with app.app_context():
+            query = Case.search(first_name='Ted', email='ted@example.com')
+            compiled = query.statement.compile(dialect=postgresql.dialect())
+
+        self.assertIn("(verification.registration_data ->> 'first_name') ILIKE", str(compiled))
+        self.assertIn("(verification.registration_data ->> 'email') ILIKE", str(compiled))
+        self.assertNotIn('last_name', str(compiled))
+        self.assertEqual([compiled.params['param_1'], compiled.params['param_2']], ['%Ted%', '%ted@example.com%'])
+
+    def test_search_escapes_wildcards(self):
+        with app.app_context():
+            compiled = Case.search(last_name='100%_sure').statement.compile(dialect=postgresql.dialect())
+
+        self.assertEqual(compiled.params['param_1'], '%100\\%\\_sure%')
+
+    def test_search_ordered_by_relevance(self):
+        with app.app_context():
+            sql = str(Case.search(first_name='Ted').statement.compile(dialect=postgresql.dialect()))
+
+        self.assertIn("ORDER BY similarity(verification.registration_data ->> 'first_name', %(similarity_1)s) DESC, "
+                      "verification.date_added DESC, verification.verification_id DESC", sql)
+
+    @patch('verification_api.models.Case.query')
+    @patch('verification_api.models.db.session')
+    def test_transition_is_conditional(self, mock_session, mock_query):
+        mock_query.populate_existing.return_value.instances.return_value = iter([])
+        with app.app_context():
+            result = Case.transition('1', 'LRTM101', 'Approved')
+            statement = mock_session.execute.call_args[0][0]
+            compiled = statement.compile(dialect=postgresql.dialect())
+
+        self.assertIsNone(result)
+        self.assertIn('UPDATE verification SET status=%(status)s', str(compiled))
+        self.assertIn('WHERE verification.verification_id = %(verification_id_1)s '
+                      'AND verification.status = %(status_1)s '
+                      'AND verification.staff_id = %(staff_id_1)s', str(compiled))
+        self.assertIn('RETURNING verification.verification_id', str(compiled))
+        self.assertEqual(compiled.params['status_1'], 'Pending')
+        self.assertEqual(compiled.params['staff_id_1'], 'LRTM101')
+        self.assertEqual(compiled.params['status'], 'Approved')
+
+    @patch('verification_api.models.db.session')
+    def test_merge_registration_data(self, mock_session):
+        mock_session.execute.return_value.scalar.return_value = 4
+        with app.app_context():
+            result = Case.merge_registration_data('1', {'contactable': True}, 3)
+            statement = mock_session.execute.call_args[0][0]
+            compiled = statement.compile(dialect=postgresql.dialect())
+
+        self.assertEqual(result, 4)
+        self.assertIn('SET registration_data=(verification.registration_data || %(param_1)s), '
+                      'version=(verification.version + %(version_1)s)', str(compiled))
+        self.assertIn('AND verification.version = %(version_2)s RETURNING verification.version', str(compiled))
+        self.assertEqual(compiled.params['param_1'], {'contactable': True})
+        self.assertEqual(compiled.params['version_2'], 3)
+
+    @patch('verification_api.models.db.session')
+    def test_lock_only_if_free_or_expired(self, mock_session):
+        with app.app_context():
+            Case.lock('1', 'LRTM101', timedelta(minutes=15))
+            compiled = mock_session.execute.call_args[0][0].compile(dialect=postgresql.dialect())
+
+        self.assertIn('locked_until=(now() + %(now_1)s)', str(compiled))
+        self.assertIn('verification.status NOT IN (%(status_1)s, %(status_2)s) '
+                      'AND (verification.staff_id = %(staff_id_1)s OR verification.locked_until IS NULL '
+                      'OR verification.locked_until <= now()) RETURNING verification.locked_until', str(compiled))
+        self.assertEqual(compiled.params['now_1'], timedelta(minutes=15))
+        self.assertNotIn('version', str(compiled))
+
+    @patch('verification_api.models.db.session')
+    def test_unlock_keeps_version(self, mock_session):
+        with app.app_context():
+            Case.unlock('1')
+            sql = str(mock_session.execute.call_args[0][0].compile(dialect=postgresql.dialect()))
+
+        self.assertIn('SET staff_id=%(staff_id)s, locked_until=%(locked_until)s WHERE', sql)
+        self.assertNotIn('version', sql)
+
+    def test_claim_next_skips_locked_rows(self):
+        with app.app_context(), patch.object(db.session, 'execute') as mock_execute, \
+                patch.object(Case, 'query') as mock_query:
+            mock_query.populate_existing.return_value.instances.return_value = iter([])
+            result = Case.claim_next('LRTM101', timedelta(minutes=15))
+            sql = str(mock_execute.call_args[0][0].compile(dialect=postgresql.dialect()))
+
+        self.assertIsNone(result)
+        self.assertIn('WHERE verification.verification_id = (SELECT verification.verification_id', sql)
+        self.assertIn('(verification.locked_until IS NULL OR verification.locked_until <= now()) '
+                      'ORDER BY verification.date_added ASC, verification.verification_id ASC', sql)
+        self.assertIn('FOR UPDATE SKIP LOCKED)', sql)
+        self.assertIn('SET staff_id=%(staff_id)s, locked_until=(now() + %(now_1)s) WHERE', sql)
+
+    @patch('verification_api.models.db.session')
+    def test_insert_many_single_statement(self, mock_session):
+        mock_session.execute.return_value = [MagicMock(verification_id=4), MagicMock(verification_id=5)]
+        cases = [{'user_id': '1', 'ldap_id': 'a', 'registration_data': {}, 'status': 'Pending'},
+                 {'user_id': '2', 'ldap_id': 'b', 'registration_data': {}, 'status': 'Pending', 'staff_id': 'LRTM101'}]
+        with app.app_context():
+            result = Case.insert_many(cases)
+            sql = str(mock_session.execute.call_args[0][0].compile(dialect=postgresql.dialect()))
+
+        self.assertEqual(result, [4, 5])
+        mock_session.execute.assert_called_once()
+        self.assertIn('RETURNING verification.verification_id', sql)
+        self.assertIn('%(status_m1)s', sql)
+
+    @patch('sqlalchemy.orm.Query.all', autospec=True)
+    def test_lock_many_locks_rows(self, mock_all):
+        with app.app_context():
+            Case.lock_many([1, 2], 'Pending', 'LRTM101')
+            query = mock_all.call_args[0][0]
+            sql = str(query.statement.compile(dialect=postgresql.dialect()))
+
+        self.assertIn('WHERE verification.verification_id IN (%(verification_id_1)s, %(verification_id_2)s) '
+                      'AND verification.status = %(status_1)s AND verification.staff_id = %(staff_id_1)s', sql)
+        self.assertIn('FOR UPDATE OF verification', sql)
+
+    @patch('verification_api.models.Case.query')
+    @patch('verification_api.models.db.session')
+    def test_update_many_single_statement(self, mock_session, mock_query):
+        mock_query.populate_existing.return_value.instances.return_value = iter(['case'])
+        with app.app_context():
+            result = Case.update_many([1, 2], {'status': 'Closed'})
+            compiled = mock_session.execute.call_args[0][0].compile(dialect=postgresql.dialect())
+
+        self.assertEqual(result, ['case'])
+        mock_session.execute.assert_called_once()
+        self.assertIn('WHERE verification.verification_id IN (%(verification_id_1)s, %(verification_id_2)s) '
+                      'RETURNING verification.verification_id', str(compiled))
+        self.assertEqual(compiled.params['status'], 'Closed')
+
+    @patch('verification_api.models.db.session')
+    def test_note_add_many_single_statement(self, mock_session):
+        with app.app_context():
+            Note.add_many([1, 2], 'LRTM101', 'Declined')
+            compiled = mock_session.execute.call_args[0][0].compile(dialect=postgresql.dialect())
+
+        mock_session.execute.assert_called_once()
+        self.assertEqual([compiled.params['verification_id_m0'], compiled.params['verification_id_m1']], [1, 2])
+
+    def test_claim_idempotency_key_takes_over_expired(self):
+        connection = MagicMock()
+        with app.app_context():
+            IdempotencyKey.claim(connection, 'abc123', 'hash', timedelta(days=1), timedelta(minutes=5))
+            compiled = connection.execute.call_args[0][0].compile(dialect=postgresql.dialect())
+
+        self.assertIn('ON CONFLICT (idempotency_key) DO UPDATE SET', str(compiled))
+        self.assertIn('WHERE idempotency_key.date_added <= now() - %(now_1)s '
+                      'OR idempotency_key.response_code IS NULL AND idempotency_key.request_hash = %(request_hash_1)s '
+                      'AND idempotency_key.date_added <= now() - %(now_2)s '
+                      'RETURNING idempotency_key.idempotency_key', str(compiled))
+        self.assertEqual(compiled.params['now_2'], timedelta(minutes=5))
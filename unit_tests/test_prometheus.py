@@ -0,0 +1,105 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import patch, MagicMock
+from flask import Flask, g
+from prometheus_client import REGISTRY
+from sqlalchemy import create_engine
+
+import gunicorn_config
+from verification_api.main import app
+from verification_api.custom_extensions.enhanced_logging import main as enhanced_logging
+from verification_api.custom_extensions.prometheus import main as prometheus
+
+
+class TestPrometheus(unittest.TestCase):
+
+    def setUp(self):
+        self.app = app.test_client()
+
+    def test_metrics(self):
+        self.app.get('/health')
+        before = _sample('http_request_duration_seconds_count', method='GET', route='/health', status='200')
+
+        self.app.get('/health')
+        response = self.app.get('/metrics')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content_type.startswith('text/plain'))
+        self.assertIn('http_request_duration_seconds_bucket', response.get_data(as_text=True))
+        self.assertEqual(_sample('http_request_duration_seconds_count', method='GET', route='/health',
+                                 status='200'), before + 1)
+
+    def test_requests_in_flight(self):
+        in_flight = []
+        with app.test_request_context():
+            before = _sample('http_requests_in_flight')
+            prometheus.before_request()
+            in_flight.append(_sample('http_requests_in_flight'))
+            prometheus.teardown_request(None)
+            prometheus.teardown_request(None)
+            in_flight.append(_sample('http_requests_in_flight'))
+
+        self.assertEqual(in_flight, [before + 1, before])
+
+    def test_get_dependency_name(self):
+        with app.app_context():
+            self.assertEqual(prometheus.get_dependency_name(app.config['ACCOUNT_API_URL'] + '/v1/users'),
+                             'AccountAPI')
+            self.assertEqual(prometheus.get_dependency_name(app.config['ULAPD_API_URL'] + '/datasets'), 'UlapdAPI')
+            self.assertEqual(prometheus.get_dependency_name('http://elsewhere/health'), 'other')
+
+    @patch('requests.Session.request')
+    def test_dependency_call_recorded(self, mock_request):
+        mock_request.return_value = MagicMock(status_code=500)
+        before_calls = _sample('dependency_call_duration_seconds_count', dependency='AccountAPI')
+        before_errors = _sample('dependency_call_errors_total', dependency='AccountAPI')
+
+        with app.test_request_context():
+            enhanced_logging.before_request()
+            g.requests.post(app.config['ACCOUNT_API_URL'] + '/v1/users/1/activate')
+
+        self.assertEqual(_sample('dependency_call_duration_seconds_count', dependency='AccountAPI'), before_calls + 1)
+        self.assertEqual(_sample('dependency_call_errors_total', dependency='AccountAPI'), before_errors + 1)
+
+    def test_database_statements_recorded(self):
+        engine = create_engine('sqlite://')
+        before_calls = _sample('dependency_call_duration_seconds_count', dependency='Postgres')
+        before_errors = _sample('dependency_call_errors_total', dependency='Postgres')
+
+        engine.execute('SELECT 1')
+        with self.assertRaises(Exception):
+            engine.execute('SELECT nonsense FROM nowhere')
+
+        self.assertEqual(_sample('dependency_call_duration_seconds_count', dependency='Postgres'), before_calls + 1)
+        self.assertEqual(_sample('dependency_call_errors_total', dependency='Postgres'), before_errors + 1)
+
+    def test_pool_checkout_recorded(self):
+        pool = prometheus.TimedQueuePool(MagicMock)
+        before = _sample('db_pool_checkout_seconds_count')
+
+        pool.connect().close()
+
+        self.assertEqual(_sample('db_pool_checkout_seconds_count'), before + 1)
+
+    def test_engine_uses_timed_pool(self):
+        self.assertIs(app.config['SQLALCHEMY_ENGINE_OPTIONS']['poolclass'], prometheus.TimedQueuePool)
+
+    def test_init_app_creates_directory(self):
+        with tempfile.TemporaryDirectory() as directory:
+            flask_app = Flask(__name__)
+            flask_app.config['PROMETHEUS_MULTIPROC_DIR'] = os.path.join(directory, 'prometheus')
+
+            prometheus.PrometheusMetrics(flask_app)
+
+            self.assertTrue(os.path.isdir(flask_app.config['PROMETHEUS_MULTIPROC_DIR']))
+
+    @patch('gunicorn_config.multiprocess.mark_process_dead')
+    def test_worker_marked_dead_on_exit(self, mock_mark_dead):
+        gunicorn_config.child_exit(MagicMock(), MagicMock(pid=1234))
+
+        mock_mark_dead.assert_called_once_with(1234)
+
+
+def _sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
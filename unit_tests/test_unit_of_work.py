@@ -0,0 +1,78 @@
+import unittest
+from unittest.mock import patch
+from flask import Response
+from sqlalchemy.exc import OperationalError
+from common_utilities import errors
+
+from verification_api.main import app
+from verification_api.extensions import db, unit_of_work
+
+
+@patch.object(db, 'session')
+class TestUnitOfWork(unittest.TestCase):
+
+    def test_commit(self, mock_session):
+        response = Response(status=200)
+        with app.test_request_context():
+            result = unit_of_work.commit(response)
+
+        self.assertIs(result, response)
+        mock_session.commit.assert_called_once()
+
+    def test_commit_not_on_server_error(self, mock_session):
+        with app.test_request_context():
+            unit_of_work.commit(Response(status=500))
+
+        mock_session.commit.assert_not_called()
+
+    def test_commit_failed(self, mock_session):
+        error = OperationalError('COMMIT', {}, 'connection lost')
+        mock_session.commit.side_effect = error
+        with app.test_request_context():
+            app.preprocess_request()
+            result = unit_of_work.commit(Response(status=200))
+
+        self.assertEqual(result.status_code, 500)
+        self.assertEqual(result.get_json()['error'],
+                         errors.get_message('verification_api', 'SQLALCHEMY_ERROR', filler=str(error)))
+        mock_session.rollback.assert_called_once()
+
+    def test_on_complete_after_commit(self, mock_session):
+        completed = []
+        mock_session.commit.side_effect = lambda: completed.append('commit')
+        response = Response(status=200)
+        with app.test_request_context():
+            unit_of_work.on_complete(lambda result: completed.append(result))
+            unit_of_work.commit(response)
+
+        self.assertEqual(completed, ['commit', response])
+
+    def test_on_complete_commit_failed(self, mock_session):
+        mock_session.commit.side_effect = OperationalError('COMMIT', {}, 'connection lost')
+        completed = []
+        with app.test_request_context():
+            app.preprocess_request()
+            unit_of_work.on_complete(completed.append)
+            result = unit_of_work.commit(Response(status=200))
+
+        # Given the error response, as the work wasn't kept
+        self.assertEqual(completed, [result])
+        self.assertEqual(result.status_code, 500)
+
+    def test_remove(self, mock_session):
+        unit_of_work.remove(None)
+
+        mock_session.rollback.assert_not_called()
+        mock_session.remove.assert_called_once()
+
+    def test_remove_after_exception(self, mock_session):
+        unit_of_work.remove(ValueError('failed'))
+
+        mock_session.rollback.assert_called_once()
+        mock_session.remove.assert_called_once()
+
+    def test_one_session_per_request(self, mock_session):
+        self.assertEqual(app.test_client().get('/health').status_code, 200)
+
+        mock_session.commit.assert_called_once()
+        mock_session.remove.assert_called()
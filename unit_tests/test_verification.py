@@ -1,13 +1,13 @@
 import unittest
+import json
 from verification_api.main import app
 from verification_api.exceptions import ApplicationError
 from unittest.mock import patch
 from common_utilities import errors
 
 
+@patch('verification_api.views.v1.verification.handle_dataset_access_metrics')
 @patch('verification_api.views.v1.verification.insert_metric_event')
-@patch('verification_api.views.v1.verification.insert_cf_event')
-@patch('verification_api.views.v1.verification.AuditAPI')
 @patch('verification_api.views.v1.verification.service')
 class TestVerification(unittest.TestCase):
 
@@ -42,17 +42,136 @@ class TestVerification(unittest.TestCase):
         response_body = response.get_json()
         self.assertEqual("Failed to retrieve worklist - " + expected_err_msg, response_body['error'])
 
+    def test_get_worklist_page(self, mock_service, *_):
+        mock_service.get_pending_page.return_value = {'cases': [{'foo': 'bar'}], 'next_cursor': 'abc'}
+
+        response = self.app.get('/v1/worklist?limit=1&cursor=xyz', headers=self.headers)
+
+        self.assertEqual(200, response.status_code)
+        mock_service.get_pending_page.assert_called_once_with('1', 'xyz')
+        self.assertEqual(response.get_json(), {'cases': [{'foo': 'bar'}], 'next_cursor': 'abc'})
+        mock_service.get_pending.assert_not_called()
+
+    def test_get_worklist_stream(self, mock_service, *_):
+        mock_service.stream_pending.return_value = iter(['[', '{"foo":"bar"}', ']'])
+
+        response = self.app.get('/v1/worklist?stream=true', headers=self.headers)
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(response.get_json(), [{'foo': 'bar'}])
+        mock_service.get_pending.assert_not_called()
+
+    def test_claim_next_case(self, mock_service, *_):
+        mock_service.claim_next_case.return_value = {'case_id': 1, 'staff_id': 'LRTM101', 'notes': []}
+
+        response = self.app.post('/v1/worklist/claim', json={'staff_id': 'LRTM101'}, headers=self.headers)
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(response.get_json(), {'case_id': 1, 'staff_id': 'LRTM101', 'notes': []})
+        mock_service.claim_next_case.assert_called_once_with('LRTM101')
+
+    def test_claim_next_case_none_left(self, mock_service, *_):
+        mock_service.claim_next_case.return_value = None
+
+        response = self.app.post('/v1/worklist/claim', json={'staff_id': 'LRTM101'}, headers=self.headers)
+
+        self.assertEqual(204, response.status_code)
+
+    def test_claim_next_case_bad_request(self, mock_service, *_):
+        response = self.app.post('/v1/worklist/claim', json={}, headers=self.headers)
+
+        self.assertEqual(400, response.status_code)
+        self.assertEqual(response.get_json()['error'], "Failed to claim case - no 'staff_id' provided")
+        mock_service.claim_next_case.assert_not_called()
+
+    def test_insert_cases(self, mock_service, *_):
+        mock_service.insert_cases.return_value = [1, 2]
+        cases = [{'user_id': '1'}, {'user_id': '2'}]
+
+        response = self.app.post('/v1/cases/bulk', json=cases, headers=self.headers)
+
+        self.assertEqual(201, response.status_code)
+        self.assertEqual(response.get_json(), {'case_ids': [1, 2]})
+        mock_service.insert_cases.assert_called_once_with(cases)
+
+    def test_insert_cases_ndjson(self, mock_service, *_):
+        mock_service.insert_cases.side_effect = lambda cases: [case['user_id'] for case in cases]
+        body = '{"user_id": "1"}\n\n{"user_id": "2"}\n'
+        headers = dict(self.headers, **{'Content-Type': 'application/x-ndjson'})
+
+        response = self.app.post('/v1/cases/bulk', data=body, headers=headers)
+
+        self.assertEqual(201, response.status_code)
+        self.assertEqual(response.get_json(), {'case_ids': ['1', '2']})
+
+    def test_insert_cases_invalid_ndjson(self, mock_service, *_):
+        mock_service.insert_cases.side_effect = lambda cases: list(cases)
+        headers = dict(self.headers, **{'Content-Type': 'application/x-ndjson'})
+
+        response = self.app.post('/v1/cases/bulk', data='{"user_id": "1"}\nnot json\n', headers=headers)
+
+        self.assertEqual(400, response.status_code)
+
+    def test_insert_cases_not_a_list(self, mock_service, *_):
+        response = self.app.post('/v1/cases/bulk', json={'user_id': '1'}, headers=self.headers)
+
+        self.assertEqual(400, response.status_code)
+        mock_service.insert_cases.assert_not_called()
+
+    def test_approve_cases(self, mock_service, *_):
+        results = [{'case_id': 1, 'status_updated': True},
+                   {'case_id': 2, 'status_updated': False, 'error': 'Case has already been approved'}]
+        mock_service.bulk_dps_action.return_value = results
+        body = dict(self.approve_body, case_ids=[1, 2])
+
+        response = self.app.post('/v1/cases/approve', json=body, headers=self.headers)
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(response.get_json(), {'results': results})
+        mock_service.bulk_dps_action.assert_called_once_with('Approve', [1, 2], body)
+
+    def test_decline_cases_missing_fields(self, mock_service, *_):
+        response = self.app.post('/v1/cases/decline', json=dict(self.decline_body, case_ids=[1]),
+                                 headers=self.headers)
+
+        self.assertEqual(400, response.status_code)
+        self.assertIn('Missing advice', response.get_json()['error'])
+        mock_service.bulk_dps_action.assert_not_called()
+
+    def test_close_accounts_invalid_case_ids(self, mock_service, *_):
+        response = self.app.post('/v1/cases/close', json=dict(self.close_body, case_ids='1,2'), headers=self.headers)
+
+        self.assertEqual(400, response.status_code)
+        self.assertIn('case_ids must be a list of case ids', response.get_json()['error'])
+        mock_service.bulk_close_accounts.assert_not_called()
+
+    def test_close_accounts_bool_case_ids(self, mock_service, *_):
+        response = self.app.post('/v1/cases/close', json=dict(self.close_body, case_ids=[True]), headers=self.headers)
+
+        self.assertEqual(400, response.status_code)
+        self.assertIn('case_ids must be a list of case ids', response.get_json()['error'])
+        mock_service.bulk_close_accounts.assert_not_called()
+
+    def test_close_accounts(self, mock_service, *_):
+        mock_service.bulk_close_accounts.return_value = [{'case_id': 1, 'status_updated': True}]
+        body = dict(self.close_body, case_ids=[1])
+
+        response = self.app.post('/v1/cases/close', json=body, headers=self.headers)
+
+        self.assertEqual(200, response.status_code)
+        mock_service.bulk_close_accounts.assert_called_once_with([1], body)
+
     def test_get_worklist_item_not_found(self, mock_service, *_):
-        mock_service.get_pending_by_id.return_value = {}
+        mock_service.get_pending_by_id.return_value = {'version': 1}
 
         response = self.app.get('/v1/case/1', headers=self.headers)
 
         self.assertEqual(200, response.status_code)
         response_body = response.get_json()
-        self.assertEqual(response_body, {})
+        self.assertEqual(response_body, {'version': 1})
 
     def test_get_worklist_item(self, mock_service, *_):
-        expected_result = {'foo': 'bar', 'notes': [{'my_note': 'A note'}]}
+        expected_result = {'foo': 'bar', 'notes': [{'my_note': 'A note'}], 'version': 3}
         mock_service.get_pending_by_id.return_value = expected_result
 
         response = self.app.get('/v1/case/1', headers=self.headers)
@@ -60,6 +179,17 @@ class TestVerification(unittest.TestCase):
         self.assertEqual(200, response.status_code)
         response_body = response.get_json()
         self.assertEqual(response_body, expected_result)
+        self.assertEqual(response.headers['ETag'], '"3"')
+
+    def test_get_worklist_item_ignores_if_none_match(self, mock_service, *_):
+        # The lock owner and notes can change without the version changing
+        mock_service.get_pending_by_id.return_value = {'foo': 'bar', 'version': 3}
+        headers = dict(self.headers, **{'If-None-Match': '"3"'})
+
+        response = self.app.get('/v1/case/1', headers=headers)
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(response.get_json(), {'foo': 'bar', 'version': 3})
 
     def test_get_worklist_item_error(self, mock_service, *_):
         mock_service.get_pending_by_id.side_effect = ApplicationError(*errors.get(*self.test_error))
@@ -73,6 +203,25 @@ class TestVerification(unittest.TestCase):
         self.assertEqual(500, response.status_code)
         self.assertEqual(expected_err_msg, response_body['error'])
 
+    def test_get_case_details(self, mock_service, *_):
+        expected_result = {'foo': 'bar', 'notes': [], 'groups': ['nps'], 'dataset_activity': [], 'dataset_access': []}
+        mock_service.get_case_details.return_value = expected_result
+
+        response = self.app.get('/v1/case/1/full', headers=self.headers)
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(response.get_json(), expected_result)
+        mock_service.get_case_details.assert_called_once_with('1')
+
+    def test_get_case_details_error(self, mock_service, *_):
+        mock_service.get_case_details.side_effect = ApplicationError(*errors.get(*self.test_error))
+
+        response = self.app.get('/v1/case/1/full', headers=self.headers)
+
+        expected_err_msg = "Failed to get full details for case '1' - {}".format(errors.get_message(*self.test_error))
+        self.assertEqual(500, response.status_code)
+        self.assertEqual(expected_err_msg, response.get_json()['error'])
+
     def test_approve_ok(self, mock_service, *_):
         mock_service.dps_action.return_value = self.return_true_body
         mock_service.get_pending_by_id.return_value = {'foo': 'bar', 'notes': [{'my_note': 'A note'}]}
@@ -174,12 +323,22 @@ class TestVerification(unittest.TestCase):
         self.assertEqual("Failed to insert note - " + expected_err_msg, response_body['error'])
 
     def test_decline_reasons(self, mock_service, *_):
-        mock_service.get_decline_reasons.return_value = [
+        mock_service.get_decline_reasons.return_value = (json.dumps([
             {"decline_reason": "Company number invalid",
              "decline_text": "Following checks your company number is invalid"}
-        ]
+        ]), 'abc123')
         response = self.app.get('/v1/decline-reasons', headers=self.headers)
         self.assertEqual(200, response.status_code)
+        self.assertEqual(response.get_json()[0]['decline_reason'], 'Company number invalid')
+        self.assertEqual(response.headers['ETag'], '"abc123"')
+
+    def test_decline_reasons_not_modified(self, mock_service, *_):
+        mock_service.get_decline_reasons.return_value = ('[]', 'abc123')
+        headers = dict(self.headers, **{'If-None-Match': '"abc123"'})
+
+        response = self.app.get('/v1/decline-reasons', headers=headers)
+
+        self.assertEqual(304, response.status_code)
 
     def test_decline_reason_error(self, mock_service, *_):
         mock_service.get_decline_reasons.side_effect = ApplicationError(*errors.get(*self.test_error))
@@ -196,10 +355,14 @@ class TestVerification(unittest.TestCase):
             'staff_id': 'LRTM101'
         }
 
+        lock = {'case_id': '1', 'staff_id': 'LRTM101', 'locked_until': '2026-01-01 12:15:00+00:00'}
+        mock_service.manage_case_lock.return_value = lock
+
         response = self.app.post('/v1/case/1/lock', json=json_body, headers=self.headers)
 
         mock_service.manage_case_lock.assert_called_once_with('1', 'LRTM101')
-        self.assertEqual(response.status_code, 204)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json(), lock)
 
     def test_lock_bad_request(self, *_):
         response = self.app.post('/v1/case/1/lock', json={}, headers=self.headers)
@@ -237,7 +400,7 @@ class TestVerification(unittest.TestCase):
         self.assertEqual(response.status_code, 500)
         self.assertEqual(response_body['error'], expected_error_msg)
 
-    def test_close_success(self, mock_service, mock_audit, *_):
+    def test_close_success(self, mock_service, mock_metric, *_):
         mock_service.close_account.return_value = self.return_true_body
         mock_service.get_closure_by_id.return_value = {'closure_reason': 'A closure reason',
                                                        'date_closed': '2018-09-09'}
@@ -246,7 +409,8 @@ class TestVerification(unittest.TestCase):
         self.assertEqual(200, response.status_code)
         response_body = response.get_json()
         self.assertEqual(response_body, self.return_true_body)
-        mock_audit.assert_called_once()
+        # The closure metric event goes through the outbox, written by the service
+        mock_metric.assert_not_called()
         mock_service.close_account.assert_called_once()
         mock_service.insert_note.assert_called_once()
         closure_text = 'Account closure requested by: {}, for reason: {}'.format(self.close_body['requester'],
@@ -254,7 +418,7 @@ class TestVerification(unittest.TestCase):
         mock_service.insert_note.assert_called_with('1', {'staff_id': self.close_body['staff_id'],
                                                           'note_text': closure_text})
 
-    def test_close_error(self, mock_service, mock_audit, *_):
+    def test_close_error(self, mock_service, *_):
         mock_service.close_account.side_effect = ApplicationError(*errors.get(*self.test_error))
         expected_err_msg = errors.get_message(*self.test_error)
 
@@ -266,7 +430,7 @@ class TestVerification(unittest.TestCase):
         expected_err = 'Failed to close account 1 - {}'.format(expected_err_msg)
         self.assertEqual(expected_err, response_body['error'])
 
-    def test_auto_close(self, mock_service, mock_audit, *_):
+    def test_auto_close(self, mock_service, *_):
         mock_service.auto_close.return_value = {'status': True}
 
         response = self.app.post('/v1/case/123456/auto_close', json=self.close_body, headers=self.headers)
@@ -274,7 +438,7 @@ class TestVerification(unittest.TestCase):
         self.assertEqual(200, response.status_code)
         self.assertEqual(response.get_json(), {'status': True})
 
-    def test_auto_close_error(self, mock_service, mock_audit, *_):
+    def test_auto_close_error(self, mock_service, *_):
         mock_service.auto_close.side_effect = ApplicationError(*errors.get(*self.test_error))
         expected_err_msg = errors.get_message(*self.test_error)
 
@@ -286,13 +450,14 @@ class TestVerification(unittest.TestCase):
         self.assertEqual(expected_err, response_body['error'])
 
     def test_search(self, mock_service, *_):
-        mock_service.perform_search.return_value = [{'foo': 'bar'}]
+        expected_result = {'results': [{'foo': 'bar'}], 'next_cursor': None, 'total_estimate': 1}
+        mock_service.perform_search.return_value = expected_result
         json_body = {"first_name": "Andreea"}
         response = self.app.post('/v1/search', json=json_body, headers=self.headers)
 
         self.assertEqual(200, response.status_code)
         response_body = response.get_json()
-        self.assertListEqual(response_body, [{'foo': 'bar'}])
+        self.assertEqual(response_body, expected_result)
 
     def test_search_error(self, mock_service, *_):
         mock_service.perform_search.side_effect = ApplicationError(*errors.get(*self.test_error))
@@ -307,14 +472,25 @@ class TestVerification(unittest.TestCase):
         self.assertEqual(expected_err, response_body['error'])
 
     def test_get_dataset_list_details(self, mock_service, *_):
-        mock_service.get_dataset_list_details.return_value = [{"id": "12345", "name": "test",
-                                                               "title": "Test Dataset", "private": True}]
+        mock_service.get_dataset_list_details.return_value = ([{"id": "12345", "name": "test",
+                                                                "title": "Test Dataset", "private": True}], 'abc123')
 
         response = self.app.get('/v1/dataset-list-details', headers=self.headers)
 
         self.assertEqual(response.get_json(), [{"id": "12345", "name": "test",
                                                 "title": "Test Dataset", "private": True}])
         self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['ETag'], '"abc123"')
+        self.assertEqual(response.headers['Cache-Control'], 'max-age={}'.format(app.config['DATASET_LIST_CACHE_TTL']))
+
+    def test_get_dataset_list_details_not_modified(self, mock_service, *_):
+        mock_service.get_dataset_list_details.return_value = ([{"id": "12345"}], 'abc123')
+        headers = dict(self.headers, **{'If-None-Match': '"abc123"'})
+
+        response = self.app.get('/v1/dataset-list-details', headers=headers)
+
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
 
     def test_get_dataset_list_details_error(self, mock_service, *_):
         mock_service.get_dataset_list_details.side_effect = ApplicationError(*errors.get(*self.test_error))
@@ -347,12 +523,33 @@ class TestVerification(unittest.TestCase):
         self.assertEqual(response.status_code, 500)
 
     def test_update_details_ok(self, mock_service, *_):
-        expected_result = {'updated': True}
+        expected_result = {'updated': True, 'version': 2}
         mock_service.update_user_details.return_value = expected_result
         json_body = {'updated_data': {'contactable': True}, 'staff_id': 'aa111zz'}
         response = self.app.post('/v1/case/1/update', json=json_body, headers=self.headers)
         self.assertEqual(200, response.status_code)
         self.assertEqual(response.get_json(), expected_result)
+        self.assertEqual(response.headers['ETag'], '"2"')
+        mock_service.update_user_details.assert_called_once_with('1', json_body, None)
+
+    def test_update_details_if_match(self, mock_service, *_):
+        mock_service.update_user_details.return_value = {'updated': True, 'version': 2}
+        json_body = {'updated_data': {'contactable': True}, 'staff_id': 'aa111zz'}
+        headers = dict(self.headers, **{'If-Match': '"1"'})
+
+        response = self.app.post('/v1/case/1/update', json=json_body, headers=headers)
+
+        self.assertEqual(200, response.status_code)
+        mock_service.update_user_details.assert_called_once_with('1', json_body, 1)
+
+    def test_update_details_invalid_if_match(self, mock_service, *_):
+        json_body = {'updated_data': {'contactable': True}, 'staff_id': 'aa111zz'}
+        headers = dict(self.headers, **{'If-Match': '"abc"'})
+
+        response = self.app.post('/v1/case/1/update', json=json_body, headers=headers)
+
+        self.assertEqual(400, response.status_code)
+        mock_service.update_user_details.assert_not_called()
 
     def test_update_details_error(self, mock_service, *_):
         mock_service.update_user_details.side_effect = ApplicationError(*errors.get(*self.test_error))
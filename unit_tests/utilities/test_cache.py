@@ -0,0 +1,78 @@
+import threading
+import unittest
+from unittest.mock import patch, MagicMock
+
+from verification_api.main import app
+from verification_api.utilities.cache import TTLCache
+
+
+@patch('verification_api.utilities.cache.time')
+class TestTTLCache(unittest.TestCase):
+
+    def setUp(self):
+        self.loader = MagicMock(side_effect=[['first'], ['second']])
+        self.cache = TTLCache(self.loader)
+
+    def test_get_fresh(self, mock_time):
+        mock_time.monotonic.side_effect = [0, 5]
+
+        value, etag = self.cache.get(10, 60)
+        cached_value, cached_etag = self.cache.get(10, 60)
+
+        self.assertEqual(value, ['first'])
+        self.assertEqual((cached_value, cached_etag), (value, etag))
+        self.loader.assert_called_once()
+
+    @patch('verification_api.utilities.cache.submit')
+    def test_get_stale(self, mock_submit, mock_time):
+        mock_time.monotonic.side_effect = [0, 20, 21]
+
+        self.cache.get(10, 60)
+        value, _ = self.cache.get(10, 60)
+        self.cache.get(10, 60)
+
+        # The stale value is served and only one refresh is started
+        self.assertEqual(value, ['first'])
+        mock_submit.assert_called_once()
+        self.loader.assert_called_once()
+
+        refresh = mock_submit.call_args[0][0]
+        mock_time.monotonic.side_effect = [22]
+        refresh()
+        self.assertEqual(self.cache.entry['value'], ['second'])
+        self.assertFalse(self.cache.refreshing)
+
+    def test_get_expired(self, mock_time):
+        mock_time.monotonic.side_effect = [0, 100, 100, 100]
+
+        first_value, first_etag = self.cache.get(10, 60)
+        second_value, second_etag = self.cache.get(10, 60)
+
+        self.assertEqual(second_value, ['second'])
+        self.assertNotEqual(first_etag, second_etag)
+        self.assertEqual(self.loader.call_count, 2)
+
+    def test_get_single_flight(self, mock_time):
+        mock_time.monotonic.return_value = 0
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow_loader():
+            started.set()
+            release.wait(5)
+            return ['first']
+
+        loader = MagicMock(side_effect=slow_loader)
+        cache = TTLCache(loader)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.get(10, 60))) for _ in range(3)]
+        with app.app_context():
+            for thread in threads:
+                thread.start()
+            started.wait(5)
+            release.set()
+            for thread in threads:
+                thread.join(5)
+
+        loader.assert_called_once()
+        self.assertEqual([value for value, _ in results], [['first']] * 3)
@@ -0,0 +1,110 @@
+import json
+import unittest
+from unittest.mock import patch, MagicMock
+
+from verification_api.main import app
+from verification_api.utilities.catalogue import Catalogue
+
+
+class StopListening(Exception):
+    pass
+
+
+@patch('verification_api.utilities.catalogue.Catalogue._start')
+class TestCatalogue(unittest.TestCase):
+
+    def setUp(self):
+        self.loader = MagicMock(side_effect=[['first'], ['second'], ['third']])
+        self.catalogue = Catalogue('test_changed', self.loader)
+
+    def test_get_not_listening(self, *_):
+        first_body, first_etag = self.catalogue.get()
+        second_body, second_etag = self.catalogue.get()
+
+        # Without a listener every call goes to the loader
+        self.assertEqual(json.loads(first_body), ['first'])
+        self.assertEqual(json.loads(second_body), ['second'])
+        self.assertNotEqual(first_etag, second_etag)
+
+    def test_get_listening(self, *_):
+        self.catalogue._set_listening(True)
+
+        first = self.catalogue.get()
+        second = self.catalogue.get()
+
+        self.assertEqual(first, second)
+        self.loader.assert_called_once()
+
+    def test_get_after_invalidate(self, *_):
+        self.catalogue._set_listening(True)
+
+        self.catalogue.get()
+        self.catalogue.invalidate()
+        body, _ = self.catalogue.get()
+
+        self.assertEqual(json.loads(body), ['second'])
+
+    def test_get_invalidated_while_loading(self, *_):
+        self.catalogue._set_listening(True)
+
+        results = [['first'], ['second']]
+
+        def load_and_change():
+            if len(results) == 2:
+                self.catalogue.invalidate()
+            return results.pop(0)
+
+        self.loader.side_effect = load_and_change
+
+        first_body, _ = self.catalogue.get()
+        second_body, _ = self.catalogue.get()
+
+        # The first load may have missed the change, so it's returned but not kept
+        self.assertEqual(json.loads(first_body), ['first'])
+        self.assertEqual(json.loads(second_body), ['second'])
+
+
+@patch('verification_api.utilities.catalogue.time.sleep', side_effect=StopListening)
+@patch('verification_api.utilities.catalogue.select')
+@patch('verification_api.utilities.catalogue.db')
+class TestCatalogueListener(unittest.TestCase):
+
+    def setUp(self):
+        self.catalogue = Catalogue('test_changed', MagicMock())
+
+    def test_listen_notified(self, mock_db, mock_select, *_):
+        connection = mock_db.engine.raw_connection.return_value.connection
+        connection.closed = False
+        connection.notifies = ['notification']
+        mock_select.select.side_effect = [([connection], [], []), StopListening]
+
+        with patch.object(self.catalogue, 'invalidate') as mock_invalidate:
+            with self.assertRaises(StopListening):
+                self.catalogue._listen(app)
+
+        cursor = connection.cursor.return_value
+        cursor.execute.assert_called_once_with('LISTEN test_changed')
+        mock_invalidate.assert_called_once()
+        self.assertEqual(connection.notifies, [])
+        mock_db.engine.raw_connection.return_value.detach.assert_called_once()
+        connection.close.assert_called_once()
+        self.assertFalse(self.catalogue.listening)
+
+    def test_listen_heartbeat(self, mock_db, mock_select, *_):
+        connection = mock_db.engine.raw_connection.return_value.connection
+        connection.notifies = []
+        mock_select.select.side_effect = [([], [], []), StopListening]
+
+        with self.assertRaises(StopListening):
+            self.catalogue._listen(app)
+
+        connection.cursor.return_value.execute.assert_called_with('SELECT 1')
+
+    def test_no_listener_behind_pgbouncer(self, *_):
+        with app.app_context(), patch.dict(app.config, {'SQL_USE_PGBOUNCER': True}), \
+                patch('verification_api.utilities.catalogue.threading.Thread') as mock_thread:
+            self.catalogue._start()
+            self.catalogue._start()
+
+        mock_thread.assert_not_called()
+        self.assertFalse(self.catalogue.listening)
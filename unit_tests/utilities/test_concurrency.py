@@ -0,0 +1,58 @@
+import threading
+import unittest
+from unittest.mock import patch
+from flask import g
+
+from verification_api.main import app
+from verification_api.exceptions import ApplicationError
+from verification_api.utilities import concurrency
+from verification_api.utilities.concurrency import run_concurrently, submit
+
+
+class TestConcurrency(unittest.TestCase):
+
+    def test_run_concurrently(self):
+        with app.test_request_context():
+            g.trace_id = 'abc123'
+            g.requests = 'session'
+            result = run_concurrently({
+                'first': lambda: (g.trace_id, g.requests),
+                'second': lambda: threading.current_thread().name
+            })
+
+        self.assertEqual(result['first'], ('abc123', 'session'))
+        self.assertNotEqual(result['second'], threading.current_thread().name)
+
+    def test_run_concurrently_overlaps(self):
+        # Both calls have to be running at the same time for either to get past the barrier
+        barrier = threading.Barrier(2, timeout=5)
+        with app.test_request_context():
+            result = run_concurrently({'first': barrier.wait, 'second': barrier.wait})
+
+        self.assertEqual(sorted(result.values()), [0, 1])
+
+    def test_run_concurrently_error(self):
+        def fail():
+            raise ApplicationError('Test error', 'E100')
+
+        with app.test_request_context():
+            with self.assertRaises(ApplicationError) as context:
+                run_concurrently({'ok': lambda: True, 'fail': fail})
+
+        self.assertEqual(context.exception.message, 'Test error')
+
+    def test_submit_pool_per_setting(self):
+        # A call on a busy pool doesn't hold up one on another
+        finished = threading.Event()
+        try:
+            with patch.dict(app.config, {'TEST_WORKERS': 1}), app.test_request_context():
+                blocked = submit(lambda: finished.wait(5), workers='TEST_WORKERS')
+                queued = submit(lambda: 'queued', workers='TEST_WORKERS')
+                self.assertEqual(submit(lambda: 'free').result(timeout=2), 'free')
+                self.assertFalse(queued.done())
+        finally:
+            finished.set()
+            concurrency._executors.pop('TEST_WORKERS').shutdown()
+
+        self.assertTrue(blocked.result())
+        self.assertEqual(queued.result(), 'queued')
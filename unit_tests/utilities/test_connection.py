@@ -0,0 +1,70 @@
+import unittest
+from unittest.mock import patch, MagicMock
+from sqlalchemy.exc import TimeoutError
+
+from verification_api.main import app
+from verification_api.utilities import connection
+
+
+@patch('verification_api.utilities.connection.psycopg2.connect')
+class TestConnection(unittest.TestCase):
+
+    def setUp(self):
+        connection._pool = None
+
+    def tearDown(self):
+        connection._pool = None
+
+    def test_transaction_commits(self, mock_connect):
+        with connection.transaction() as cursor:
+            cursor.execute('SELECT 1')
+
+        raw_connection = mock_connect.return_value
+        raw_connection.cursor.return_value.__enter__.return_value.execute.assert_called_once_with('SELECT 1')
+        raw_connection.commit.assert_called_once()
+        raw_connection.close.assert_not_called()
+
+    def test_connections_configured_as_engine(self, mock_connect):
+        with connection.transaction():
+            pass
+
+        connect_args = mock_connect.call_args[1]
+        self.assertEqual(connect_args['application_name'], app.config['APP_NAME'])
+        self.assertEqual(connect_args, app.config['SQLALCHEMY_ENGINE_OPTIONS']['connect_args'])
+
+    def test_transaction_rolls_back_on_error(self, mock_connect):
+        with self.assertRaises(ValueError):
+            with connection.transaction():
+                raise ValueError('failed')
+
+        mock_connect.return_value.commit.assert_not_called()
+        mock_connect.return_value.rollback.assert_called()
+
+    def test_transaction_reuses_connection(self, mock_connect):
+        with connection.transaction():
+            pass
+        with connection.transaction():
+            pass
+
+        mock_connect.assert_called_once()
+
+    def test_connect_and_complete_reuses_connection(self, mock_connect):
+        mock_connect.return_value.cursor.return_value.connection = mock_connect.return_value
+
+        cursor = connection.connect()
+        connection.complete(cursor)
+        cursor = connection.connect()
+        connection.rollback(cursor)
+
+        mock_connect.assert_called_once()
+        mock_connect.return_value.commit.assert_called_once()
+        mock_connect.return_value.close.assert_not_called()
+        self.assertEqual(connection._checked_out, {})
+
+    def test_pool_timeout(self, mock_connect):
+        mock_connect.side_effect = lambda *_, **__: MagicMock()
+        config = {'RAW_SQL_POOL_SIZE': 1, 'RAW_SQL_MAX_OVERFLOW': 0, 'RAW_SQL_POOL_TIMEOUT': 0.1}
+        with patch.dict(app.config, config), connection.transaction():
+            with self.assertRaises(TimeoutError):
+                with connection.transaction():
+                    pass
@@ -0,0 +1,119 @@
+import unittest
+from unittest.mock import patch, MagicMock
+from flask import jsonify
+from common_utilities import errors
+
+from verification_api.main import app
+from verification_api.exceptions import ApplicationError
+from verification_api.utilities.idempotency import idempotent
+
+
+@patch('verification_api.utilities.idempotency.unit_of_work')
+@patch('verification_api.utilities.idempotency.service')
+class TestIdempotency(unittest.TestCase):
+
+    def setUp(self):
+        self.view = MagicMock(side_effect=lambda *_: (jsonify(status_updated=True), 200))
+        self.headers = {'Idempotency-Key': 'abc123'}
+
+    def test_no_key(self, mock_service, mock_unit_of_work):
+        with app.test_request_context(method='POST', json={}):
+            app.preprocess_request()
+            response = idempotent(self.view)()
+
+        self.view.assert_called_once()
+        mock_service.claim_idempotency_key.assert_not_called()
+        self.assertEqual(response[1], 200)
+
+    def test_first_request(self, mock_service, mock_unit_of_work):
+        mock_service.claim_idempotency_key.return_value = None
+        with app.test_request_context('/v1/case/1/approve', method='POST', json={'staff_id': 'LRTM101'},
+                                      headers=self.headers):
+            app.preprocess_request()
+            response = idempotent(self.view)('1')
+            # Not stored until the view's work has been committed
+            mock_service.save_idempotent_response.assert_not_called()
+            mock_unit_of_work.on_complete.call_args[0][0](response)
+
+        self.view.assert_called_once_with('1')
+        key, request_hash = mock_service.claim_idempotency_key.call_args[0]
+        self.assertEqual(key, 'abc123')
+        self.assertEqual(len(request_hash), 64)
+        mock_service.save_idempotent_response.assert_called_once_with('abc123', 200, {'status_updated': True}, {})
+        mock_service.release_idempotency_key.assert_not_called()
+        self.assertNotIn('Idempotent-Replayed', response.headers)
+
+    def test_headers_saved(self, mock_service, mock_unit_of_work):
+        def view():
+            response = jsonify(updated=True, version=2)
+            response.set_etag('2')
+            response.headers['Cache-Control'] = 'no-store'
+            return response
+
+        mock_service.claim_idempotency_key.return_value = None
+        with app.test_request_context(method='POST', json={}, headers=self.headers):
+            app.preprocess_request()
+            response = idempotent(view)()
+            mock_unit_of_work.on_complete.call_args[0][0](response)
+
+        mock_service.save_idempotent_response.assert_called_once_with('abc123', 200, {'updated': True, 'version': 2},
+                                                                      {'ETag': '"2"'})
+
+    def test_commit_failed_released(self, mock_service, mock_unit_of_work):
+        mock_service.claim_idempotency_key.return_value = None
+        with app.test_request_context(method='POST', json={}, headers=self.headers):
+            app.preprocess_request()
+            idempotent(self.view)()
+            failed = jsonify(error='Failed to commit')
+            failed.status_code = 500
+            mock_unit_of_work.on_complete.call_args[0][0](failed)
+
+        mock_service.save_idempotent_response.assert_not_called()
+        mock_service.release_idempotency_key.assert_called_once_with('abc123')
+
+    def test_replay(self, mock_service, mock_unit_of_work):
+        mock_service.claim_idempotency_key.return_value = (201, {'message': 'Note added for case 1'},
+                                                           {'ETag': '"2"', 'Location': '/v1/case/1'})
+        with app.test_request_context(method='POST', json={}, headers=self.headers):
+            app.preprocess_request()
+            response = idempotent(self.view)()
+
+        self.view.assert_not_called()
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.get_json(), {'message': 'Note added for case 1'})
+        self.assertEqual(response.headers['Idempotent-Replayed'], 'true')
+        self.assertEqual(response.headers['ETag'], '"2"')
+        self.assertEqual(response.headers['Location'], '/v1/case/1')
+
+    def test_in_progress(self, mock_service, mock_unit_of_work):
+        error_msg = 'A request with Idempotency-Key abc123 is already in progress'
+        mock_service.claim_idempotency_key.side_effect = ApplicationError(
+            *errors.get('verification_api', 'VERIFICATION_ERROR', filler=error_msg), http_code=409)
+        with app.test_request_context(method='POST', json={}, headers=self.headers):
+            app.preprocess_request()
+            response, status = idempotent(self.view)()
+
+        self.view.assert_not_called()
+        self.assertEqual(status, 409)
+
+    def test_server_error_released(self, mock_service, mock_unit_of_work):
+        mock_service.claim_idempotency_key.return_value = None
+        self.view.side_effect = lambda: (jsonify(error='Failed'), 500)
+        with app.test_request_context(method='POST', json={}, headers=self.headers):
+            app.preprocess_request()
+            response = idempotent(self.view)()
+            mock_unit_of_work.on_complete.call_args[0][0](response)
+
+        mock_service.save_idempotent_response.assert_not_called()
+        mock_service.release_idempotency_key.assert_called_once_with('abc123')
+
+    def test_exception_released(self, mock_service, mock_unit_of_work):
+        mock_service.claim_idempotency_key.return_value = None
+        self.view.side_effect = KeyError('staff_id')
+        with app.test_request_context(method='POST', json={}, headers=self.headers):
+            app.preprocess_request()
+            with self.assertRaises(KeyError):
+                idempotent(self.view)()
+
+        mock_service.release_idempotency_key.assert_called_once_with('abc123')
+        mock_unit_of_work.on_complete.assert_not_called()
@@ -17,8 +17,26 @@ COMMIT = os.environ['COMMIT']
 # each app in the cluster will have a unique name.
 APP_NAME = os.environ['APP_NAME']
 MAX_HEALTH_CASCADE = int(os.environ['MAX_HEALTH_CASCADE'])
+# How long in seconds the health cascade's database check result is reused for, and how long in milliseconds the
+# check can take before it's reported as failed
+HEALTH_DB_CACHE_TTL = int(os.environ['HEALTH_DB_CACHE_TTL'])
+HEALTH_DB_TIMEOUT = int(os.environ['HEALTH_DB_TIMEOUT'])
+# How long in seconds the health cascade waits for all its dependencies to answer, between them
+HEALTH_CASCADE_TIMEOUT = int(os.environ['HEALTH_CASCADE_TIMEOUT'])
+# Threads per worker for the health cascade to probe its dependencies on, apart from FAN_OUT_WORKERS
+HEALTH_CASCADE_WORKERS = int(os.environ['HEALTH_CASCADE_WORKERS'])
 DEFAULT_TIMEOUT = int(os.environ['DEFAULT_TIMEOUT'])
 
+# Connection pooling for calls to other APIs, per worker process. HTTP_POOL_CONNECTIONS is how many hosts to keep
+# a pool for, HTTP_POOL_MAXSIZE is how many connections to keep alive to each host.
+HTTP_POOL_CONNECTIONS = int(os.environ['HTTP_POOL_CONNECTIONS'])
+HTTP_POOL_MAXSIZE = int(os.environ['HTTP_POOL_MAXSIZE'])
+# Threads per worker for calling other APIs concurrently (e.g. for the full case details)
+FAN_OUT_WORKERS = int(os.environ['FAN_OUT_WORKERS'])
+# Where each worker process writes its /metrics figures for them to be added up across all of them (prometheus_client
+# reads this same variable itself)
+PROMETHEUS_MULTIPROC_DIR = os.environ['prometheus_multiproc_dir']
+
 # Following is an example of building the dependency structure used by the cascade route
 # SELF can be used to demonstrate how it works (i.e. it will call it's own casecade
 # route until MAX_HEALTH_CASCADE is hit)
@@ -38,7 +56,53 @@ else:
 
 SQLALCHEMY_DATABASE_URI = 'postgres://{0}:{1}@{2}/{3}'.format(FINAL_SQL_USERNAME, SQL_PASSWORD, SQL_HOST, SQL_DATABASE)
 SQLALCHEMY_TRACK_MODIFICATIONS = False  # Explicitly set this in order to remove warning on run
-SQLALCHEMY_POOL_RECYCLE = int(os.environ['SQLALCHEMY_POOL_RECYCLE'])
+# Set to 'yes' when connecting through PgBouncer in transaction pooling mode, where each transaction can get a
+# different server connection. Nothing that needs a session of its own is used then: the statement timeout has to be
+# set on the database role instead (startup options are refused), and the in-memory catalogues don't LISTEN for
+# changes, so they're loaded for every request.
+SQL_USE_PGBOUNCER = os.environ['SQL_USE_PGBOUNCER'] == 'yes'
+# How long in milliseconds a statement can run before Postgres cancels it
+SQL_STATEMENT_TIMEOUT = int(os.environ['SQL_STATEMENT_TIMEOUT'])
+# Connection pool per worker process: how many connections it keeps open, how many more it opens when they're all in
+# use, how long in seconds to wait for one before giving up and how old one can get before it's replaced. Pre-ping
+# checks a connection still works before handing it out, so connections left broken by a failover are replaced
+# rather than failing a request.
+SQLALCHEMY_ENGINE_OPTIONS = {
+    'pool_size': int(os.environ['SQL_POOL_SIZE']),
+    'max_overflow': int(os.environ['SQL_MAX_OVERFLOW']),
+    'pool_timeout': int(os.environ['SQL_POOL_TIMEOUT']),
+    'pool_recycle': int(os.environ['SQLALCHEMY_POOL_RECYCLE']),
+    'pool_pre_ping': os.environ['SQL_POOL_PRE_PING'] == 'yes',
+    'connect_args': {'application_name': APP_NAME}
+}
+if not SQL_USE_PGBOUNCER:
+    SQLALCHEMY_ENGINE_OPTIONS['connect_args']['options'] = '-c statement_timeout={}'.format(SQL_STATEMENT_TIMEOUT)
+# How often in seconds the in-memory catalogues (e.g. decline reasons) check their change notification connection is
+# still alive when idle, and wait before reconnecting it
+CATALOGUE_HEARTBEAT_INTERVAL = int(os.environ['CATALOGUE_HEARTBEAT_INTERVAL'])
+# The pool of connections utilities/connection uses for raw SQL, per worker process: how many it keeps open, how many
+# more it opens when they're all in use, and how long in seconds to wait for one before giving up
+RAW_SQL_POOL_SIZE = int(os.environ['RAW_SQL_POOL_SIZE'])
+RAW_SQL_MAX_OVERFLOW = int(os.environ['RAW_SQL_MAX_OVERFLOW'])
+RAW_SQL_POOL_TIMEOUT = int(os.environ['RAW_SQL_POOL_TIMEOUT'])
+
+# Paging - the largest page a client may ask for, and how many rows a streamed response fetches per round trip
+MAX_PAGE_SIZE = int(os.environ['MAX_PAGE_SIZE'])
+STREAM_BATCH_SIZE = int(os.environ['STREAM_BATCH_SIZE'])
+# How many cases POST /cases/bulk inserts per statement
+BULK_INSERT_BATCH_SIZE = int(os.environ['BULK_INSERT_BATCH_SIZE'])
+# How many cases the bulk approve, decline and close endpoints act on per statement (the account-api calls for a
+# batch are made FAN_OUT_WORKERS at a time)
+BULK_ACTION_BATCH_SIZE = int(os.environ['BULK_ACTION_BATCH_SIZE'])
+
+# How long in seconds a caseworker's lock on a case lasts unless they renew it
+CASE_LOCK_LEASE = int(os.environ['CASE_LOCK_LEASE'])
+
+# How long in seconds the response to a request with an Idempotency-Key is kept to replay if it's retried
+IDEMPOTENCY_KEY_TTL = int(os.environ['IDEMPOTENCY_KEY_TTL'])
+# How long in seconds a request with an Idempotency-Key can be in progress before a retry of it may take the key over
+# (its worker having died before it could release it). Must be longer than any request takes.
+IDEMPOTENCY_KEY_IN_PROGRESS_TIMEOUT = int(os.environ['IDEMPOTENCY_KEY_IN_PROGRESS_TIMEOUT'])
 
 # Account
 ACCOUNT_API_URL = os.environ['ACCOUNT_API_URL']
@@ -51,6 +115,10 @@ AUDIT_API_VERSION = os.environ['AUDIT_API_VERSION']
 
 # Ulapd-api
 ULAPD_API_URL = os.environ['ULAPD_API_URL']
+# How long in seconds the dataset list is cached for, and for how long after that a stale copy can be served while
+# it's refreshed
+DATASET_LIST_CACHE_TTL = int(os.environ['DATASET_LIST_CACHE_TTL'])
+DATASET_LIST_STALE_TTL = int(os.environ['DATASET_LIST_STALE_TTL'])
 
 # Akuma
 AKUMA_API_URL = os.environ['AKUMA_API_URL']
@@ -59,6 +127,15 @@ AKUMA_RETRY = os.environ['AKUMA_RETRY']
 # Metric
 METRIC_API_URL = os.environ['METRIC_API_URL']
 METRIC_RETRY = os.environ['METRIC_RETRY']
+# Events are queued and sent by a background thread in each worker. METRIC_BACKOFF is the delay in seconds before
+# the first retry, doubling for each one after.
+METRIC_QUEUE_SIZE = int(os.environ['METRIC_QUEUE_SIZE'])
+METRIC_BATCH_SIZE = int(os.environ['METRIC_BATCH_SIZE'])
+METRIC_BACKOFF = float(os.environ['METRIC_BACKOFF'])
+# Events that must not be lost go through the metric_outbox table instead, which 'manage.py drain_metrics' sends
+# METRIC_OUTBOX_BATCH_SIZE rows at a time, waiting METRIC_OUTBOX_INTERVAL seconds between polls when idle
+METRIC_OUTBOX_BATCH_SIZE = int(os.environ['METRIC_OUTBOX_BATCH_SIZE'])
+METRIC_OUTBOX_INTERVAL = float(os.environ['METRIC_OUTBOX_INTERVAL'])
 
 DEPENDENCIES = {
     "Postgres": SQLALCHEMY_DATABASE_URI,
@@ -2,6 +2,8 @@ import logging
 
 from flask import ctx, g
 
+from .query_stats import get_query_stats
+
 
 class ContextualFilter(logging.Filter):
     def filter(self, log_record):
@@ -13,4 +15,9 @@ class ContextualFilter(logging.Filter):
             log_record.trace_id = g.trace_id
         else:
             log_record.trace_id = 'N/A'
+
+        # The database work the request has done so far
+        if ctx.has_request_context():
+            log_record.sql_queries, sql_time = get_query_stats()
+            log_record.sql_time_ms = round(sql_time * 1000, 3)
         return True
@@ -19,4 +19,8 @@ class JsonFormatter(logging.Formatter):
              ('message', record.msg % record.args),
              ('exception', exc)])
 
+        if hasattr(record, 'sql_queries'):
+            log_entry['sql_queries'] = record.sql_queries
+            log_entry['sql_time_ms'] = record.sql_time_ms
+
         return json.dumps(log_entry, separators=(',', ':'))
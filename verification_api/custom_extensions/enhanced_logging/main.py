@@ -1,31 +1,88 @@
+import threading
+import time
 import uuid
+from http.cookiejar import DefaultCookiePolicy
 from pathlib import Path
 
 import requests
 from flask import current_app, g, request
 from flask_logconfig import LogConfig
+from requests.adapters import HTTPAdapter
+
+from verification_api.custom_extensions.prometheus import main as prometheus
+from .query_stats import get_query_stats, listen
+
+# One session per worker process, shared by every request it handles, so connections to other APIs are kept alive
+# and reused rather than set up again for each incoming request. It's created on first use so that each gunicorn
+# worker builds its own after forking.
+_session = None
+_session_lock = threading.Lock()
 
 
 class RequestsSessionTimeout(requests.Session):
     """Custom requests session class to set some defaults on g.requests"""
-    def request(self, *args, **kwargs):
+    def request(self, method, url, *args, **kwargs):
         # Set a default timeout for the request.
         # Can be overridden in the same way that you would normally set a timeout
         # i.e. g.requests.get(timeout=5)
         if not kwargs.get('timeout'):
             kwargs['timeout'] = current_app.config['DEFAULT_TIMEOUT']
 
-        return super(RequestsSessionTimeout, self).request(*args, **kwargs)
+        # The session is shared between incoming requests, so the trace id has to be added to each call rather
+        # than to the session's headers
+        if g.get('trace_id'):
+            headers = dict(kwargs.get('headers') or {})
+            headers.setdefault('X-Trace-ID', g.trace_id)
+            kwargs['headers'] = headers
+
+        # Every call to another API goes through here, so this is where they're timed for /metrics
+        start = time.perf_counter()
+        failed = True
+        try:
+            response = super(RequestsSessionTimeout, self).request(method, url, *args, **kwargs)
+            failed = response.status_code >= 400
+            return response
+        finally:
+            prometheus.record_dependency_call(prometheus.get_dependency_name(url), time.perf_counter() - start, failed)
+
+
+def get_session():
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = RequestsSessionTimeout()
+                adapter = HTTPAdapter(pool_connections=current_app.config['HTTP_POOL_CONNECTIONS'],
+                                      pool_maxsize=current_app.config['HTTP_POOL_MAXSIZE'])
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                # Cookies one API sets for one caller would otherwise be sent on every later call from the worker
+                session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+                _session = session
+    return _session
 
 
 def before_request():
     # Sets the transaction trace id on the global object if provided in the HTTP header from the caller.
     # Generate a new one if it has not. We will use this in log messages.
     g.trace_id = request.headers.get('X-Trace-ID', uuid.uuid4().hex)
-    # We also create a session-level requests object for the app to use with the header pre-set, so other APIs
-    # will receive it. These lines can be removed if the app will not make requests to other LR APIs!
-    g.requests = RequestsSessionTimeout()
-    g.requests.headers.update({'X-Trace-ID': g.trace_id})
+    g.request_start_time = time.perf_counter()
+    # We also make the worker's shared requests session available to the app. It adds the trace id header to every
+    # call, so other APIs will receive it. These lines can be removed if the app will not make requests to other
+    # LR APIs!
+    g.requests = get_session()
+
+
+def after_request(response):
+    # Reports the database time the request took, and how many statements it ran, in a Server-Timing header and an
+    # access log entry, so a request that has started making a query per row stands out. A streamed response is
+    # still running its queries at this point, so only those made before it started are counted.
+    queries, sql_time = get_query_stats()
+    duration = time.perf_counter() - g.get('request_start_time', time.perf_counter())
+    response.headers.add('Server-Timing', 'db;desc="{} queries";dur={:.3f}'.format(queries, sql_time * 1000))
+    response.headers.add('Server-Timing', 'total;dur={:.3f}'.format(duration * 1000))
+    current_app.logger.info('%s %s %s %.3fms', request.method, request.path, response.status_code, duration * 1000)
+    return response
 
 
 class EnhancedLogging(object):
@@ -38,6 +95,9 @@ class EnhancedLogging(object):
     def init_app(self, app):
         # Ensure that the traceid is parsed/propagated on every request
         app.before_request(before_request)
+        # Count the SQL statements each request runs and time them
+        listen()
+        app.after_request(after_request)
 
         # Let's get the app's base package name so we can set the correct formatter, filter and logger names
         app_module_name = Path(__file__).resolve().parents[2].parts[-1]
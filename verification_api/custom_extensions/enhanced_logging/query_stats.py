@@ -0,0 +1,28 @@
+import time
+
+from flask import g, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context.query_start_time = time.perf_counter()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # Only counted against the request on whose thread the statement ran
+    if has_request_context():
+        g.sql_queries = g.get('sql_queries', 0) + 1
+        g.sql_time = g.get('sql_time', 0.0) + time.perf_counter() - context.query_start_time
+
+
+def listen():
+    # Listens on every engine, so it doesn't matter when Flask-SQLAlchemy gets round to creating the app's
+    if not event.contains(Engine, 'before_cursor_execute', before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+
+
+def get_query_stats():
+    """Returns how many SQL statements the current request has run and how long they took in seconds"""
+    return g.get('sql_queries', 0), g.get('sql_time', 0.0)
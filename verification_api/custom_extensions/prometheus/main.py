@@ -0,0 +1,124 @@
+import os
+import time
+
+from flask import current_app, g, request
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+
+# Each worker process writes its metrics to its own files in PROMETHEUS_MULTIPROC_DIR, and /metrics adds them up
+# across all of them. They're created by init_app, as the files are opened as soon as a metric is, so the directory
+# has to exist first. The gunicorn config marks each worker's files dead when it exits.
+REQUEST_LATENCY = None
+REQUESTS_IN_FLIGHT = None
+DEPENDENCY_LATENCY = None
+DEPENDENCY_ERRORS = None
+POOL_CHECKOUT_WAIT = None
+
+
+class TimedQueuePool(QueuePool):
+    """The default pool, but recording how long each checkout has to wait for a connection"""
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super(TimedQueuePool, self)._do_get()
+        finally:
+            POOL_CHECKOUT_WAIT.observe(time.perf_counter() - start)
+
+
+def get_dependency_name(url):
+    """Which of the APIs we call a URL belongs to, to label its metrics with"""
+    for name, config_key in (('AccountAPI', 'ACCOUNT_API_URL'), ('UlapdAPI', 'ULAPD_API_URL'),
+                             ('MetricAPI', 'METRIC_API_URL')):
+        if url.startswith(current_app.config[config_key]):
+            return name
+    return 'other'
+
+
+def record_dependency_call(dependency, duration, failed):
+    DEPENDENCY_LATENCY.labels(dependency).observe(duration)
+    if failed:
+        DEPENDENCY_ERRORS.labels(dependency).inc()
+
+
+def generate_metrics():
+    """Returns the metrics in the Prometheus text format, added up across every worker process"""
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry, path=current_app.config['PROMETHEUS_MULTIPROC_DIR'])
+    return generate_latest(registry)
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context.prometheus_start_time = time.perf_counter()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    record_dependency_call('Postgres', time.perf_counter() - context.prometheus_start_time, False)
+
+
+def handle_error(exception_context):
+    DEPENDENCY_ERRORS.labels('Postgres').inc()
+
+
+def before_request():
+    REQUESTS_IN_FLIGHT.inc()
+    g.prometheus_start_time = time.perf_counter()
+
+
+def after_request(response):
+    if 'prometheus_start_time' in g:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        REQUEST_LATENCY.labels(request.method, route, response.status_code) \
+            .observe(time.perf_counter() - g.prometheus_start_time)
+    return response
+
+
+def teardown_request(exception):
+    if g.pop('prometheus_start_time', None) is not None:
+        REQUESTS_IN_FLIGHT.dec()
+
+
+def _create_metrics():
+    global REQUEST_LATENCY, REQUESTS_IN_FLIGHT, DEPENDENCY_LATENCY, DEPENDENCY_ERRORS, POOL_CHECKOUT_WAIT
+    if REQUEST_LATENCY is not None:
+        return
+    REQUEST_LATENCY = Histogram('http_request_duration_seconds',
+                                'Time taken to handle requests, by route (its count is the number of requests)',
+                                ['method', 'route', 'status'])
+    REQUESTS_IN_FLIGHT = Gauge('http_requests_in_flight', 'Requests currently being handled',
+                               multiprocess_mode='livesum')
+    DEPENDENCY_LATENCY = Histogram('dependency_call_duration_seconds',
+                                   'Time taken by calls to other APIs and statements run on the database',
+                                   ['dependency'])
+    DEPENDENCY_ERRORS = Counter('dependency_call_errors_total',
+                                'Calls to other APIs and statements run on the database that failed', ['dependency'])
+    POOL_CHECKOUT_WAIT = Histogram('db_pool_checkout_seconds',
+                                   'Time taken to get a connection from the database pool, including opening a new '
+                                   'one')
+
+
+class PrometheusMetrics(object):
+
+    def __init__(self, app=None):
+        self.app = app
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        os.makedirs(app.config['PROMETHEUS_MULTIPROC_DIR'], exist_ok=True)
+        _create_metrics()
+
+        # Read by Flask-SQLAlchemy when it creates the engine, unless a pool class has already been chosen
+        app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', {}).setdefault('poolclass', TimedQueuePool)
+
+        # Listens on every engine, so it doesn't matter when Flask-SQLAlchemy gets round to creating the app's
+        if not event.contains(Engine, 'before_cursor_execute', before_cursor_execute):
+            event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+            event.listen(Engine, 'handle_error', handle_error)
+
+        app.before_request(before_request)
+        app.after_request(after_request)
+        app.teardown_request(teardown_request)
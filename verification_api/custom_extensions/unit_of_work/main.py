@@ -0,0 +1,58 @@
+from flask import current_app, g, jsonify
+from sqlalchemy.exc import SQLAlchemyError
+from common_utilities import errors
+from verification_api.exceptions import ApplicationError
+
+
+class UnitOfWork(object):
+    """One database session, and where possible one transaction, per request.
+
+    Service functions share the request's session rather than each closing it when they're done, so the reads a
+    request makes don't each check a connection out of the pool and reset it. Whatever is still pending when the view
+    returns is committed, unless the response is a server error, and the session is rolled back and removed when the
+    request is torn down. Services that need their changes seen straight away (e.g. before calling another API) still
+    commit them as they go.
+    """
+
+    def __init__(self, db, app=None):
+        self.db = db
+        self.app = app
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.after_request(self.commit)
+        app.teardown_request(self.remove)
+
+    def on_complete(self, callback):
+        """Have callback called with the response once the request's work has been committed.
+
+        If the commit fails, or isn't made because the response is a server error, it's called with the error
+        response instead, so it can tell from the status code whether the work was kept.
+        """
+        g.setdefault('unit_of_work_callbacks', []).append(callback)
+
+    def commit(self, response):
+        if response.status_code < 500:
+            response = self._commit(response)
+        for callback in g.pop('unit_of_work_callbacks', []):
+            callback(response)
+        return response
+
+    def _commit(self, response):
+        try:
+            # Doesn't touch the database if the request hasn't
+            self.db.session.commit()
+        except SQLAlchemyError as error:
+            current_app.logger.error('Failed to commit request - {}'.format(str(error)))
+            self.db.session.rollback()
+            error = ApplicationError(*errors.get('verification_api', 'SQLALCHEMY_ERROR', filler=str(error)),
+                                     http_code=500)
+            response = jsonify(error=error.message)
+            response.status_code = error.http_code
+        return response
+
+    def remove(self, exception):
+        if exception is not None:
+            self.db.session.rollback()
+        self.db.session.remove()
@@ -1,6 +1,13 @@
+import os
+import queue
+import threading
+import time
 from flask import current_app, g
 from verification_api.app import app
 from verification_api.exceptions import ApplicationError
+from verification_api.custom_extensions.enhanced_logging.main import get_session
+from verification_api.extensions import db
+from verification_api.models import MetricOutbox
 from common_utilities import errors
 import requests
 
@@ -36,29 +43,122 @@ class MetricAPI(object):
             return {'message': 'event added'}
 
 
-def insert_metric_event(activity, data):
-    try:
-        data.update(data['registration_data'])
-        data.pop('registration_data')
-        data['activity_type'] = activity
+class MetricDispatcher(object):
+    """Sends metric events to dps-metric-api from a background thread, so requests only have to queue them.
 
-        payload = _create_metric_payload(data)
-        event = MetricAPI()
+    Each worker process gets its own bounded queue and thread, started when it queues its first event. The thread
+    takes up to METRIC_BATCH_SIZE events off the queue at a time and sends them back to back, retrying each with
+    exponential backoff. If the queue is full the new event is logged and dropped rather than holding up the request.
+    """
+
+    def __init__(self):
+        self.queue = None
+        self.pid = None
+        self.lock = threading.Lock()
 
-        metric_retries = int(current_app.config["METRIC_RETRY"])
-        for attempts in range(metric_retries):
+    def enqueue(self, payload):
+        self._start()
+        try:
+            self.queue.put_nowait((g.get('trace_id'), payload))
+        except queue.Full:
+            app.logger.error('Metric queue full, dropping event: {}'.format(payload))
+
+    def _start(self):
+        with self.lock:
+            # Checking the pid means a worker forked from a process that had already started a thread
+            # gets its own rather than queueing events nothing will ever send
+            if self.pid != os.getpid():
+                self.queue = queue.Queue(maxsize=current_app.config['METRIC_QUEUE_SIZE'])
+                thread = threading.Thread(target=self._run, args=(current_app._get_current_object(),), daemon=True)
+                thread.start()
+                self.pid = os.getpid()
+
+    def _run(self, flask_app):
+        while True:
+            batch = self._next_batch(flask_app.config['METRIC_BATCH_SIZE'])
             try:
-                app.logger.info('Attempt {} to call Metric API'.format(attempts))
-                event.add_event(payload)
-                app.logger.info('Call to Metric API successful')
-                break
+                with flask_app.app_context():
+                    send_metric_events(batch)
             except Exception as e:
-                app.logger.error('Call to Metric API failed on attempt {} with error: {}'.format(attempts, e))
+                flask_app.logger.error('Failed to send batch of {} metric events: {}'.format(len(batch), e))
+
+    def _next_batch(self, batch_size):
+        # Block until there's something to send, then take whatever else is already waiting
+        batch = [self.queue.get()]
+        while len(batch) < batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+
+dispatcher = MetricDispatcher()
+
+
+def insert_metric_event(activity, data):
+    try:
+        payload = _build_metric_payload(activity, data)
+        dispatcher.enqueue(payload)
     except ApplicationError as error:
         app.logger.error('Verification-api failed calling Metric API with error: {}'.format(str(error)))
         app.logger.info(activity, data)
 
 
+def add_metric_event_to_outbox(activity, data):
+    """Add an event to the metric outbox in the current transaction. Nothing is sent until it has been committed."""
+    payload = _build_metric_payload(activity, data)
+    db.session.add(MetricOutbox(payload, g.get('trace_id')))
+
+
+def add_metric_events_to_outbox(activity, data_list):
+    """Add an event for each item in data_list to the metric outbox in the current transaction, in one INSERT."""
+    payloads = [_build_metric_payload(activity, data) for data in data_list]
+    if payloads:
+        MetricOutbox.add_many(payloads, g.get('trace_id'))
+
+
+def drain_metric_outbox(batch_size):
+    """Send a batch of events from the metric outbox, removing those that were sent. Returns how many were sent.
+
+    If the metric API can't be reached the rest of the batch is left for the next attempt.
+    """
+    try:
+        g.requests = get_session()
+        event = MetricAPI()
+        sent_ids = []
+        for row in MetricOutbox.lock_batch(batch_size):
+            g.trace_id = row.trace_id
+            try:
+                event.add_event(row.payload)
+            except ApplicationError as error:
+                app.logger.error('Failed to send metric event {} from outbox: {}'.format(row.outbox_id, error.message))
+                break
+            sent_ids.append(row.outbox_id)
+
+        if sent_ids:
+            MetricOutbox.remove(sent_ids)
+        db.session.commit()
+        return len(sent_ids)
+    except Exception:
+        db.session.rollback()
+        raise
+    finally:
+        db.session.close()
+
+
+def send_metric_events(events):
+    """Send (trace_id, payload) pairs to dps-metric-api. Needs an app context, but not a request."""
+    g.requests = get_session()
+    event = MetricAPI()
+    sent = 0
+    for trace_id, payload in events:
+        g.trace_id = trace_id
+        if _send_with_backoff(event, payload):
+            sent += 1
+    return sent
+
+
 def handle_dataset_access_metrics(case_details, updated_access):
     for licence in updated_access['licences']:
         data = {}
@@ -68,6 +168,30 @@ def handle_dataset_access_metrics(case_details, updated_access):
         insert_metric_event(activity, data)
 
 
+def _build_metric_payload(activity, data):
+    data.update(data['registration_data'])
+    data.pop('registration_data')
+    data['activity_type'] = activity
+    return _create_metric_payload(data)
+
+
+def _send_with_backoff(event, payload):
+    metric_retries = int(current_app.config["METRIC_RETRY"])
+    for attempts in range(metric_retries):
+        try:
+            app.logger.info('Attempt {} to call Metric API'.format(attempts))
+            event.add_event(payload)
+            app.logger.info('Call to Metric API successful')
+            return True
+        except Exception as e:
+            app.logger.error('Call to Metric API failed on attempt {} with error: {}'.format(attempts, e))
+            if attempts + 1 < metric_retries:
+                time.sleep(current_app.config['METRIC_BACKOFF'] * 2 ** attempts)
+
+    app.logger.error('Giving up calling Metric API, event not sent: {}'.format(payload))
+    return False
+
+
 def _create_metric_payload(data):
     payload = {
         'user': {},
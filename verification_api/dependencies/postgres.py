@@ -1,20 +1,49 @@
+import math
+import threading
 from flask import current_app
-import psycopg2
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import SQLAlchemyError
 from verification_api.exceptions import ApplicationError
+from verification_api.utilities.cache import TTLCache
+
+# Load balancer health checks come in bursts, so they share one query for HEALTH_DB_CACHE_TTL seconds. Failures
+# aren't cached, but concurrent checks still wait for the one query rather than each making their own.
+_timestamp_cache = TTLCache(lambda: _query_current_timestamp())
+
+# The check's own connection, kept open between checks. It's separate from the app's pool so that it doesn't queue
+# for a connection behind requests when that pool is exhausted, which is just when the health check matters most. It's
+# created on first use so each gunicorn worker gets its own after forking.
+_engine = None
+_engine_lock = threading.Lock()
 
 
 def get_current_timestamp():
     try:
-        conn = psycopg2.connect(current_app.config['SQLALCHEMY_DATABASE_URI'])
-        cur = conn.cursor()
-        cur.execute("SELECT CURRENT_TIMESTAMP;")
-        result = cur.fetchone()
-        cur.close()
-        conn.close()
-        return result[0]
-    except psycopg2.DataError as e:
-        raise ApplicationError(
-            'Input data error: ' + str(e), 'DB', http_code=400)
-    except (psycopg2.OperationalError, psycopg2.ProgrammingError) as e:
+        timestamp, _ = _timestamp_cache.get(current_app.config['HEALTH_DB_CACHE_TTL'], 0)
+        return timestamp
+    except SQLAlchemyError as e:
         raise ApplicationError(
             'Database error: ' + str(e), 'DB', http_code=400)
+
+
+def _query_current_timestamp():
+    # Gives up after HEALTH_DB_TIMEOUT milliseconds rather than holding up the health check
+    with _get_engine().begin() as connection:
+        connection.execute(text("SELECT set_config('statement_timeout', :timeout, true)"),
+                           timeout=str(current_app.config['HEALTH_DB_TIMEOUT']))
+        return connection.execute(text('SELECT CURRENT_TIMESTAMP')).scalar()
+
+
+def _get_engine():
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                timeout = current_app.config['HEALTH_DB_TIMEOUT'] / 1000
+                engine_options = current_app.config['SQLALCHEMY_ENGINE_OPTIONS']
+                # Opening the connection is bounded too (libpq only takes whole seconds, and at least 2)
+                connect_args = dict(engine_options['connect_args'], connect_timeout=max(2, math.ceil(timeout)))
+                _engine = create_engine(current_app.config['SQLALCHEMY_DATABASE_URI'], pool_size=1, max_overflow=0,
+                                        pool_timeout=timeout, pool_pre_ping=True,
+                                        pool_recycle=engine_options['pool_recycle'], connect_args=connect_args)
+    return _engine
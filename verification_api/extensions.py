@@ -1,9 +1,13 @@
 from verification_api.custom_extensions.enhanced_logging.main import EnhancedLogging
+from verification_api.custom_extensions.prometheus.main import PrometheusMetrics
+from verification_api.custom_extensions.unit_of_work.main import UnitOfWork
 from flask_sqlalchemy import SQLAlchemy
 
 # Create empty extension objects here
 enhanced_logging = EnhancedLogging()
+prometheus_metrics = PrometheusMetrics()
 db = SQLAlchemy()
+unit_of_work = UnitOfWork(db)
 
 
 def register_extensions(app):
@@ -13,8 +17,15 @@ def register_extensions(app):
     # plus traceid parsing and propagation in a custom Requests Session)
     enhanced_logging.init_app(app)
 
+    # Request, dependency and database pool metrics for /metrics. Before the database so the engine it creates gets
+    # the timed pool.
+    prometheus_metrics.init_app(app)
+
     # Database
     db.init_app(app)
 
+    # One session per request, committed when the view returns and removed when the request is torn down
+    unit_of_work.init_app(app)
+
     # All done!
     app.logger.info("Extensions registered")
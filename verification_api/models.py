@@ -1,8 +1,13 @@
 import datetime
+import operator
+from functools import reduce
 from verification_api.extensions import db
-from sqlalchemy.dialects.postgresql import JSONB
-from sqlalchemy.orm import relationship
-from sqlalchemy import asc, desc
+from sqlalchemy.dialects.postgresql import JSONB, insert
+from sqlalchemy.orm import column_property, relationship
+from sqlalchemy import and_, asc, desc, exists, func, literal, literal_column, or_, select, tuple_
+
+# Cases that have been decided on and can no longer be locked
+RESOLVED_STATUSES = ('Approved', 'Declined')
 
 
 class Case(db.Model):
@@ -15,6 +20,9 @@ class Case(db.Model):
     date_added = db.Column(db.DateTime(timezone=True), default=datetime.datetime.utcnow)
     staff_id = db.Column(db.String, nullable=True)
     date_agreed = db.Column(db.DateTime(timezone=True), nullable=True)
+    version = db.Column(db.Integer, nullable=False)
+    # When the lock staff_id holds on a pending case runs out
+    locked_until = db.Column(db.DateTime(timezone=True), nullable=True)
     notes = relationship(
         'Note',
         cascade='all, delete, delete-orphan'
@@ -24,6 +32,12 @@ class Case(db.Model):
         cascade='all, delete, delete-orphan'
     )
 
+    # Every ORM update checks the version it read is still current and increments it, raising StaleDataError if
+    # someone else got there first. It's also the case's ETag.
+    __mapper_args__ = {
+        'version_id_col': version
+    }
+
     def __init__(self, user_data):
         self.user_id = user_data['user_id']
         self.ldap_id = user_data['ldap_id']
@@ -32,6 +46,20 @@ class Case(db.Model):
         self.staff_id = user_data.get('staff_id', None)
         self.date_agreed = None
 
+    @staticmethod
+    def insert_many(cases):
+        # Inserts the cases with a single multi-row INSERT, returning their ids in the same order
+        rows = [{
+            'user_id': user_data['user_id'],
+            'ldap_id': user_data['ldap_id'],
+            'registration_data': user_data['registration_data'],
+            'status': user_data['status'],
+            'staff_id': user_data.get('staff_id', None),
+            'version': 1
+        } for user_data in cases]
+        statement = Case.__table__.insert().values(rows).returning(Case.verification_id)
+        return [row.verification_id for row in db.session.execute(statement)]
+
     @staticmethod
     def get_case_by_id(case_id):
         return Case.query.filter_by(verification_id=case_id).first()
@@ -40,28 +68,144 @@ class Case(db.Model):
     def get_case_by_ldap_id(ldap_id):
         return Case.query.filter_by(ldap_id=ldap_id).first()
 
+    @staticmethod
+    def transition(case_id, staff_id, status):
+        # Resolves a case in one conditional UPDATE, so the check that it's still pending and locked to this
+        # caseworker can't race with anyone else's. Returns the updated case, or None if it didn't qualify.
+        statement = Case.__table__.update() \
+            .where(Case.verification_id == case_id) \
+            .where(Case.status == 'Pending') \
+            .where(Case.staff_id == staff_id) \
+            .values(status=status, date_agreed=datetime.datetime.utcnow(), locked_until=None,
+                    version=Case.version + 1) \
+            .returning(*Case.__table__.columns)
+        result = db.session.execute(statement)
+        return next(Case.query.populate_existing().instances(result), None)
+
+    @staticmethod
+    def lock_many(case_ids, status, staff_id=None):
+        # Row locks (until the commit) whichever of the cases have the status, and if given, are locked to staff_id.
+        # Anyone else acting on them waits, and then finds they no longer qualify.
+        query = Case.query.filter(Case.verification_id.in_(case_ids)).filter(Case.status == status)
+        if staff_id is not None:
+            query = query.filter(Case.staff_id == staff_id)
+        return query.with_for_update(of=Case).all()
+
+    @staticmethod
+    def update_many(case_ids, values):
+        # Sets the values on all the cases in a single UPDATE, returning the updated cases
+        statement = Case.__table__.update() \
+            .where(Case.verification_id.in_(case_ids)) \
+            .values(version=Case.version + 1, **values) \
+            .returning(*Case.__table__.columns)
+        return list(Case.query.populate_existing().instances(db.session.execute(statement)))
+
+    @staticmethod
+    def lock(case_id, staff_id, lease):
+        # Acquires a lock on the case for staff_id lasting for the lease (a timedelta), or renews it if they already
+        # hold it. Fails if anyone else holds an unexpired one. Returns when the lock runs out, or None if it failed.
+        # Lock bookkeeping leaves the version alone, so taking or renewing a lock doesn't change the case's ETag.
+        statement = Case.__table__.update() \
+            .where(Case.verification_id == case_id) \
+            .where(Case.status.notin_(RESOLVED_STATUSES)) \
+            .where(or_(Case.staff_id == staff_id, Case.locked_until.is_(None), Case.locked_until <= func.now())) \
+            .values(staff_id=staff_id, locked_until=func.now() + lease) \
+            .returning(Case.locked_until)
+        return db.session.execute(statement).scalar()
+
+    @staticmethod
+    def claim_next(staff_id, lease):
+        # Locks the oldest pending case that nobody holds a current lock on to staff_id, and returns it (or None
+        # if there isn't one). SKIP LOCKED means concurrent claims pass over the rows each other are taking rather
+        # than queueing behind them and then all failing on the same case. As with lock(), the version is left alone.
+        candidate = db.session.query(Case.verification_id) \
+            .filter(Case.status == 'Pending') \
+            .filter(or_(Case.locked_until.is_(None), Case.locked_until <= func.now())) \
+            .order_by(asc(Case.date_added), asc(Case.verification_id)) \
+            .limit(1) \
+            .with_for_update(skip_locked=True) \
+            .as_scalar()
+        statement = Case.__table__.update() \
+            .where(Case.verification_id == candidate) \
+            .values(staff_id=staff_id, locked_until=func.now() + lease) \
+            .returning(*Case.__table__.columns)
+        result = db.session.execute(statement)
+        return next(Case.query.populate_existing().instances(result), None)
+
+    @staticmethod
+    def unlock(case_id):
+        # Releases any lock on the case, leaving its version alone as lock() does. Returns None if the case doesn't
+        # exist or has been resolved.
+        statement = Case.__table__.update() \
+            .where(Case.verification_id == case_id) \
+            .where(Case.status.notin_(RESOLVED_STATUSES)) \
+            .values(staff_id=None, locked_until=None) \
+            .returning(Case.verification_id)
+        return db.session.execute(statement).scalar()
+
+    @staticmethod
+    def merge_registration_data(case_id, patch, version=None):
+        # Merges the patch's top level keys into registration_data in the database, so only the patch is sent
+        # rather than the whole document. Given a version, the case must still be at it. Returns the new version,
+        # or None if the case didn't qualify.
+        statement = Case.__table__.update().where(Case.verification_id == case_id)
+        if version is not None:
+            statement = statement.where(Case.version == version)
+        merged = Case.registration_data.op('||')(literal(patch, JSONB))
+        statement = statement.values(registration_data=merged, version=Case.version + 1).returning(Case.version)
+        return db.session.execute(statement).scalar()
+
     @staticmethod
     def get_pending():
-        return Case.query.filter_by(status='Pending').order_by(desc(Case.date_added)).all()
+        return Case._pending_query().all()
+
+    @staticmethod
+    def get_pending_page(limit, after=None):
+        # Keyset pagination - 'after' is the (date_added, verification_id) of the last case on the previous page
+        query = Case.query.filter_by(status='Pending')
+        if after is not None:
+            query = query.filter(tuple_(Case.date_added, Case.verification_id) < tuple_(*after))
+        return query.order_by(desc(Case.date_added), desc(Case.verification_id)).limit(limit).all()
+
+    @staticmethod
+    def stream_pending(batch_size):
+        # Rows are fetched from a server-side cursor, batch_size at a time, rather than all at once
+        return Case._pending_query().execution_options(stream_results=True).yield_per(batch_size)
+
+    @staticmethod
+    def _pending_query():
+        return Case.query.filter_by(status='Pending').order_by(desc(Case.date_added), desc(Case.verification_id))
 
     @staticmethod
     def search(first_name=None, last_name=None, organisation_name=None, email=None):
-        filters = []
-        if first_name:
-            filters.append(Case.registration_data['first_name'].astext.ilike('%' + first_name + '%'))
-        if last_name:
-            filters.append(Case.registration_data['last_name'].astext.ilike('%' + last_name + '%'))
-        if organisation_name:
-            org = '%' + organisation_name + '%'
-            filters.append(Case.registration_data['organisation_name'].astext.ilike(org))
-        if email:
-            filters.append(Case.registration_data['email'].astext.ilike('%' + email + '%'))
-
-        return Case.query.filter(*filters)
+        search_terms = {
+            'first_name': first_name,
+            'last_name': last_name,
+            'organisation_name': organisation_name,
+            'email': email
+        }
+        search_terms = {field: term for field, term in search_terms.items() if term}
+        filters = [Case.registration_field(field).ilike(_contains_pattern(term))
+                   for field, term in search_terms.items()]
+
+        # Best matches first, then newest first (with the id as a tie break so paging is deterministic)
+        ordering = [desc(Case.date_added), desc(Case.verification_id)]
+        if search_terms:
+            similarities = [func.similarity(Case.registration_field(field), term)
+                            for field, term in search_terms.items()]
+            ordering.insert(0, desc(reduce(operator.add, similarities)))
+
+        return Case.query.filter(*filters).order_by(*ordering)
+
+    @staticmethod
+    def registration_field(field):
+        # The key is rendered as a literal rather than a bind parameter so that the expression is identical to
+        # the one in the trigram indexes over registration_data (see migration a6dbe85920e3)
+        return Case.registration_data.op('->>', return_type=db.Text)(literal_column("'{}'".format(field)))
 
     def as_dict(self):
         status = self.status
-        if status == 'Pending' and len(self.notes) > 0:
+        if status == 'Pending' and self.has_notes:
             status = 'In Progress'
 
         return {
@@ -72,7 +216,9 @@ class Case(db.Model):
             'date_added': str(self.date_added),
             'staff_id': self.staff_id,
             'date_agreed': str(self.date_agreed),
-            'status': status
+            'locked_until': str(self.locked_until),
+            'status': status,
+            'version': self.version
         }
 
 
@@ -89,6 +235,12 @@ class Note(db.Model):
         self.note_detail = notepad['note_text']
         self.staff_id = notepad['staff_id']
 
+    @staticmethod
+    def add_many(case_ids, staff_id, note_text):
+        # Adds the same note to each of the cases with a single multi-row INSERT
+        rows = [{'verification_id': case_id, 'note_detail': note_text, 'staff_id': staff_id} for case_id in case_ids]
+        db.session.execute(Note.__table__.insert().values(rows))
+
     @staticmethod
     def get_notepad_by_case_id(case_id):
         return Note.query.filter_by(verification_id=case_id).order_by(desc(Note.date_added)).all()
@@ -103,6 +255,25 @@ class Note(db.Model):
         }
 
 
+def estimate_rows(query):
+    # The planner's estimate of how many rows a query will return. Much cheaper than a COUNT(*) as
+    # nothing is read, but only as accurate as the table statistics.
+    statement = query.statement.compile(dialect=db.engine.dialect)
+    plan = db.session.connection().execute('EXPLAIN (FORMAT JSON) ' + str(statement), statement.params).scalar()
+    return plan[0]['Plan']['Plan Rows']
+
+
+def _contains_pattern(term):
+    # Escape LIKE wildcards in user input so they are matched literally (backslash is Postgres' default escape)
+    escaped = term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return '%' + escaped + '%'
+
+
+# Loaded as an EXISTS subquery in the same SELECT as the case itself, so as_dict doesn't have to lazy load
+# the notes relationship (one extra query per case) to work out whether a case is in progress
+Case.has_notes = column_property(exists().where(Note.verification_id == Case.verification_id))
+
+
 class DeclineReason(db.Model):
     __tablename__ = 'decline_reason'
     decline_id = db.Column(db.Integer, primary_key=True)
@@ -147,6 +318,111 @@ class Close(db.Model):
         self.requester = closure['requester']
         self.staff_id = closure['staff_id']
 
+    @staticmethod
+    def add_many(case_ids, closure):
+        # Records the same closure against each of the cases with a single multi-row INSERT
+        rows = [{
+            'verification_id': case_id,
+            'close_detail': closure['close_detail'],
+            'requester': closure['requester'],
+            'staff_id': closure['staff_id']
+        } for case_id in case_ids]
+        db.session.execute(Close.__table__.insert().values(rows))
+
     @staticmethod
     def get_closure_by_case_id(case_id):
         return Close.query.filter_by(verification_id=case_id).first()
+
+
+class MetricOutbox(db.Model):
+    """Metric events waiting to be sent to dps-metric-api.
+
+    Rows are added in the same transaction as the change they record, so an event can't be lost if the metric API
+    is down, and are removed once sent (see drain_metric_outbox).
+    """
+    __tablename__ = 'metric_outbox'
+    outbox_id = db.Column(db.Integer, primary_key=True)
+    payload = db.Column(JSONB, nullable=False)
+    trace_id = db.Column(db.String, nullable=True)
+    date_added = db.Column(db.DateTime(timezone=True), default=datetime.datetime.utcnow)
+
+    def __init__(self, payload, trace_id=None):
+        self.payload = payload
+        self.trace_id = trace_id
+
+    @staticmethod
+    def add_many(payloads, trace_id=None):
+        rows = [{'payload': payload, 'trace_id': trace_id} for payload in payloads]
+        db.session.execute(MetricOutbox.__table__.insert().values(rows))
+
+    @staticmethod
+    def lock_batch(batch_size):
+        # Rows another drain process already has locked are skipped, so several can run in parallel without
+        # waiting on each other or sending the same event twice
+        query = MetricOutbox.query.order_by(asc(MetricOutbox.outbox_id)).with_for_update(skip_locked=True)
+        return query.limit(batch_size).all()
+
+    @staticmethod
+    def remove(outbox_ids):
+        MetricOutbox.query.filter(MetricOutbox.outbox_id.in_(outbox_ids)).delete(synchronize_session=False)
+
+
+class IdempotencyKey(db.Model):
+    """The response to a request made with an Idempotency-Key header, replayed if the request is retried.
+
+    response_code is null while the first request with the key is still in progress. Keys are kept for
+    IDEMPOTENCY_KEY_TTL seconds, after which they can be reused and are removed by manage.py purge_idempotency_keys.
+
+    Keys are read and written on a connection of their own rather than the request's session, so they're committed
+    separately from the request's work (see idempotency.idempotent).
+    """
+    __tablename__ = 'idempotency_key'
+    idempotency_key = db.Column(db.String, primary_key=True)
+    # Identifies the request the key was first used for, so it can't be replayed for a different one
+    request_hash = db.Column(db.String, nullable=False)
+    response_code = db.Column(db.Integer, nullable=True)
+    response_body = db.Column(JSONB, nullable=True)
+    # The headers that are replayed along with the body (see idempotency.REPLAYED_HEADERS)
+    response_headers = db.Column(JSONB, nullable=True)
+    date_added = db.Column(db.DateTime(timezone=True), nullable=False, index=True)
+
+    @staticmethod
+    def claim(connection, key, request_hash, ttl, in_progress_timeout):
+        # Adds the key, or takes it over if it's older than the ttl (a timedelta), in one statement so that only
+        # one of any concurrent requests with it can succeed. A retry of the same request can also take it over once
+        # it's been in progress for longer than in_progress_timeout, as the worker handling it must have died before
+        # it could release it. Returns whether this request got it.
+        table = IdempotencyKey.__table__
+        statement = insert(table).values(idempotency_key=key, request_hash=request_hash, date_added=func.now())
+        statement = statement.on_conflict_do_update(
+            index_elements=[table.c.idempotency_key],
+            set_={'request_hash': request_hash, 'response_code': None, 'response_body': None,
+                  'response_headers': None, 'date_added': func.now()},
+            where=or_(table.c.date_added <= func.now() - ttl,
+                      and_(table.c.response_code.is_(None), table.c.request_hash == request_hash,
+                           table.c.date_added <= func.now() - in_progress_timeout))
+        ).returning(table.c.idempotency_key)
+        return connection.execute(statement).scalar() is not None
+
+    @staticmethod
+    def get_key(connection, key):
+        table = IdempotencyKey.__table__
+        return connection.execute(select([table]).where(table.c.idempotency_key == key)).first()
+
+    @staticmethod
+    def save_response(connection, key, response_code, response_body, response_headers):
+        table = IdempotencyKey.__table__
+        connection.execute(table.update().where(table.c.idempotency_key == key)
+                           .values(response_code=response_code, response_body=response_body,
+                                   response_headers=response_headers))
+
+    @staticmethod
+    def release(connection, key):
+        # Removes a key whose request didn't finish, so it can be retried
+        table = IdempotencyKey.__table__
+        connection.execute(table.delete().where(and_(table.c.idempotency_key == key, table.c.response_code.is_(None))))
+
+    @staticmethod
+    def purge(connection, ttl):
+        table = IdempotencyKey.__table__
+        return connection.execute(table.delete().where(table.c.date_added <= func.now() - ttl)).rowcount
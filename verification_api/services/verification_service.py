@@ -1,23 +1,56 @@
+import base64
+import binascii
+import functools
+import itertools
+import json
 import logging
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+from flask import current_app
 from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm.exc import StaleDataError
 from common_utilities import errors
 
-from verification_api.models import Case, Note, DeclineReason, Close
+from verification_api.models import Case, Note, DeclineReason, Close, IdempotencyKey, RESOLVED_STATUSES, estimate_rows
 from verification_api.exceptions import ApplicationError
 from verification_api.extensions import db
 from verification_api.dependencies.account_api import AccountAPI
 from verification_api.dependencies.ulapd_api import UlapdAPI
+from verification_api.dependencies.metric_api import add_metric_event_to_outbox, add_metric_events_to_outbox
+from verification_api.utilities.cache import TTLCache
+from verification_api.utilities.catalogue import Catalogue
+from verification_api.utilities.concurrency import run_concurrently
 
 
 log = logging.getLogger(__name__)
 
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+# The status each dps action resolves a case to
+DECISIONS = {'Approve': 'Approved', 'Decline': 'Declined'}
+CLOSURE_ERROR = 'Account closure only permitted on active user accounts'
+
+# The dataset catalogue rarely changes, so there's no need to ask ulapd-api for it on every case screen
+dataset_list_cache = TTLCache(lambda: UlapdAPI().get_dataset_list_details())
+# Decline reasons only change through migrations, which notify this channel (see the decline_reason trigger)
+decline_reason_catalogue = Catalogue('decline_reason_changed', lambda: _load_decline_reasons())
+
 
 def handle_errors(is_get):
     def wrapper(func):
         def run_and_handle(*args, **kwargs):
             try:
-                return func(*args, **kwargs)
+                try:
+                    return func(*args, **kwargs)
+                except Exception:
+                    # The session lasts for the whole request (see UnitOfWork), so it's left usable for whatever the
+                    # view does next
+                    db.session.rollback()
+                    raise
+            except StaleDataError as error:
+                log.error(str(error))
+                error_msg = 'Case was changed by another request, please try again'
+                error_def = errors.get('verification_api', 'VERIFICATION_ERROR', filler=error_msg)
+                raise ApplicationError(*error_def, http_code=409)
             except SQLAlchemyError as error:
                 log.error(str(error))
                 error_code = 500 if is_get else 422
@@ -25,10 +58,6 @@ def handle_errors(is_get):
                 raise ApplicationError(*error_def, http_code=error_code)
             except ApplicationError as error:
                 raise error
-            finally:
-                if not is_get:
-                    db.session.rollback()
-                db.session.close()
         return run_and_handle
     return wrapper
 
@@ -38,6 +67,36 @@ def get_pending():
     return _extract_rows(Case.get_pending())
 
 
+@handle_errors(is_get=True)
+def get_pending_page(limit, cursor=None):
+    page_size = _get_page_size(limit)
+    after = _decode_worklist_cursor(cursor) if cursor else None
+
+    # Fetch one extra row so we know whether there is another page without having to count
+    cases = Case.get_pending_page(page_size + 1, after)
+    next_cursor = _encode_worklist_cursor(cases[page_size - 1]) if len(cases) > page_size else None
+
+    return {
+        'cases': _extract_rows(cases[:page_size]),
+        'next_cursor': next_cursor
+    }
+
+
+def stream_pending():
+    # A generator can't use handle_errors as the query only runs once the response starts being sent,
+    # by which point the status code has gone so all we can do is log and stop.
+    try:
+        yield '['
+        for index, case in enumerate(Case.stream_pending(current_app.config['STREAM_BATCH_SIZE'])):
+            yield (',' if index else '') + json.dumps(case.as_dict(), separators=(',', ':'))
+        yield ']'
+    except SQLAlchemyError as error:
+        log.error('Failed to stream worklist - {}'.format(str(error)))
+        raise
+    finally:
+        db.session.close()
+
+
 @handle_errors(is_get=True)
 def get_pending_by_id(case_id):
     case = Case.get_case_by_id(case_id)
@@ -52,35 +111,47 @@ def get_pending_by_id(case_id):
     return result
 
 
-@handle_errors(is_get=False)
-def dps_action(action, case_id, data):
+@handle_errors(is_get=True)
+def get_case_details(case_id):
     case = Case.get_case_by_id(case_id)
-    if not case:
+    if case is None:
+        log.error("Case '{}' not found".format(case_id))
         raise ApplicationError(*errors.get('verification_api', 'CASE_NOT_FOUND', filler=case_id), http_code=404)
 
-    if not _can_perform_action(case, data['staff_id']):
-        error_msg = 'Could not perform action on case as it is locked to another user'
-        raise ApplicationError(*errors.get('verification_api', 'LOCKING_ERROR', filler=error_msg), http_code=403)
+    result = case.as_dict()
+    result['notes'] = _extract_rows(Note.get_notepad_by_case_id(case_id))
+
+    # The account-api and ulapd-api calls don't depend on each other, so make them all at once
+    ldap_id = case.ldap_id
+    user_id = case.user_id
+    result.update(run_concurrently({
+        'groups': lambda: _get_group_names(AccountAPI().get(ldap_id)),
+        'dataset_activity': lambda: UlapdAPI().get_dataset_activity(user_id),
+        'dataset_access': lambda: UlapdAPI().get_user_dataset_access(user_id)
+    }))
+
+    return result
+
+
+@handle_errors(is_get=False)
+def dps_action(action, case_id, data):
+    _check_action(action)
+
+    # The case stays locked in this transaction until the commit, so a concurrent action on it waits and then
+    # finds it's no longer pending
+    case = Case.transition(case_id, data['staff_id'], DECISIONS[action])
+    if case is None:
+        _raise_transition_error(case_id)
 
     account_api = AccountAPI()
 
     if action == 'Approve':
         account_api.approve(case.ldap_id)
-        _status_update(case, 'Approved', data)
-    elif action == 'Decline':
-        # need to make the first letter in the reason lowercase due to the layout of the template
-        reason = data['reason'][0].lower() + data['reason'][1:]
-        account_api.decline(case.ldap_id, reason, data['advice'], case.user_id)
-        _status_update(case, 'Declined', data)
-        # add the decline reason as a notepad entry
-        note_text = 'Declined: Reason - {}; Next Steps - {}'.format(data['reason'], data['advice'])
-        _add_note(case_id, data['staff_id'], note_text)
-
+        add_metric_event_to_outbox('dst action approved', case.as_dict())
     else:
-        error_msg = 'Invalid action {}'.format(action)
-        log.error(error_msg)
-        raise ApplicationError(*errors.get('verification_api', 'VERIFICATION_ERROR', filler=str(error_msg)),
-                               http_code=500)
+        account_api.decline(case.ldap_id, _template_reason(data['reason']), data['advice'], case.user_id)
+        # add the decline reason as a notepad entry
+        _add_note(case_id, data['staff_id'], _decline_note(data))
 
     data['status_updated'] = True
     data['case_id'] = case_id
@@ -89,6 +160,53 @@ def dps_action(action, case_id, data):
     return data
 
 
+# Approves or declines each of the cases locked to data['staff_id'], BULK_ACTION_BATCH_SIZE at a time. The account-api
+# calls for a batch are made concurrently, then the cases they succeeded for are updated together and committed.
+# Returns a result for each case in the order given, as one failing doesn't stop the rest.
+@handle_errors(is_get=False)
+def bulk_dps_action(action, case_ids, data):
+    _check_action(action)
+    account_api = AccountAPI()
+
+    if action == 'Approve':
+        def call(case):
+            account_api.approve(case['ldap_id'])
+
+        def apply(batch_ids):
+            cases = Case.update_many(batch_ids, _decision_values('Approved'))
+            add_metric_events_to_outbox('dst action approved', _extract_rows(cases))
+    else:
+        reason = _template_reason(data['reason'])
+
+        def call(case):
+            account_api.decline(case['ldap_id'], reason, data['advice'], case['user_id'])
+
+        def apply(batch_ids):
+            Case.update_many(batch_ids, _decision_values('Declined'))
+            Note.add_many(batch_ids, data['staff_id'], _decline_note(data))
+
+    return _run_bulk_action(case_ids, lambda batch_ids: Case.lock_many(batch_ids, 'Pending', data['staff_id']),
+                            _get_transition_error, call, apply)
+
+
+# As bulk_dps_action, but closes each of the approved cases' accounts
+@handle_errors(is_get=False)
+def bulk_close_accounts(case_ids, data):
+    account_api = AccountAPI()
+
+    def call(case):
+        account_api.close(case['ldap_id'], case['user_id'], data['requester'])
+
+    def apply(batch_ids):
+        cases = Case.update_many(batch_ids, {'status': 'Closed'})
+        Close.add_many(batch_ids, data)
+        Note.add_many(batch_ids, data['staff_id'], _closure_note(data))
+        add_metric_events_to_outbox('account closed', _extract_rows(cases))
+
+    return _run_bulk_action(case_ids, lambda batch_ids: Case.lock_many(batch_ids, 'Approved'),
+                            lambda case: CLOSURE_ERROR, call, apply)
+
+
 @handle_errors(is_get=False)
 def close_account(case_id, data):
     case = Case.get_case_by_id(case_id)
@@ -96,9 +214,8 @@ def close_account(case_id, data):
         raise ApplicationError(*errors.get('verification_api', 'CASE_NOT_FOUND', filler=case_id), http_code=404)
 
     if case.status != 'Approved':
-        error_msg = 'Account closure only permitted on active user accounts'
-        log.error(error_msg)
-        error = errors.get('verification_api', 'VERIFICATION_ERROR', filler=str(error_msg))
+        log.error(CLOSURE_ERROR)
+        error = errors.get('verification_api', 'VERIFICATION_ERROR', filler=CLOSURE_ERROR)
         raise ApplicationError(*error, http_code=409)
 
     account_api = AccountAPI()
@@ -108,6 +225,7 @@ def close_account(case_id, data):
     db.session.add(closure)
 
     case.status = 'Closed'
+    add_metric_event_to_outbox('account closed', case.as_dict())
     db.session.commit()
     data['status_updated'] = True
     data['case_id'] = case_id
@@ -152,6 +270,27 @@ def insert_case(case_details):
     return user.verification_id
 
 
+@handle_errors(is_get=False)
+def insert_cases(cases):
+    # Inserts any number of cases (cases can be a generator) BULK_INSERT_BATCH_SIZE at a time, all in the one
+    # transaction so that either every case is added or none are. Returns their ids in the order given.
+    batch_size = current_app.config['BULK_INSERT_BATCH_SIZE']
+    cases = iter(cases)
+    case_ids = []
+    while True:
+        batch = list(itertools.islice(cases, batch_size))
+        if not batch:
+            break
+        for index, case_details in enumerate(batch, start=len(case_ids)):
+            _check_case_details(index, case_details)
+
+        case_ids.extend(Case.insert_many(batch))
+        add_metric_events_to_outbox('application received', [_received_metric_data(case) for case in batch])
+
+    db.session.commit()
+    return case_ids
+
+
 @handle_errors(is_get=False)
 def insert_note(case_id, note_data):
     case = Case.get_case_by_id(case_id)
@@ -161,6 +300,7 @@ def insert_note(case_id, note_data):
 
     if _can_perform_action(case, note_data['staff_id']):
         _add_note(case_id, note_data['staff_id'], note_data['note_text'])
+        db.session.commit()
     else:
         error_msg = 'Could not add note to case as it is locked to another user'
         log.error(error_msg)
@@ -169,6 +309,11 @@ def insert_note(case_id, note_data):
 
 @handle_errors(is_get=True)
 def get_decline_reasons():
+    # Returns the decline reasons already serialised to JSON, and their ETag
+    return decline_reason_catalogue.get()
+
+
+def _load_decline_reasons():
     decline = _extract_rows(DeclineReason.get_all_decline_reasons())
     reasons = []
     for row in decline:
@@ -182,19 +327,40 @@ def get_decline_reasons():
     return reasons
 
 
-# Sets a lock on the specified case for the specified user.
+# Sets a lock on the specified case for the specified user, or renews it if they already hold it. The lock runs out
+# after CASE_LOCK_LEASE seconds unless renewed, so an abandoned case doesn't stay locked.
 # If no user is supplied, the case is unlocked instead.
 @handle_errors(is_get=False)
 def manage_case_lock(case_id, owner=None):
-    case = Case.get_case_by_id(case_id)
+    if owner is None:
+        locked_until = None
+        updated = Case.unlock(case_id) is not None
+    else:
+        locked_until = Case.lock(case_id, owner, _get_lock_lease())
+        updated = locked_until is not None
+
+    if not updated:
+        _raise_lock_error(case_id)
+
+    db.session.commit()
+    return {
+        'case_id': case_id,
+        'staff_id': owner,
+        'locked_until': str(locked_until) if locked_until else None
+    }
+
+
+# Locks the oldest unlocked pending case to the user and returns it with its notes, or None if there are none left
+@handle_errors(is_get=False)
+def claim_next_case(staff_id):
+    case = Case.claim_next(staff_id, _get_lock_lease())
     if case is None:
-        raise ApplicationError(*errors.get('verification_api', 'CASE_NOT_FOUND', filler=case_id), http_code=404)
+        return None
 
-    if case.status in ['Approved', 'Declined']:
-        error_msg = 'Cannot lock resolved case'
-        raise ApplicationError(*errors.get('verification_api', 'LOCKING_ERROR', filler=error_msg))
-    case.staff_id = owner
+    result = case.as_dict()
+    result['notes'] = _extract_rows(Note.get_notepad_by_case_id(case.verification_id))
     db.session.commit()
+    return result
 
 
 @handle_errors(is_get=True)
@@ -203,15 +369,46 @@ def perform_search(search_params):
     last_name = search_params.get('last_name', '')
     organisation_name = search_params.get('organisation_name', '')
     email = search_params.get('email', '')
-    return _extract_rows(Case.search(first_name, last_name, organisation_name, email))
+    query = Case.search(first_name, last_name, organisation_name, email)
+
+    # Always one page, MAX_PAGE_SIZE results if no limit is given
+    page_size = _get_page_size(search_params.get('limit'))
+    cursor = search_params.get('cursor')
+    offset = _decode_cursor(cursor, 1)[0] if cursor else 0
+    # Only ever handed out for a page after the first, so it's past at least one row
+    if cursor and offset < 1:
+        _raise_invalid_cursor(cursor)
+
+    # Fetch one extra row so we know whether there is another page without having to count
+    cases = query.offset(offset).limit(page_size + 1).all()
+    next_cursor = _encode_cursor(offset + page_size) if len(cases) > page_size else None
+
+    return {
+        'results': _extract_rows(cases[:page_size]),
+        'next_cursor': next_cursor,
+        'total_estimate': estimate_rows(query)
+    }
 
 
 @handle_errors(is_get=False)
-def update_user_details(case_id, data):
+def update_user_details(case_id, data, version=None):
+    # If a version is given (from If-Match) the update only goes ahead if the case is still at it
     case = Case.get_case_by_id(case_id)
     if case is None:
         raise ApplicationError(*errors.get('verification_api', 'CASE_NOT_FOUND', filler=case_id), http_code=404)
 
+    if version is not None and case.version != version:
+        _raise_version_mismatch(case_id)
+
+    # The case is updated before ulapd, so a concurrent change is caught before ulapd is touched. The update holds
+    # the row until the commit, and is rolled back if ulapd fails.
+    new_version = Case.merge_registration_data(case_id, data['updated_data'], version)
+    if new_version is None:
+        _raise_version_mismatch(case_id)
+
+    if 'contactable' in data['updated_data']:
+        _add_update_note(case_id, data)
+
     # update preference in ulapd
     ulapd = UlapdAPI()
     ulapd_data = {'user_id': case.user_id}
@@ -219,21 +416,16 @@ def update_user_details(case_id, data):
         ulapd_data[key] = value
     ulapd.update(ulapd_data)
 
-    case.registration_data = _update_registration_data(dict(case.registration_data), data['updated_data'])
-
-    if 'contactable' in data['updated_data']:
-        _add_update_note(case_id, data)
-
     db.session.commit()
 
-    return {'updated': True}
+    return {'updated': True, 'version': new_version}
 
 
 @handle_errors(is_get=True)
 def get_dataset_list_details():
-    ulapd = UlapdAPI()
-    dataset_list = ulapd.get_dataset_list_details()
-    return dataset_list
+    # Returns the dataset list and its ETag
+    return dataset_list_cache.get(current_app.config['DATASET_LIST_CACHE_TTL'],
+                                  current_app.config['DATASET_LIST_STALE_TTL'])
 
 
 @handle_errors(is_get=False)
@@ -259,6 +451,7 @@ def update_dataset_access(case_id, updated_access):
 
     note_text = 'Data access updated: {}'.format(', '.join(dataset_msgs))
     _add_note(case_id, updated_access['staff_id'], note_text)
+    db.session.commit()
 
     return data_dict
 
@@ -272,13 +465,7 @@ def get_groups(case_id):
         raise ApplicationError(*errors.get('verification_api', 'CASE_NOT_FOUND', filler=case_id), http_code=404)
 
     ldap_details = AccountAPI().get(case.ldap_id)
-
-    if isinstance(ldap_details['groups'], str):
-        group_dns = [ldap_details['groups']]
-    else:
-        group_dns = ldap_details['groups']
-
-    groups = [group.split(',')[0][3:] for group in group_dns]
+    groups = _get_group_names(ldap_details)
     return groups, case
 
 
@@ -308,10 +495,99 @@ def get_user_dataset_access(case_id):
     return dataset_access_list
 
 
+# Takes the Idempotency-Key for this request, returning None, or if a request with it has already finished, that
+# request's (response_code, response_body, response_headers) to be replayed. The key is committed straight away on a
+# connection of its own, leaving the request's session to the view.
+@handle_errors(is_get=False)
+def claim_idempotency_key(key, request_hash):
+    with db.engine.begin() as connection:
+        if IdempotencyKey.claim(connection, key, request_hash, _get_idempotency_ttl(),
+                                timedelta(seconds=current_app.config['IDEMPOTENCY_KEY_IN_PROGRESS_TIMEOUT'])):
+            return None
+
+        stored = IdempotencyKey.get_key(connection, key)
+
+    if stored is not None and stored.request_hash != request_hash:
+        error_msg = 'Idempotency-Key {} has already been used for a different request'.format(key)
+        log.error(error_msg)
+        raise ApplicationError(*errors.get('verification_api', 'VERIFICATION_ERROR', filler=error_msg),
+                               http_code=422)
+
+    if stored is None or stored.response_code is None:
+        error_msg = 'A request with Idempotency-Key {} is already in progress'.format(key)
+        log.error(error_msg)
+        raise ApplicationError(*errors.get('verification_api', 'VERIFICATION_ERROR', filler=error_msg),
+                               http_code=409)
+
+    # Keys stored before headers were kept have none
+    return stored.response_code, stored.response_body, stored.response_headers or {}
+
+
+@handle_errors(is_get=False)
+def save_idempotent_response(key, response_code, response_body, response_headers):
+    with db.engine.begin() as connection:
+        IdempotencyKey.save_response(connection, key, response_code, response_body, response_headers)
+
+
+@handle_errors(is_get=False)
+def release_idempotency_key(key):
+    with db.engine.begin() as connection:
+        IdempotencyKey.release(connection, key)
+
+
+@handle_errors(is_get=False)
+def purge_idempotency_keys():
+    with db.engine.begin() as connection:
+        return IdempotencyKey.purge(connection, _get_idempotency_ttl())
+
+
 def _extract_rows(rows):
     return [row.as_dict() for row in rows]
 
 
+def _get_page_size(limit):
+    if limit is None:
+        return current_app.config['MAX_PAGE_SIZE']
+    # From a query string it's still text
+    if isinstance(limit, str) and limit.isdigit():
+        limit = int(limit)
+    if not isinstance(limit, int) or isinstance(limit, bool) or limit < 1:
+        error_msg = 'Page size must be a positive integer'
+        raise ApplicationError(*errors.get('verification_api', 'VERIFICATION_ERROR', filler=error_msg), http_code=400)
+    return min(limit, current_app.config['MAX_PAGE_SIZE'])
+
+
+# Cursors are opaque to clients. A worklist cursor holds the date_added (as microseconds since the epoch, so
+# there is no timestamp parsing to do) and id of the last case on a page, a search cursor holds an offset.
+def _encode_cursor(*values):
+    cursor = '_'.join(str(value) for value in values)
+    return base64.urlsafe_b64encode(cursor.encode()).decode()
+
+
+def _decode_cursor(cursor, size):
+    try:
+        values = [int(value) for value in base64.urlsafe_b64decode(cursor.encode()).decode().split('_')]
+        if len(values) == size:
+            return values
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        pass
+    _raise_invalid_cursor(cursor)
+
+
+def _raise_invalid_cursor(cursor):
+    error_msg = "Invalid cursor '{}'".format(cursor)
+    raise ApplicationError(*errors.get('verification_api', 'VERIFICATION_ERROR', filler=error_msg), http_code=400)
+
+
+def _encode_worklist_cursor(case):
+    return _encode_cursor((case.date_added - EPOCH) // timedelta(microseconds=1), case.verification_id)
+
+
+def _decode_worklist_cursor(cursor):
+    micros, case_id = _decode_cursor(cursor, 2)
+    return EPOCH + timedelta(microseconds=micros), case_id
+
+
 def _add_note(case_id, staff_id, note_text):
     entry = {
         'case_id': case_id,
@@ -319,15 +595,104 @@ def _add_note(case_id, staff_id, note_text):
         'note_text': note_text
     }
 
+    # Committed by the caller, along with whatever else the note records
     note = Note(entry)
     db.session.add(note)
-    db.session.commit()
 
 
-def _status_update(user, decision, data):
-    user.status = decision
-    user.staff_id = data['staff_id']
-    user.date_agreed = datetime.utcnow()
+def _check_action(action):
+    if action not in DECISIONS:
+        error_msg = 'Invalid action {}'.format(action)
+        log.error(error_msg)
+        raise ApplicationError(*errors.get('verification_api', 'VERIFICATION_ERROR', filler=str(error_msg)),
+                               http_code=500)
+
+
+def _template_reason(reason):
+    # need to make the first letter in the reason lowercase due to the layout of the template
+    return reason[0].lower() + reason[1:]
+
+
+def _decline_note(data):
+    return 'Declined: Reason - {}; Next Steps - {}'.format(data['reason'], data['advice'])
+
+
+def _closure_note(data):
+    return 'Account closure requested by: {}, for reason: {}'.format(data['requester'], data['close_detail'])
+
+
+def _decision_values(status):
+    return {'status': status, 'date_agreed': datetime.utcnow(), 'locked_until': None}
+
+
+def _run_bulk_action(case_ids, lock, reject, call, apply):
+    # lock(batch_ids) returns the cases in the batch the action can be taken on, locked until the commit, and
+    # reject(case) says why one it didn't return can't be. call(case) makes the account-api call for one of them
+    # (given as a dict, as ORM objects shouldn't be shared between threads) and apply(batch_ids) updates those the
+    # calls succeeded for.
+    batch_size = current_app.config['BULK_ACTION_BATCH_SIZE']
+    case_ids = list(dict.fromkeys(case_ids))
+    errors_by_id = {}
+    for start in range(0, len(case_ids), batch_size):
+        batch_ids = case_ids[start:start + batch_size]
+        cases = lock(batch_ids)
+
+        batch_errors = run_concurrently({case.verification_id: functools.partial(_attempt, call, case.as_dict())
+                                         for case in cases})
+        succeeded = [case_id for case_id, error in batch_errors.items() if error is None]
+        if succeeded:
+            apply(succeeded)
+        db.session.commit()
+
+        errors_by_id.update(batch_errors)
+        ineligible = [case_id for case_id in batch_ids if case_id not in batch_errors]
+        if ineligible:
+            errors_by_id.update(_get_ineligible_reasons(ineligible, reject))
+
+    return [_bulk_result(case_id, errors_by_id[case_id]) for case_id in case_ids]
+
+
+def _attempt(call, case):
+    # Returns why the call failed rather than raising, so the other cases in the batch carry on
+    try:
+        call(case)
+    except ApplicationError as error:
+        log.error('Bulk action failed for case {} - {}'.format(case['case_id'], error.message))
+        return error.message
+    return None
+
+
+def _get_ineligible_reasons(case_ids, reject):
+    cases = {case.verification_id: case for case in Case.query.filter(Case.verification_id.in_(case_ids))}
+    return {case_id: reject(cases[case_id]) if case_id in cases else 'Case {} not found'.format(case_id)
+            for case_id in case_ids}
+
+
+def _bulk_result(case_id, error):
+    if error is None:
+        return {'case_id': case_id, 'status_updated': True}
+    return {'case_id': case_id, 'status_updated': False, 'error': error}
+
+
+def _raise_transition_error(case_id):
+    # Only reached when Case.transition didn't update anything, to work out why
+    case = Case.get_case_by_id(case_id)
+    if case is None:
+        raise ApplicationError(*errors.get('verification_api', 'CASE_NOT_FOUND', filler=case_id), http_code=404)
+
+    error_msg = _get_transition_error(case)
+    if case.status == 'Pending':
+        raise ApplicationError(*errors.get('verification_api', 'LOCKING_ERROR', filler=error_msg), http_code=403)
+
+    log.error(error_msg)
+    raise ApplicationError(*errors.get('verification_api', 'VERIFICATION_ERROR', filler=error_msg), http_code=409)
+
+
+def _get_transition_error(case):
+    # Why an existing case couldn't be approved or declined
+    if case.status == 'Pending':
+        return 'Could not perform action on case as it is locked to another user'
+    return 'Case has already been {}'.format(case.status.lower())
 
 
 def _can_perform_action(case, staff_id):
@@ -336,10 +701,53 @@ def _can_perform_action(case, staff_id):
     return True
 
 
-def _update_registration_data(data, updated_data):
-    for key, value in updated_data.items():
-        data[key] = value
-    return data
+def _check_case_details(index, case_details):
+    fields = {'user_id': str, 'ldap_id': str, 'registration_data': dict, 'status': str}
+    missing = [field for field in fields if not isinstance(case_details, dict) or field not in case_details]
+    if missing:
+        error_msg = 'Case {} is missing {}'.format(index, ', '.join(missing))
+        log.error(error_msg)
+        raise ApplicationError(*errors.get('verification_api', 'VERIFICATION_ERROR', filler=error_msg), http_code=400)
+
+    invalid = [field for field, field_type in fields.items() if not isinstance(case_details[field], field_type)]
+    if invalid:
+        error_msg = 'Case {} has invalid {}'.format(index, ', '.join(invalid))
+        log.error(error_msg)
+        raise ApplicationError(*errors.get('verification_api', 'VERIFICATION_ERROR', filler=error_msg), http_code=400)
+
+
+def _received_metric_data(case_details):
+    # The same data as the single insert sends, copied as building the payload changes it
+    registration_data = dict(case_details['registration_data'], date_added=str(datetime.now()))
+    return dict(case_details, registration_data=registration_data)
+
+
+def _get_lock_lease():
+    return timedelta(seconds=current_app.config['CASE_LOCK_LEASE'])
+
+
+def _get_idempotency_ttl():
+    return timedelta(seconds=current_app.config['IDEMPOTENCY_KEY_TTL'])
+
+
+def _raise_lock_error(case_id):
+    # Only reached when Case.lock or Case.unlock didn't update anything, to work out why
+    case = Case.get_case_by_id(case_id)
+    if case is None:
+        raise ApplicationError(*errors.get('verification_api', 'CASE_NOT_FOUND', filler=case_id), http_code=404)
+
+    if case.status in RESOLVED_STATUSES:
+        error_msg = 'Cannot lock resolved case'
+        raise ApplicationError(*errors.get('verification_api', 'LOCKING_ERROR', filler=error_msg))
+
+    error_msg = 'Case is locked to another user until {}'.format(case.locked_until)
+    raise ApplicationError(*errors.get('verification_api', 'LOCKING_ERROR', filler=error_msg), http_code=403)
+
+
+def _raise_version_mismatch(case_id):
+    error_msg = 'Case {} has been changed since it was read'.format(case_id)
+    log.error(error_msg)
+    raise ApplicationError(*errors.get('verification_api', 'VERIFICATION_ERROR', filler=error_msg), http_code=412)
 
 
 def _add_update_note(case_id, data):
@@ -358,6 +766,15 @@ def _add_update_note(case_id, data):
     _add_note(case_id, data['staff_id'], note)
 
 
+def _get_group_names(ldap_details):
+    if isinstance(ldap_details['groups'], str):
+        group_dns = [ldap_details['groups']]
+    else:
+        group_dns = ldap_details['groups']
+
+    return [group.split(',')[0][3:] for group in group_dns]
+
+
 def _filter_groups_to_update(existing_groups, new_groups):
     # Create only list of group CNs
     user_groups = [x.split(',')[x.find('cn=')][3:] for x in existing_groups]
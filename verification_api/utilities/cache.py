@@ -0,0 +1,67 @@
+import hashlib
+import json
+import threading
+import time
+from verification_api.app import app
+from verification_api.utilities.concurrency import submit
+
+
+class TTLCache(object):
+    """Caches the result of a loader for a worker process, along with an ETag for it.
+
+    A value younger than ttl seconds is served as is. Once older than that, but younger than ttl + stale_ttl, it's
+    still served while a single background refresh replaces it. Beyond that (or before the first load) the caller
+    loads it, with any concurrent callers waiting for that one load rather than making their own.
+    """
+
+    def __init__(self, loader):
+        self.loader = loader
+        self.entry = None
+        self.load_lock = threading.Lock()
+        self.refresh_lock = threading.Lock()
+        self.refreshing = False
+
+    def get(self, ttl, stale_ttl):
+        """Returns (value, etag)"""
+        entry = self.entry
+        if entry is not None:
+            age = time.monotonic() - entry['loaded_at']
+            if age < ttl:
+                return entry['value'], entry['etag']
+            if age < ttl + stale_ttl:
+                self._refresh_in_background()
+                return entry['value'], entry['etag']
+
+        with self.load_lock:
+            # Another caller may have loaded it while we waited
+            entry = self.entry
+            if entry is None or time.monotonic() - entry['loaded_at'] >= ttl:
+                entry = self._load()
+            return entry['value'], entry['etag']
+
+    def clear(self):
+        self.entry = None
+
+    def _load(self):
+        value = self.loader()
+        etag = hashlib.sha1(json.dumps(value, sort_keys=True, default=str).encode()).hexdigest()
+        self.entry = {'value': value, 'etag': etag, 'loaded_at': time.monotonic()}
+        return self.entry
+
+    def _refresh_in_background(self):
+        with self.refresh_lock:
+            if self.refreshing:
+                return
+            self.refreshing = True
+
+        def refresh():
+            try:
+                with self.load_lock:
+                    self._load()
+            except Exception as e:
+                # Carry on serving the stale value, the next request past the ttl will try again
+                app.logger.error('Failed to refresh cached value: {}'.format(e))
+            finally:
+                self.refreshing = False
+
+        submit(refresh)
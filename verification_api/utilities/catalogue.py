@@ -0,0 +1,100 @@
+import hashlib
+import json
+import os
+import select
+import threading
+import time
+from flask import current_app
+from verification_api.extensions import db
+
+
+class Catalogue(object):
+    """Keeps a small, rarely changing table in memory as a ready to send JSON body, along with an ETag for it.
+
+    Each worker process loads the body on first use and keeps it until Postgres sends a notification on the given
+    channel (from a trigger on the table), which a background thread LISTENs for on its own connection. Until that
+    thread is listening every call loads the body afresh, so a change is never missed while it's reconnecting.
+    """
+
+    def __init__(self, channel, loader):
+        self.channel = channel
+        self.loader = loader
+        self.entry = None
+        self.version = 0
+        self.listening = False
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def get(self):
+        """Returns (body, etag)"""
+        self._start()
+        entry = self.entry
+        if entry is None:
+            entry = self._load()
+        return entry['body'], entry['etag']
+
+    def invalidate(self):
+        with self.lock:
+            self.version += 1
+            self.entry = None
+
+    def _load(self):
+        version = self.version
+        body = json.dumps(self.loader())
+        entry = {'body': body, 'etag': hashlib.sha1(body.encode()).hexdigest()}
+        with self.lock:
+            # Only keep it if no change was notified while loading, otherwise it may already be out of date
+            if self.listening and self.version == version:
+                self.entry = entry
+        return entry
+
+    def _start(self):
+        with self.lock:
+            # As with the metric dispatcher, a forked worker needs its own listener rather than its parent's
+            if self.pid != os.getpid():
+                self.entry = None
+                self.listening = False
+                # LISTEN needs a session of its own, which PgBouncer's transaction pooling doesn't give, so behind it
+                # every call loads the body
+                if not current_app.config['SQL_USE_PGBOUNCER']:
+                    thread = threading.Thread(target=self._listen, args=(current_app._get_current_object(),),
+                                              daemon=True)
+                    thread.start()
+                self.pid = os.getpid()
+
+    def _set_listening(self, listening):
+        with self.lock:
+            self.version += 1
+            self.entry = None
+            self.listening = listening
+
+    def _listen(self, flask_app):
+        interval = flask_app.config['CATALOGUE_HEARTBEAT_INTERVAL']
+        while True:
+            connection = None
+            try:
+                with flask_app.app_context():
+                    pooled = db.engine.raw_connection()
+                # Detached so it doesn't take up one of the pool's connections for good
+                pooled.detach()
+                connection = pooled.connection
+                connection.autocommit = True
+                cursor = connection.cursor()
+                cursor.execute('LISTEN {}'.format(self.channel))
+                self._set_listening(True)
+
+                while True:
+                    if select.select([connection], [], [], interval) == ([], [], []):
+                        # Nothing for a while, make sure the connection is still there
+                        cursor.execute('SELECT 1')
+                    connection.poll()
+                    if connection.notifies:
+                        del connection.notifies[:]
+                        self.invalidate()
+            except Exception as e:
+                flask_app.logger.error('Lost {} listener connection: {}'.format(self.channel, e))
+            finally:
+                self._set_listening(False)
+                if connection is not None and not connection.closed:
+                    connection.close()
+            time.sleep(interval)
@@ -0,0 +1,46 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app, g
+
+# Shared by every request a worker handles, one per setting for its number of threads (so e.g. health checks don't
+# queue behind case details). Threads are only started when work is first submitted, so each gunicorn worker gets its
+# own after forking.
+_executors = {}
+_executor_lock = threading.Lock()
+
+
+def run_concurrently(calls):
+    """Run each of the named calls on the worker's thread pool and return their results by name.
+
+    If any call raises, the first one to (in the order given) is re-raised.
+    """
+    futures = {name: submit(call) for name, call in calls.items()}
+    return {name: future.result() for name, future in futures.items()}
+
+
+def submit(call, workers='FAN_OUT_WORKERS'):
+    """Run a call on the worker's thread pool, returning its future.
+
+    workers names the config setting for the pool's size, each setting having a pool of its own. The call gets an app
+    context with the caller's trace id and requests session on g, so the dependency classes work as they would on the
+    request thread.
+    """
+    flask_app = current_app._get_current_object()
+    trace_id = g.get('trace_id')
+    session = g.get('requests')
+
+    def in_context():
+        with flask_app.app_context():
+            g.trace_id = trace_id
+            g.requests = session
+            return call()
+
+    return _get_executor(workers, flask_app.config[workers]).submit(in_context)
+
+
+def _get_executor(workers, max_workers):
+    if workers not in _executors:
+        with _executor_lock:
+            if workers not in _executors:
+                _executors[workers] = ThreadPoolExecutor(max_workers=max_workers)
+    return _executors[workers]
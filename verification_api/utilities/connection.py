@@ -1,19 +1,71 @@
+import threading
+from contextlib import contextmanager
 from verification_api.app import app
+from sqlalchemy.pool import QueuePool
 import psycopg2
 
+# Connections for raw SQL, kept open and shared by every thread in a worker. The pool is only created when first
+# used, so each gunicorn worker gets its own after forking.
+_pool = None
+_pool_lock = threading.Lock()
+# The pool's wrapper for each connection checked out through connect(), which complete() and rollback() hand back
+_checked_out = {}
+
+
+@contextmanager
+def transaction(cursor_factory=None):
+    """Borrow a pooled connection and yield a cursor on it.
+
+    The transaction is committed if the block finishes and rolled back if it raises, then the connection goes back to
+    the pool. Raises sqlalchemy.exc.TimeoutError if none is free within RAW_SQL_POOL_TIMEOUT seconds.
+    """
+    connection = _get_pool().connect()
+    try:
+        with connection.cursor(cursor_factory=cursor_factory) as raw_cursor:
+            yield raw_cursor
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+
 
 def connect(cursor_factory=None):
-    connection = psycopg2.connect(app.config['SQLALCHEMY_DATABASE_URI'])
+    connection = _get_pool().connect()
+    _checked_out[connection.connection] = connection
     return connection.cursor(cursor_factory=cursor_factory)
 
 
 def complete(cursor):
     cursor.connection.commit()
-    cursor.close()
-    cursor.connection.close()
+    _release(cursor)
 
 
 def rollback(cursor):
     cursor.connection.rollback()
+    _release(cursor)
+
+
+def _release(cursor):
     cursor.close()
-    cursor.connection.close()
+    # Closing the pool's wrapper returns the connection to the pool rather than closing it
+    _checked_out.pop(cursor.connection).close()
+
+
+def _create_connection():
+    # With the same application name and statement timeout as the app's other connections
+    return psycopg2.connect(app.config['SQLALCHEMY_DATABASE_URI'],
+                            **app.config['SQLALCHEMY_ENGINE_OPTIONS']['connect_args'])
+
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = QueuePool(_create_connection, pool_size=app.config['RAW_SQL_POOL_SIZE'],
+                                  max_overflow=app.config['RAW_SQL_MAX_OVERFLOW'],
+                                  timeout=app.config['RAW_SQL_POOL_TIMEOUT'],
+                                  recycle=app.config['SQLALCHEMY_ENGINE_OPTIONS']['pool_recycle'])
+    return _pool
@@ -0,0 +1,82 @@
+import functools
+import hashlib
+from flask import current_app, jsonify, make_response, request
+from verification_api.exceptions import ApplicationError
+from verification_api.extensions import unit_of_work
+from verification_api.services import verification_service as service
+
+# Headers a view sets that are part of its response, so a replay has them too
+REPLAYED_HEADERS = ('ETag', 'Location')
+
+
+def idempotent(view):
+    """Lets a client safely retry a request to the view by sending an Idempotency-Key header with it.
+
+    The first request with a key runs the view as normal and its response, along with any REPLAYED_HEADERS, is
+    stored. A retry with the same key gets the stored response back (with an Idempotent-Replayed header) without
+    running the view again, so nothing downstream is repeated. While the first request is still running a retry gets
+    a 409. The response is only stored once the view's work has been committed (see UnitOfWork.on_complete), and
+    responses with a 5xx code aren't stored, so the request can be retried with the same key.
+    """
+    @functools.wraps(view)
+    def run_once(*args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+        if not key:
+            return view(*args, **kwargs)
+
+        try:
+            stored = service.claim_idempotency_key(key, _hash_request())
+        except ApplicationError as error:
+            current_app.logger.error('Failed to process Idempotency-Key - {}'.format(error.message))
+            return jsonify(error=error.message), error.http_code
+
+        if stored is not None:
+            current_app.logger.info('Replaying response for Idempotency-Key {}'.format(key))
+            response_code, response_body, response_headers = stored
+            response = jsonify(response_body)
+            response.status_code = response_code
+            response.headers.extend(response_headers)
+            response.headers['Idempotent-Replayed'] = 'true'
+            return response
+
+        try:
+            response = make_response(view(*args, **kwargs))
+        except Exception:
+            _release(key)
+            raise
+
+        unit_of_work.on_complete(functools.partial(_complete, key))
+        return response
+
+    return run_once
+
+
+def _hash_request():
+    # The body is cached by get_data, so the view can still read it
+    request_hash = hashlib.sha256('{} {}\n'.format(request.method, request.path).encode())
+    request_hash.update(request.get_data())
+    return request_hash.hexdigest()
+
+
+def _complete(key, response):
+    if response.status_code < 500 and response.is_json:
+        _save(key, response)
+    else:
+        _release(key)
+
+
+def _save(key, response):
+    # The view's work is already committed, so failing to store its response shouldn't fail the request
+    try:
+        headers = {name: response.headers[name] for name in REPLAYED_HEADERS if name in response.headers}
+        service.save_idempotent_response(key, response.status_code, response.get_json(), headers)
+    except ApplicationError as error:
+        current_app.logger.error('Failed to store response for Idempotency-Key {} - {}'.format(key, error.message))
+        _release(key)
+
+
+def _release(key):
+    try:
+        service.release_idempotency_key(key)
+    except ApplicationError as error:
+        current_app.logger.error('Failed to release Idempotency-Key {} - {}'.format(key, error.message))
@@ -1,11 +1,27 @@
 import datetime
+import functools
 import json
+import threading
+import time
+from concurrent.futures import Future, TimeoutError
 from verification_api.dependencies import postgres
+from verification_api.custom_extensions.prometheus import main as prometheus
+from verification_api.utilities.concurrency import submit
 from flask import Blueprint, Response, current_app, g, request
+from prometheus_client import CONTENT_TYPE_LATEST
 
 # This is the blueprint object that gets registered into the app in blueprints.py.
 general = Blueprint('general', __name__)
 
+# Sent to dependencies with how long in seconds we'll wait for their cascade, so they can give up on theirs in time
+CASCADE_TIMEOUT_HEADER = 'X-Cascade-Timeout'
+DBS = 'db'
+SERVICES = 'services'
+
+# Cascade checks in progress in this worker, by depth
+_cascades_in_flight = {}
+_cascades_lock = threading.Lock()
+
 
 @general.route("/health")
 def check_status():
@@ -17,6 +33,11 @@ def check_status():
     }, separators=(',', ':')), mimetype='application/json', status=200)
 
 
+@general.route("/metrics")
+def metrics():
+    return Response(response=prometheus.generate_metrics(), mimetype=CONTENT_TYPE_LATEST, status=200)
+
+
 @general.route("/health/cascade/<int:depth>")
 def cascade_health(depth):
     if (depth < 0) or (depth > current_app.config.get("MAX_HEALTH_CASCADE")):
@@ -28,75 +49,7 @@ def cascade_health(depth):
             "status": "ERROR",
             "timestamp": str(datetime.datetime.utcnow())
         }, separators=(',', ':')), mimetype='application/json', status=500)
-    dbs = []
-    services = []
-    # if we encounter a failure at any point then this will be set to != 200
-    overall_status = 200
-    if current_app.config.get("DEPENDENCIES") is not None:
-        for dependency, value in current_app.config.get("DEPENDENCIES").items():
-            # Below is an example of hitting a database dependency - in this instance postgresql
-            # It requires a route to obtain the current timestamp to be declared somewhere in code
-            # In the below example we have an sql.py script containing the get_current_timestamp() function
-            if "postgres" in value:
-                # postgres db url - try calling current timestamp routine
-                db = {"name": dependency}
-                try:
-                    db_timestamp = postgres.get_current_timestamp()
-                    # trim microseconds to 3 to match java
-                    db["current_timestamp"] = db_timestamp.strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + 'Z'
-                    db["status"] = "OK"
-                except Exception as e:
-                    current_app.logger.error("Unknown error occurred during health cascade on request to database: {};"
-                                             " full error: {}.".format(dependency, e))
-                    overall_status = 500
-                    db["status"] = "BAD"
-                finally:
-                    dbs.append(db)
-            else:  # indent the following code to match the if..else block when database checks are included
-                if depth > 0:
-                    # As there is an inconsistant approach to url variables we need to check
-                    # to see if we have a trailing '/' and add one if not
-                    if value[-1] != '/':
-                        value = value + '/'
-                    # Setup our service entry
-                    service = {
-                        "name": dependency,
-                        "type": "http"
-                    }
-                    try:
-                        # Try and request the health
-                        resp = g.requests.get(
-                            value + 'health/cascade/' + str(depth - 1))
-                    except ConnectionAbortedError as e:  # More specific logging statement for abortion error
-                        current_app.logger.error("Connection Aborted during health cascade on attempt to connect to"
-                                                 " {}; full error: {}".format(dependency, e))
-                        service["status"] = "UNKNOWN"
-                        overall_status = 500
-                        service["status_code"] = None
-                        service["content_type"] = None
-                        service["content"] = None
-                    except Exception as e:  # Generic catch-all exception
-                        current_app.logger.error("Unknown error occured during health cascade on request to {};"
-                                                 " full error: {}".format(dependency, e))
-                        service["status"] = "UNKNOWN"
-                        overall_status = 500
-                        service["status_code"] = None
-                        service["content_type"] = None
-                        service["content"] = None
-                    else:   # Everything worked
-                        service["status_code"] = resp.status_code
-                        service["content_type"] = resp.headers["content-type"]
-                        service["content"] = resp.json()
-                        if resp.status_code == 200:  # Happy route, happy service, happy status_code.
-                            service["status"] = "OK"
-                        elif resp.status_code == 500:  # Something went wrong
-                            service["status"] = "BAD"
-                            overall_status = 500
-                        else:   # Who knows what happened.
-                            service["status"] = "UNKNOWN"
-                            overall_status = 500
-                    finally:
-                        services.append(service)
+    dbs, services, overall_status = _run_cascade(depth, _get_cascade_budget())
     response_json = {
         "cascade_depth": depth,
         "server_timestamp": str(datetime.datetime.now()),
@@ -113,3 +66,160 @@ def cascade_health(depth):
         response_json['status'] = "OK"
     return Response(response=json.dumps(response_json, separators=(',', ':')),
                     mimetype='application/json', status=overall_status)
+
+
+def _get_cascade_budget():
+    # How long in seconds the cascade has to finish. A caller further up the cascade tells us how long it will wait,
+    # so we don't go on waiting for our dependencies after it has given up on us.
+    budget = float(current_app.config.get("HEALTH_CASCADE_TIMEOUT"))
+    try:
+        return min(budget, float(request.headers.get(CASCADE_TIMEOUT_HEADER, budget)))
+    except ValueError:
+        return budget
+
+
+def _run_cascade(depth, budget):
+    # Concurrent cascade checks at the same depth share the one set of probes, rather than each adding to the load
+    # on the dependencies (which cascade further themselves)
+    with _cascades_lock:
+        cascade = _cascades_in_flight.get(depth)
+        leader = cascade is None
+        if leader:
+            cascade = Future()
+            _cascades_in_flight[depth] = cascade
+
+    if not leader:
+        # The leader's caller may allow it longer than ours allows us, so we only wait as long as we have left
+        try:
+            return cascade.result(timeout=budget)
+        except TimeoutError:
+            current_app.logger.error("Timed out after {}s waiting for the health cascade already in progress"
+                                     .format(budget))
+            return _failed_cascade(depth)
+
+    try:
+        result = _probe_dependencies(depth, budget)
+        cascade.set_result(result)
+        return result
+    except Exception as e:
+        cascade.set_exception(e)
+        raise
+    finally:
+        with _cascades_lock:
+            del _cascades_in_flight[depth]
+
+
+def _probe_dependencies(depth, budget):
+    # Probes every dependency at once, each having until the deadline to answer. Returns (dbs, services, status).
+    deadline = time.monotonic() + budget
+    probes = []
+    for kind, dependency, value in _get_dependencies(depth):
+        # Below is an example of hitting a database dependency - in this instance postgresql
+        # It requires a route to obtain the current timestamp to be declared somewhere in code
+        # In the below example we have an sql.py script containing the get_current_timestamp() function
+        if kind == DBS:
+            probe = functools.partial(_probe_database, dependency)
+        else:
+            probe = functools.partial(_probe_service, dependency, value, depth, deadline)
+        # On threads of their own, so they aren't held up by requests' fan out calls when the worker is busy
+        probes.append((kind, dependency, submit(probe, workers='HEALTH_CASCADE_WORKERS')))
+
+    results = {DBS: [], SERVICES: []}
+    # if we encounter a failure at any point then this will be set to != 200
+    overall_status = 200
+    for kind, dependency, probe in probes:
+        try:
+            result, ok = probe.result(timeout=max(deadline - time.monotonic(), 0))
+        except TimeoutError:
+            current_app.logger.error("Timed out after {}s during health cascade on request to {}"
+                                     .format(budget, dependency))
+            result, ok = _failed_probe(kind, dependency), False
+        if not ok:
+            overall_status = 500
+        results[kind].append(result)
+    return results[DBS], results[SERVICES], overall_status
+
+
+def _get_dependencies(depth):
+    # The dependencies a cascade at this depth checks, as (kind, name, url)
+    dependencies = []
+    for dependency, value in (current_app.config.get("DEPENDENCIES") or {}).items():
+        if "postgres" in value:
+            dependencies.append((DBS, dependency, value))
+        elif depth > 0:
+            dependencies.append((SERVICES, dependency, value))
+    return dependencies
+
+
+def _failed_cascade(depth):
+    # Every dependency reported as failed, for when we couldn't find out in time. Returns (dbs, services, status).
+    results = {DBS: [], SERVICES: []}
+    for kind, dependency, _ in _get_dependencies(depth):
+        results[kind].append(_failed_probe(kind, dependency))
+    return results[DBS], results[SERVICES], 500
+
+
+def _probe_database(dependency):
+    # postgres db url - try calling current timestamp routine
+    db = {"name": dependency}
+    try:
+        db_timestamp = postgres.get_current_timestamp()
+        # trim microseconds to 3 to match java
+        db["current_timestamp"] = db_timestamp.strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + 'Z'
+        db["status"] = "OK"
+    except Exception as e:
+        current_app.logger.error("Unknown error occurred during health cascade on request to database: {};"
+                                 " full error: {}.".format(dependency, e))
+        db["status"] = "BAD"
+    return db, db["status"] == "OK"
+
+
+def _probe_service(dependency, value, depth, deadline):
+    # As there is an inconsistant approach to url variables we need to check
+    # to see if we have a trailing '/' and add one if not
+    if value[-1] != '/':
+        value = value + '/'
+    # Whatever is left of our budget is all the dependency gets, and it's told to leave a little of that for its
+    # response to get back to us
+    timeout = max(deadline - time.monotonic(), 0.001)
+    try:
+        # Try and request the health
+        resp = g.requests.get(value + 'health/cascade/' + str(depth - 1), timeout=timeout,
+                              headers={CASCADE_TIMEOUT_HEADER: '{:.3f}'.format(timeout * 0.9)})
+    except ConnectionAbortedError as e:  # More specific logging statement for abortion error
+        current_app.logger.error("Connection Aborted during health cascade on attempt to connect to"
+                                 " {}; full error: {}".format(dependency, e))
+        return _failed_probe(SERVICES, dependency), False
+    except Exception as e:  # Generic catch-all exception
+        current_app.logger.error("Unknown error occured during health cascade on request to {};"
+                                 " full error: {}".format(dependency, e))
+        return _failed_probe(SERVICES, dependency), False
+
+    # Setup our service entry
+    service = {
+        "name": dependency,
+        "type": "http",
+        "status_code": resp.status_code,
+        "content_type": resp.headers["content-type"],
+        "content": resp.json()
+    }
+    if resp.status_code == 200:  # Happy route, happy service, happy status_code.
+        service["status"] = "OK"
+    elif resp.status_code == 500:  # Something went wrong
+        service["status"] = "BAD"
+    else:   # Who knows what happened.
+        service["status"] = "UNKNOWN"
+    return service, service["status"] == "OK"
+
+
+def _failed_probe(kind, dependency):
+    if kind == DBS:
+        return {"name": dependency, "status": "BAD"}
+    return {
+        "name": dependency,
+        "type": "http",
+        "status": "UNKNOWN",
+        "status_code": None,
+        "content_type": None,
+        "content": None
+    }
@@ -1,11 +1,14 @@
+import json
 from datetime import datetime
-from flask import request, Blueprint, jsonify
+from flask import request, Blueprint, Response, jsonify, stream_with_context
 from flask_negotiate import consumes, produces
+from common_utilities import errors
 
 from verification_api.app import app
 from verification_api.exceptions import ApplicationError
 from verification_api.services import verification_service as service
 from verification_api.dependencies.metric_api import insert_metric_event, handle_dataset_access_metrics
+from verification_api.utilities.idempotency import idempotent
 
 
 verification_bp = Blueprint('verification_bp', __name__)
@@ -15,6 +18,15 @@ verification_bp = Blueprint('verification_bp', __name__)
 @produces('application/json')
 def get_worklist():
     try:
+        if 'limit' in request.args or 'cursor' in request.args:
+            app.logger.info("Getting page of work-list")
+            page = service.get_pending_page(request.args.get('limit'), request.args.get('cursor'))
+            return jsonify(page)
+
+        if request.args.get('stream') == 'true':
+            app.logger.info("Streaming all work-list")
+            return Response(stream_with_context(service.stream_pending()), mimetype='application/json')
+
         app.logger.info("Getting all work-list")
         pending = service.get_pending()
         return jsonify(pending)
@@ -24,6 +36,28 @@ def get_worklist():
         return jsonify(error=error_message), error.http_code
 
 
+@verification_bp.route('/worklist/claim', methods=['POST'])
+@consumes('application/json')
+@produces('application/json')
+def claim_next_case():
+    try:
+        staff_id = request.get_json(force=True)['staff_id']
+        app.logger.info('Claiming next case for {}'.format(staff_id))
+        case = service.claim_next_case(staff_id)
+        if case is None:
+            app.logger.info('No unlocked cases left to claim')
+            return '', 204
+
+        return jsonify(case), 200
+    except ApplicationError as error:
+        error_msg = 'Failed to claim case - {}'.format(error.message)
+        app.logger.error(error_msg)
+        return jsonify(error=error_msg), error.http_code
+    except KeyError:
+        app.logger.error('Bad request - staff_id not in body')
+        return jsonify(error="Failed to claim case - no 'staff_id' provided"), 400
+
+
 @verification_bp.route('/case', methods=['POST'])
 @consumes('application/json')
 @produces('application/json')
@@ -46,22 +80,66 @@ def insert_case():
         return jsonify(error=error_msg), error.http_code
 
 
+@verification_bp.route('/cases/bulk', methods=['POST'])
+@consumes('application/json', 'application/x-ndjson')
+@produces('application/json')
+def insert_cases():
+    try:
+        if request.mimetype == 'application/x-ndjson':
+            # One case per line, read as the request streams in rather than all at once
+            cases = (json.loads(line) for line in request.stream if line.strip())
+        else:
+            cases = request.get_json(force=True)
+            if not isinstance(cases, list):
+                return jsonify(error='Failed to insert cases - expected a JSON array of cases'), 400
+
+        app.logger.info("Inserting cases in bulk")
+        case_ids = service.insert_cases(cases)
+        app.logger.info("Inserted {} cases".format(len(case_ids)))
+        return jsonify(case_ids=case_ids), 201
+    except ApplicationError as error:
+        error_msg = 'Failed to insert cases - {}'.format(error.message)
+        app.logger.error(error_msg)
+        return jsonify(error=error_msg), error.http_code
+    except ValueError as error:
+        error_msg = 'Failed to insert cases - invalid JSON: {}'.format(error)
+        app.logger.error(error_msg)
+        return jsonify(error=error_msg), 400
+
+
 @verification_bp.route('/case/<case_id>', methods=['GET'])
 @produces('application/json')
 def get_case_by_id(case_id):
     try:
         app.logger.info("Getting details for id: {}".format(case_id))
         result = service.get_pending_by_id(case_id)
-        return jsonify(result)
+        response = jsonify(result)
+        # Only for If-Match on updates. The version doesn't cover the lock or notes, so it can't answer If-None-Match.
+        response.set_etag(str(result['version']))
+        return response
     except ApplicationError as error:
         error_message = "Failed to get case '{}' - {}".format(case_id, error.message)
         app.logger.error(error_message)
         return jsonify(error=error_message), error.http_code
 
 
+@verification_bp.route('/case/<case_id>/full', methods=['GET'])
+@produces('application/json')
+def get_case_details(case_id):
+    try:
+        app.logger.info("Getting full details for id: {}".format(case_id))
+        result = service.get_case_details(case_id)
+        return jsonify(result)
+    except ApplicationError as error:
+        error_message = "Failed to get full details for case '{}' - {}".format(case_id, error.message)
+        app.logger.error(error_message)
+        return jsonify(error=error_message), error.http_code
+
+
 @verification_bp.route('/case/<case_id>/approve', methods=['POST'])
 @consumes('application/json')
 @produces('application/json')
+@idempotent
 def approve_case(case_id):
     try:
         approval = request.get_json(force=True)
@@ -71,10 +149,6 @@ def approve_case(case_id):
             app.logger.error('Failed to approve case {}'.format(case_id))
             return jsonify(result), 500
 
-        user_details = service.get_pending_by_id(case_id)
-
-        insert_metric_event('dst action approved', user_details)
-
         return jsonify(result), 200
 
     except ApplicationError as error:
@@ -87,6 +161,7 @@ def approve_case(case_id):
 @verification_bp.route('/case/<case_id>/decline', methods=['POST'])
 @consumes('application/json')
 @produces('application/json')
+@idempotent
 def decline_case(case_id):
     try:
         decline = request.get_json(force=True)
@@ -96,9 +171,6 @@ def decline_case(case_id):
             app.logger.error('Failed to approve case {}'.format(case_id))
             return jsonify(result), 500
 
-        user_details = service.get_pending_by_id(case_id)
-        user_details['decline_reason'] = decline['reason']
-
         return jsonify(result), 200
 
     except ApplicationError as error:
@@ -108,9 +180,44 @@ def decline_case(case_id):
         return jsonify(error=error_msg), error.http_code
 
 
+@verification_bp.route('/cases/approve', methods=['POST'])
+@consumes('application/json')
+@produces('application/json')
+@idempotent
+def approve_cases():
+    try:
+        approval = request.get_json(force=True)
+        case_ids = _get_case_ids(approval, 'staff_id')
+        app.logger.info('Approving {} cases, by: {}'.format(len(case_ids), approval['staff_id']))
+        results = service.bulk_dps_action('Approve', case_ids, approval)
+        return jsonify(results=results), 200
+    except ApplicationError as error:
+        error_msg = 'Failed to approve cases - {}'.format(error.message)
+        app.logger.error(error_msg)
+        return jsonify(error=error_msg), error.http_code
+
+
+@verification_bp.route('/cases/decline', methods=['POST'])
+@consumes('application/json')
+@produces('application/json')
+@idempotent
+def decline_cases():
+    try:
+        decline = request.get_json(force=True)
+        case_ids = _get_case_ids(decline, 'staff_id', 'reason', 'advice')
+        app.logger.info('Declining {} cases, by: {}'.format(len(case_ids), decline['staff_id']))
+        results = service.bulk_dps_action('Decline', case_ids, decline)
+        return jsonify(results=results), 200
+    except ApplicationError as error:
+        error_msg = 'Failed to decline cases - {}'.format(error.message)
+        app.logger.error(error_msg)
+        return jsonify(error=error_msg), error.http_code
+
+
 @verification_bp.route('/case/<case_id>/note', methods=['POST'])
 @consumes('application/json')
 @produces('application/json')
+@idempotent
 def insert_notes(case_id):
     try:
         note_details = request.get_json(force=True)
@@ -129,8 +236,12 @@ def insert_notes(case_id):
 def get_decline_reasons():
     try:
         app.logger.info('Fetching DPS decline reasons')
-        reasons = service.get_decline_reasons()
-        return jsonify(reasons)
+        body, etag = service.get_decline_reasons()
+        response = app.response_class(body, mimetype='application/json')
+        response.set_etag(etag)
+        # Clients may keep a copy but must check it's still current, as it can change at any time
+        response.cache_control.no_cache = True
+        return response.make_conditional(request)
     except ApplicationError as error:
         error_msg = 'Failed to get decline reasons - {}'.format(error.message)
         app.logger.error(error_msg)
@@ -145,8 +256,8 @@ def lock_application(case_id):
         details = request.get_json(force=True)
         owner = details['staff_id']
         app.logger.info('Locking case {} to {}'.format(case_id, owner))
-        service.manage_case_lock(case_id, owner)
-        return '', 204
+        result = service.manage_case_lock(case_id, owner)
+        return jsonify(result), 200
     except ApplicationError as error:
         app.logger.error('Failed to lock case - {}'.format(error.message))
         return jsonify(error=error.message), error.http_code
@@ -171,6 +282,7 @@ def unlock_application(case_id):
 @verification_bp.route('/case/<case_id>/close', methods=['POST'])
 @consumes('application/json')
 @produces('application/json')
+@idempotent
 def close_account(case_id):
     try:
         closure_data = request.get_json(force=True)
@@ -181,13 +293,6 @@ def close_account(case_id):
         service.insert_note(case_id, {'staff_id': closure_data['staff_id'],
                                       'note_text': closure_text})
 
-        user_details = service.get_pending_by_id(case_id)
-        user_details = {key: '' if value is None else value for (key, value) in user_details.items()}
-        closure_details = service.get_closure_by_id(case_id)
-        user_details.update(closure_details)
-
-        insert_metric_event('account closed', user_details)
-
         return jsonify(result), 200
     except ApplicationError as error:
         error_msg = 'Failed to close account {} - {}'.format(case_id, error.message)
@@ -196,6 +301,23 @@ def close_account(case_id):
         return jsonify(error=error_msg), error.http_code
 
 
+@verification_bp.route('/cases/close', methods=['POST'])
+@consumes('application/json')
+@produces('application/json')
+@idempotent
+def close_accounts():
+    try:
+        closure_data = request.get_json(force=True)
+        case_ids = _get_case_ids(closure_data, 'staff_id', 'requester', 'close_detail')
+        app.logger.info('Starting to close {} accounts'.format(len(case_ids)))
+        results = service.bulk_close_accounts(case_ids, closure_data)
+        return jsonify(results=results), 200
+    except ApplicationError as error:
+        error_msg = 'Failed to close accounts - {}'.format(error.message)
+        app.logger.error(error_msg)
+        return jsonify(error=error_msg), error.http_code
+
+
 @verification_bp.route('/case/<ldap_id>/auto_close', methods=['POST'])
 @consumes('application/json')
 @produces('application/json')
@@ -214,13 +336,16 @@ def auto_close(ldap_id):
 @verification_bp.route('/case/<case_id>/update', methods=['POST'])
 @consumes('application/json')
 @produces('application/json')
+@idempotent
 def update_details(case_id):
     try:
         app.logger.info("Updating the contact preference for user {}".format(case_id))
         data = request.get_json(force=True)
-        result = service.update_user_details(case_id, data)
+        result = service.update_user_details(case_id, data, _get_if_match_version())
 
-        return jsonify(result), 200
+        response = jsonify(result)
+        response.set_etag(str(result['version']))
+        return response, 200
     except ApplicationError as error:
         error_msg = 'Failed to update contact details - {}'.format(error.message)
         app.logger.error(error_msg)
@@ -265,8 +390,12 @@ def search():
 def get_dataset_list_details():
     try:
         app.logger.info("Getting detailed dataset list from ckan")
-        dataset_list = service.get_dataset_list_details()
-        return jsonify(dataset_list), 200
+        dataset_list, etag = service.get_dataset_list_details()
+        response = jsonify(dataset_list)
+        response.set_etag(etag)
+        response.cache_control.max_age = app.config['DATASET_LIST_CACHE_TTL']
+        # Turns the response into a 304 if the client already has this version
+        return response.make_conditional(request)
     except ApplicationError as error:
         error_msg = 'Failed to get detailed dataset list - {}'.format(error.message)
         app.logger.error(error_msg)
@@ -310,3 +439,34 @@ def get_user_dataset_access(case_id):
         error_msg = 'Failed to get dataset access - {}'.format(error.message)
         app.logger.error(error_msg)
         return jsonify(error=error_msg), error.http_code
+
+
+def _get_if_match_version():
+    # A case's ETag is its version, so If-Match carries the version the client last read
+    etags = request.if_match.as_set()
+    if not etags:
+        return None
+    try:
+        return int(next(iter(etags)))
+    except ValueError:
+        error_msg = 'If-Match must be the ETag of the case'
+        raise ApplicationError(*errors.get('verification_api', 'VERIFICATION_ERROR', filler=error_msg),
+                               http_code=400)
+
+
+def _get_case_ids(data, *required):
+    # Checks a bulk action's body has the fields the action needs and a list of case ids, and returns the ids
+    missing = [field for field in required if not isinstance(data, dict) or field not in data]
+    if missing:
+        error_msg = 'Missing {}'.format(', '.join(missing))
+        raise ApplicationError(*errors.get('verification_api', 'VERIFICATION_ERROR', filler=error_msg),
+                               http_code=400)
+
+    case_ids = data.get('case_ids')
+    # bool is a subclass of int, but true isn't case 1
+    if not isinstance(case_ids, list) or not all(isinstance(case_id, int) and not isinstance(case_id, bool)
+                                                 for case_id in case_ids):
+        error_msg = 'case_ids must be a list of case ids'
+        raise ApplicationError(*errors.get('verification_api', 'VERIFICATION_ERROR', filler=error_msg),
+                               http_code=400)
+    return case_ids